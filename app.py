@@ -1,19 +1,61 @@
 import json
+import logging
 import os
 import uuid
 from datetime import datetime, timedelta
 from functools import wraps
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, session, jsonify, flash, stream_with_context
 
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+from utils import attachments as attachment_store
+from utils import file_delivery
+from utils import image_variants
+from utils import metrics
 from utils.auth import register_user, login_user, get_user_by_id
+from utils.chat_context import (
+    answer_with_context,
+    clear_conversation,
+    load_conversation,
+    stream_answer_with_context,
+)
 from utils.database import Database
-from utils.exam_parser import ExamParseError, parse_docx_exam
-from utils.gemini_api import chat_with_gemini
+from utils.exam_blueprint import (
+    DIFFICULTIES,
+    DIFFICULTY_LABELS,
+    BlueprintError,
+    build_blueprint,
+    generate_exam,
+    new_seed,
+)
+from utils.fragment_cache import render_cached_page
+from utils.grading import (
+    calculate_tl2_score,
+    count_correct,
+    format_correct_answer,
+    normalize_answer_token,
+    normalize_correct_answers,
+)
+from utils.import_jobs import (
+    abandon_import_job,
+    create_import_job,
+    enqueue_batch_import_job,
+    enqueue_import_job,
+    get_job as get_import_job,
+    store_upload,
+)
+from utils.item_analysis import ItemAnalysis
+from utils.leaderboard import LEADERBOARD_SIZE, Leaderboards
+from utils.regrade_jobs import enqueue_regrade_job
+from utils.static_assets import StaticAssets
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-me')
@@ -21,10 +63,15 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 app.config['SESSION_COOKIE_SECURE'] = os.getenv('SESSION_COOKIE_SECURE', 'false').lower() == 'true'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = os.getenv('SESSION_COOKIE_SAMESITE', 'Lax')
+# Giới hạn tổng dung lượng một request (kể cả file .zip đề thi); từng file đính kèm diễn đàn còn bị giới hạn bởi MAX_FILE_SIZE
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH_MB', '100')) * 1024 * 1024
 
 FORUM_UPLOAD_FOLDER = os.getenv('FORUM_UPLOAD_FOLDER', 'static/uploads/forum')
 EXAM_UPLOAD_FOLDER = os.getenv('EXAM_UPLOAD_FOLDER', 'static/uploads/exams')
 ALLOWED_EXAM_EXTENSIONS = {'docx'}
+ALLOWED_EXAM_ARCHIVE_EXTENSIONS = {'zip'}
+# Số nhóm câu gần trùng hiển thị trên trang báo cáo
+DUPLICATE_REPORT_LIMIT = 200
 
 
 GRADE_LABELS = {
@@ -36,7 +83,24 @@ GRADE_LABELS = {
 AVAILABLE_GRADES = list(GRADE_LABELS.keys())
 DEFAULT_GRADE = '12'
 
+# Các trang nội dung tĩnh được render sẵn (xem `flask build-static`)
+PRERENDERED_PAGES = [
+    'lop10.html',
+    'lop11.html',
+    'lop12.html',
+    'onthi/onthi_main.html',
+    'onthi/de_tham_khao.html',
+    'onthi/tai_lieu_on_luyen.html',
+    'onthi/de_chinh_thuc.html'
+]
+
 db = Database()
+# Dữ liệu khóa học định dạng cũ (bài học nhúng trong courses.json) được tách một lần, trong khóa file
+db.migrate_courses()
+exam_analytics = ItemAnalysis(db)
+leaderboards = Leaderboards(db)
+static_assets = StaticAssets(app)
+metrics.init_app(app)
 
 
 def login_required(f):
@@ -169,7 +233,7 @@ def student_dashboard():
     
     enrolled_courses = []
     for progress in my_progress:
-        course = db.get_course_by_id(progress['course_id'])
+        course = db.get_course_summary(progress['course_id'])
         if course:
             total_lessons = len(course.get('lessons', []))
             completed_lessons = len(progress.get('completed_lessons', []))
@@ -212,15 +276,20 @@ def teacher_dashboard():
 @app.route('/courses')
 @login_required
 def courses():
-    all_courses = db.get_all_courses()
-    
-    courses_with_teacher = []
-    for course in all_courses:
-        teacher = get_user_by_id(course['teacher_id'])
-        course['teacher_name'] = teacher['username'] if teacher else 'Unknown'
-        courses_with_teacher.append(course)
+    def load_courses():
+        all_courses = db.get_all_courses()
+        
+        courses_with_teacher = []
+        for course in all_courses:
+            teacher = get_user_by_id(course['teacher_id'])
+            course['teacher_name'] = teacher['username'] if teacher else 'Unknown'
+            courses_with_teacher.append(course)
+        return {'courses': courses_with_teacher}
     
-    return render_template('courses.html', courses=courses_with_teacher)
+    return render_cached_page(
+        'courses.html', 'partials/courses_list.html', 'courses_html',
+        ['courses', 'users'], load_courses
+    )
 
 
 @app.route('/course/<course_id>')
@@ -302,7 +371,7 @@ def edit_course(course_id):
 @app.route('/teacher/delete_course/<course_id>', methods=['POST'])
 @teacher_required
 def delete_course(course_id):
-    course = db.get_course_by_id(course_id)
+    course = db.get_course_summary(course_id)
     
     if not course:
         return jsonify({'success': False, 'message': 'Khóa học không tồn tại'})
@@ -310,9 +379,7 @@ def delete_course(course_id):
     if course['teacher_id'] != session['user_id']:
         return jsonify({'success': False, 'message': 'Bạn không có quyền xóa khóa học này'})
     
-    courses = db.get_all_courses()
-    courses = [c for c in courses if c['id'] != course_id]
-    db._save_json(db.courses_file, courses)
+    db.delete_course(course_id)
     
     return jsonify({'success': True, 'message': 'Xóa khóa học thành công'})
 
@@ -320,31 +387,32 @@ def delete_course(course_id):
 @app.route('/exercises')
 @login_required
 def exercises():
-    all_courses = db.get_all_courses()
-    
-    exercises_list = []
-    for course in all_courses:
-        for lesson in course.get('lessons', []):
-            questions = lesson.get('questions', [])
-            if questions:
-                exercises_list.append({
-                    'course_id': course['id'],
-                    'course_title': course['title'],
-                    'lesson_id': lesson['id'],
-                    'lesson_title': lesson['title'],
-                    'questions': questions
-                })
-    
-    try:
-        all_submissions = db._load_json(db.submissions_file) if hasattr(db, 'submissions_file') else []
-    except:
-        all_submissions = []
-    
-    my_submissions = [s for s in all_submissions if s.get('user_id') == session['user_id']]
-    
-    return render_template('exercises.html', 
-                         exercises=exercises_list,
-                         submissions=my_submissions)
+    # Danh mục bài tập và bài nộp của học sinh đều lấy từ chỉ mục; nội dung câu hỏi tải khi mở bài
+    return render_template('exercises.html',
+                         exercises=db.get_exercise_catalogue(),
+                         submissions=db.get_user_submissions(session['user_id']))
+
+
+@app.route('/exercises/<course_id>/<lesson_id>/questions')
+@login_required
+def exercise_questions(course_id, lesson_id):
+    """Câu hỏi của một bài tập để làm bài (không kèm đáp án)."""
+    course = db.get_course_summary(course_id)
+    if not course or not any(str(l['id']) == lesson_id for l in course.get('lessons', [])):
+        return jsonify({'success': False, 'message': 'Không tìm thấy bài tập'}), 404
+    lesson = db.get_lesson(course_id, lesson_id)
+    if not lesson or not lesson.get('questions'):
+        return jsonify({'success': False, 'message': 'Không tìm thấy bài tập'}), 404
+
+    return jsonify({
+        'success': True,
+        'course_title': course.get('title', ''),
+        'lesson_title': lesson.get('title', ''),
+        'questions': [
+            {'question': q.get('question', ''), 'options': q.get('options') or []}
+            for q in lesson['questions']
+        ]
+    })
 
 
 @app.route('/submit_exercise', methods=['POST'])
@@ -356,41 +424,36 @@ def submit_exercise():
         if not data.get('course_id') or not data.get('lesson_id') or not data.get('answers'):
             return jsonify({'success': False, 'message': 'Dữ liệu không đầy đủ'})
         
+        course = db.get_course_summary(data['course_id'])
+        if not course or not any(str(lesson['id']) == str(data['lesson_id']) for lesson in course.get('lessons', [])):
+            return jsonify({'success': False, 'message': 'Không tìm thấy bài tập'}), 404
+        
         submission_data = {
             'course_id': data['course_id'],
             'exercise_id': data['lesson_id'],
             'answers': data['answers'],
             'submitted_at': datetime.now().isoformat()
         }
-        
+
+        # Chấm theo đáp án đã biên dịch sẵn trong bộ nhớ, không đọc lại nội dung bài học
+        answer_key = db.get_lesson_answer_key(data['course_id'], data['lesson_id'])
+        if answer_key is not None:
+            correct = count_correct(answer_key, data['answers'])
+            total = len(answer_key)
+            score = round((correct / total * 100) if total > 0 else 0, 1)
+            submission_data.update(score=score, correct=correct, total=total)
+
         submission_id = db.save_exercise_submission(session['user_id'], submission_data)
-        
-        course = db.get_course_by_id(data['course_id'])
-        if course:
-            lesson = next((l for l in course.get('lessons', []) if l['id'] == data['lesson_id']), None)
-            if lesson:
-                questions = lesson.get('questions', [])
-                correct = 0
-                total = len(questions)
-                
-                for i, q in enumerate(questions):
-                    user_answer_raw = data['answers'].get(str(i), '')
-                    user_choice = normalize_answer_token(user_answer_raw)
-                    correct_answers = normalize_correct_answers(q.get('correct_answer'))
-                    
-                    if user_choice and user_choice in correct_answers:
-                        correct += 1
-                
-                score = round((correct / total * 100) if total > 0 else 0, 1)
-                
-                return jsonify({
-                    'success': True,
-                    'submission_id': submission_id,
-                    'score': score,
-                    'correct': correct,
-                    'total': total,
-                    'message': 'Nộp bài thành công'
-                })
+
+        if answer_key is not None:
+            return jsonify({
+                'success': True,
+                'submission_id': submission_id,
+                'score': score,
+                'correct': correct,
+                'total': total,
+                'message': 'Nộp bài thành công'
+            })
         
         return jsonify({'success': True, 'submission_id': submission_id, 'message': 'Nộp bài thành công'})
     
@@ -404,31 +467,41 @@ def documents():
     grade_filter = request.args.get('grade', 'all')
     type_filter = request.args.get('type', 'all')
     
-    docs = db.get_all_documents()
-    
-    # ✅ Thêm giá trị mặc định cho documents cũ
-    for doc in docs:
-        if 'grade' not in doc or not doc.get('grade'):
-            doc['grade'] = '12'  # Mặc định lớp 12
-        if 'doc_type' not in doc or not doc.get('doc_type'):
-            doc['doc_type'] = 'document'  # Mặc định là tài liệu
-    
-    if grade_filter != 'all':
-        docs = [d for d in docs if str(d.get('grade')) == grade_filter]
-    if type_filter != 'all':
-        docs = [d for d in docs if d.get('doc_type') == type_filter]
-    
-    docs_by_grade = {
-        grade: [d for d in docs if str(d.get('grade')) == grade]
-        for grade in AVAILABLE_GRADES
-    }
+    def load_documents():
+        docs = db.get_all_documents()
+        
+        # ✅ Thêm giá trị mặc định cho documents cũ
+        for doc in docs:
+            if 'grade' not in doc or not doc.get('grade'):
+                doc['grade'] = '12'  # Mặc định lớp 12
+            if 'doc_type' not in doc or not doc.get('doc_type'):
+                doc['doc_type'] = 'document'  # Mặc định là tài liệu
+        
+        if grade_filter != 'all':
+            docs = [d for d in docs if str(d.get('grade')) == grade_filter]
+        if type_filter != 'all':
+            docs = [d for d in docs if d.get('doc_type') == type_filter]
+        
+        docs_by_grade = {
+            grade: [d for d in docs if str(d.get('grade')) == grade]
+            for grade in AVAILABLE_GRADES
+        }
+        return {
+            'docs_by_grade': docs_by_grade,
+            'current_grade': grade_filter,
+            'grade_labels': GRADE_LABELS
+        }
     
-    return render_template('documents.html',
-                         docs_by_grade=docs_by_grade,
-                         current_grade=grade_filter,
-                         current_type=type_filter,
-                         grade_labels=GRADE_LABELS,
-                         grade_choices=AVAILABLE_GRADES)
+    # Nút xóa chỉ hiện với giáo viên nên vai trò là một phần của khóa cache
+    return render_cached_page(
+        'documents.html', 'partials/documents_list.html', 'documents_html',
+        ['documents'], load_documents,
+        fragment_key=(session.get('role'), grade_filter, type_filter),
+        current_grade=grade_filter,
+        current_type=type_filter,
+        grade_labels=GRADE_LABELS,
+        grade_choices=AVAILABLE_GRADES
+    )
                          ################################################33
 
 
@@ -516,161 +589,80 @@ def import_exam():
             errors.append('Thời gian làm bài phải là số nguyên dương (phút).')
             time_limit = 15
 
-        if not title:
+        is_batch = bool(exam_file and exam_file.filename and is_exam_archive(exam_file.filename))
+
+        # Import hàng loạt lấy tên đề theo tên file, tên nhập vào chỉ là tiền tố
+        if not title and not is_batch:
             errors.append('Vui lòng nhập tên đề thi.')
 
         if not exam_file or not exam_file.filename:
             errors.append('Vui lòng chọn file .docx cần import.')
-        elif not allowed_exam_file(exam_file.filename):
-            errors.append('Chỉ hỗ trợ file định dạng .docx.')
+        elif not allowed_exam_file(exam_file.filename) and not is_batch:
+            errors.append('Chỉ hỗ trợ file định dạng .docx hoặc .zip chứa các file .docx.')
 
         if errors:
             for message in errors:
                 flash(message, 'danger')
             return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
 
-        secure_name = secure_filename(exam_file.filename)
-        ensure_directory(EXAM_UPLOAD_FOLDER)
-        temp_filename = f"{uuid.uuid4().hex}_{secure_name}"
-        temp_path = os.path.join(EXAM_UPLOAD_FOLDER, temp_filename)
-        exam_file.save(temp_path)
-
-        parsed_questions = []
-
-        try:
-            parsed_questions = parse_docx_exam(temp_path, allow_multiple_answers=False)
-        except ExamParseError as exc:
-            error_message = str(exc)
-            if 'nhiều đáp án đúng' in error_message.lower():
-                try:
-                    parsed_questions = parse_docx_exam(temp_path, allow_multiple_answers=True)
-                except ExamParseError as re_exc:
-                    flash(f'Lỗi khi đọc file đề: {re_exc}', 'danger')
-                    os.remove(temp_path)
-                    return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-                except Exception as re_exc:
-                    flash(f'Lỗi không xác định khi xử lý file: {re_exc}', 'danger')
-                    os.remove(temp_path)
-                    return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-            else:
-                flash(f'Lỗi khi đọc file đề: {exc}', 'danger')
-                os.remove(temp_path)
-                return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-        except Exception as exc:
-            flash(f'Lỗi không xác định khi xử lý file: {exc}', 'danger')
-            os.remove(temp_path)
-            return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-        finally:
-            try:
-                os.remove(temp_path)
-            except OSError:
-                pass
-
-        if not parsed_questions:
-            flash('Không tìm thấy câu hỏi trắc nghiệm nào trong file.', 'danger')
-            return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-        questions_with_multiple = [
-            item.get('number')
-            for item in parsed_questions
-            if len(normalize_correct_answers(item.get('correct_answer'))) > 1
-        ]
-
-        if questions_with_multiple and not allow_multiple:
-            question_list = ', '.join(str(num) for num in questions_with_multiple[:5])
-            more_suffix = '...' if len(questions_with_multiple) > 5 else ''
-            flash(
-                f'Đề thi có các câu {question_list}{more_suffix} được đánh dấu nhiều đáp án đúng. '
-                'Vui lòng bật tùy chọn "Cho phép nhiều đáp án đúng" trước khi import.',
-                'warning'
-            )
-            form_data['allow_multiple'] = 'on'
-            return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-        questions = []
-        has_tl2_question = False
-        for idx, item in enumerate(parsed_questions, start=1):
-            options = item.get('options', {})
-            correct_answer = item.get('correct_answer')
-            question_type = item.get('type', 'tl1')
-
-            if not options or len(options) < 2:
-                flash(f'Câu {item.get("number", idx)} không có đủ lựa chọn.', 'danger')
-                return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-            if question_type == 'tl2':
-                has_tl2_question = True
-                if len(options) != 4:
-                    flash(f'Câu {item.get("number", idx)} (TL2) cần đúng 4 ý để đánh giá Đúng/Sai.', 'danger')
-                    return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-            option_keys = {key.upper(): key for key in options.keys()}
-            correct_tokens = normalize_correct_answers(correct_answer)
-            if not correct_tokens:
-                flash(f'Không xác định được đáp án đúng cho câu {item.get("number", idx)}.', 'danger')
-                return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-            invalid_tokens = [token for token in correct_tokens if token not in option_keys]
-            if invalid_tokens:
-                flash(
-                    f'Đáp án {", ".join(invalid_tokens)} của câu {item.get("number", idx)} không trùng với lựa chọn A/B/C/D.',
-                    'danger'
-                )
-                return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
-
-            def convert_token(token):
-                # Map back to original key casing (A vs a) if needed
-                return option_keys.get(token, token)
-
-            if question_type == 'tl2':
-                normalized_correct = [convert_token(token) for token in sorted(correct_tokens)]
-            else:
-                if len(correct_tokens) > 1:
-                    normalized_correct = [convert_token(token) for token in sorted(correct_tokens)]
-                    if len(normalized_correct) == 1:
-                        normalized_correct = normalized_correct[0]
-                else:
-                    normalized_correct = convert_token(next(iter(correct_tokens)))
-
-            questions.append({
-                'id': item.get('number', idx),
-                'number': item.get('number', idx),
-                'question': item.get('question', '').strip(),
-                'options': options,
-                'correct_answer': normalized_correct,
-                'explanation': item.get('explanation', '').strip(),
-                'type': question_type
-            })
-
-        exam_id = f"exam_{grade}_{uuid.uuid4().hex[:6]}"
-        exam_record = {
-            'id': exam_id,
+        exam_meta = {
+            'grade': grade,
             'title': title,
             'description': description,
             'time_limit': time_limit,
-            'questions': questions,
-            'allow_multiple_answers': bool(questions_with_multiple or has_tl2_question),
-            'created_by': session.get('user_id'),
-            'created_by_name': session.get('username'),
-            'created_at': datetime.now().isoformat()
+            'allow_multiple': allow_multiple,
+            'created_by_name': session.get('username')
         }
 
+        # Job được tạo trước để tham chiếu tới file upload (dùng chung theo nội dung) có ngay khi file được lưu
+        job_id = create_import_job(exam_meta, session.get('user_id'), kind='batch' if is_batch else None)
         try:
-            db.add_exam(grade, exam_record)
+            store_upload(job_id, exam_file, EXAM_UPLOAD_FOLDER, extension='zip' if is_batch else 'docx', primary=True)
+            if is_batch:
+                enqueue_batch_import_job(job_id, db)
+            else:
+                enqueue_import_job(job_id)
         except Exception as exc:
-            flash(f'Không thể lưu đề thi: {exc}', 'danger')
+            abandon_import_job(job_id, f'Không thể tạo tác vụ import: {exc}')
+            flash(f'Không thể tạo tác vụ import: {exc}', 'danger')
             return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
 
-        flash(f'Đã tạo đề thi "{title}" với {len(questions)} câu hỏi cho khối {grade}.', 'success')
-        return redirect(url_for('tracnghiem'))
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'success': True, 'job_id': job_id}), 202
+
+        return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES,
+                               grade_labels=GRADE_LABELS, job_id=job_id)
 
     return render_template('import_exam.html', form_data=form_data, grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS)
 
 
+@app.route('/teacher/import_exam/status/<job_id>')
+@teacher_required
+def import_exam_status(job_id):
+    job = get_import_job(job_id)
+    if not job or job.get('created_by') != session.get('user_id'):
+        return jsonify({'success': False, 'message': 'Không tìm thấy tác vụ import'}), 404
+
+    return jsonify({
+        'success': True,
+        'job': {
+            'id': job['id'],
+            'status': job['status'],
+            'progress': job['progress'],
+            'message': job.get('message'),
+            'exam_id': job.get('exam_id'),
+            **job.get('result', {})
+        }
+    })
+
+
 @app.route('/chatbot')
 @login_required
 def chatbot():
-    return render_template('chatbot.html', username=session.get('username'))
+    conversation_state = load_conversation(session['user_id'])
+    return render_template('chatbot.html',
+                           username=session.get('username'),
+                           conversation_turns=conversation_state['turns'])
 
 
 @app.route('/api/chat', methods=['POST'])
@@ -683,7 +675,7 @@ def chat():
         if not message:
             return jsonify({'success': False, 'response': 'Vui lòng nhập tin nhắn'})
         
-        response = chat_with_gemini(message)
+        response = answer_with_context(session['user_id'], message)
         
         return jsonify({'success': True, 'response': response})
     
@@ -691,6 +683,36 @@ def chat():
         return jsonify({'success': False, 'response': f'Xin lỗi, có lỗi xảy ra: {str(e)}'})
 
 
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    data = request.get_json(silent=True) or {}
+    message = data.get('message', '').strip()
+
+    if not message:
+        return jsonify({'success': False, 'response': 'Vui lòng nhập tin nhắn'})
+
+    user_id = session['user_id']
+
+    def generate():
+        for chunk in stream_answer_with_context(user_id, message):
+            yield f"data: {json.dumps({'text': chunk}, ensure_ascii=False)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/api/chat/reset', methods=['POST'])
+@login_required
+def chat_reset():
+    clear_conversation(session['user_id'])
+    return jsonify({'success': True, 'message': 'Đã bắt đầu cuộc trò chuyện mới'})
+
+
 @app.route('/update_progress', methods=['POST'])
 @login_required
 def update_progress():
@@ -726,7 +748,7 @@ def students_progress():
     progress_with_details = []
     for prog in filtered_progress:
         student = get_user_by_id(prog['user_id'])
-        course = db.get_course_by_id(prog['course_id'])
+        course = db.get_course_summary(prog['course_id'])
         
         if student and course:
             total_lessons = len(course.get('lessons', []))
@@ -753,22 +775,10 @@ def teacher_exams():
     exams_by_grade = {}
 
     for grade in AVAILABLE_GRADES:
-        bank = db.load_exam_bank(grade)
         grade_exams = []
 
-        for exam in bank.get('exams', []):
-            exam_copy = {
-                'id': exam.get('id'),
-                'title': exam.get('title', 'Không có tiêu đề'),
-                'description': exam.get('description', ''),
-                'time_limit': exam.get('time_limit', 15),
-                'question_count': len(exam.get('questions', [])),
-                'created_at': exam.get('created_at'),
-                'allow_multiple_answers': exam.get('allow_multiple_answers', False),
-                'created_by': exam.get('created_by'),
-                'created_by_name': exam.get('created_by_name', 'Không rõ'),
-                'grade': grade,
-            }
+        for summary in db.get_exam_summaries(grade):
+            exam_copy = dict(summary)
             exam_copy['is_owner'] = exam_copy['created_by'] == teacher_id or exam_copy['created_by'] is None
             grade_exams.append(exam_copy)
 
@@ -780,6 +790,209 @@ def teacher_exams():
                            grade_order=AVAILABLE_GRADES,
                            username=session.get('username'))
 
+@app.route('/teacher/exams/<grade>/<exam_id>/stats')
+@login_required
+@teacher_required
+def teacher_exam_stats(grade, exam_id):
+    """Thống kê từng câu của một đề: độ khó, độ phân biệt, phân bố lựa chọn."""
+    if grade not in AVAILABLE_GRADES:
+        flash('Lớp không hợp lệ', 'danger')
+        return redirect(url_for('teacher_exams'))
+
+    exam = db.get_exam(grade, exam_id)
+    if not exam:
+        flash('Không tìm thấy đề thi', 'danger')
+        return redirect(url_for('teacher_exams'))
+
+    if exam.get('blueprint'):
+        # Mỗi lượt làm có bộ câu và thứ tự riêng nên không thống kê theo vị trí câu được
+        flash('Đề ngẫu nhiên theo ma trận chưa có thống kê theo câu, xem thống kê ở các đề nguồn.', 'info')
+        return redirect(url_for('teacher_exams'))
+
+    return render_template('teacher_exam_stats.html',
+                           exam=exam,
+                           grade=grade,
+                           grade_labels=GRADE_LABELS,
+                           analysis=exam_analytics.analyze(grade, exam),
+                           can_edit=exam.get('created_by') in (None, session.get('user_id')),
+                           username=session.get('username'))
+
+@app.route('/teacher/exams/random', methods=['GET', 'POST'])
+@login_required
+@teacher_required
+def create_random_exam():
+    """Tạo đề ngẫu nhiên: mỗi lượt làm rút câu từ các đề nguồn theo ma trận chủ đề/độ khó."""
+    grade = (request.form.get('grade') or request.args.get('grade') or DEFAULT_GRADE).strip()
+    if grade not in AVAILABLE_GRADES:
+        grade = DEFAULT_GRADE
+    pool = db.get_question_pool(grade)
+    source_choices = [
+        dict(summary, topics=pool.topics([summary['id']]))
+        for summary in db.get_exam_summaries(grade) if summary['id'] in pool.topics_by_exam
+    ]
+    form_data = {
+        'title': request.form.get('title', '').strip(),
+        'description': request.form.get('description', '').strip(),
+        'time_limit': request.form.get('time_limit', '').strip() or '15',
+        'per_topic': request.form.get('per_topic', '').strip() or '10',
+        'source_exams': request.form.getlist('source_exams'),
+        'mix': {difficulty: request.form.get(f'mix_{difficulty}', '').strip() or '1' for difficulty in DIFFICULTIES},
+        'shuffle_options': request.method == 'GET' or bool(request.form.get('shuffle_options'))
+    }
+
+    def render_form():
+        return render_template('random_exam.html', form_data=form_data, grade=grade,
+                               grade_choices=AVAILABLE_GRADES, grade_labels=GRADE_LABELS,
+                               source_choices=source_choices, difficulties=DIFFICULTIES,
+                               difficulty_labels=DIFFICULTY_LABELS, username=session.get('username'))
+
+    if request.method == 'GET':
+        return render_form()
+
+    errors = []
+    if not form_data['title']:
+        errors.append('Vui lòng nhập tên đề thi.')
+    try:
+        time_limit = int(form_data['time_limit'])
+        per_topic = int(form_data['per_topic'])
+        mix = {difficulty: int(value) for difficulty, value in form_data['mix'].items()}
+        if time_limit <= 0 or per_topic <= 0 or min(mix.values()) < 0:
+            raise ValueError
+    except ValueError:
+        errors.append('Thời gian, số câu mỗi chủ đề và tỉ lệ độ khó phải là số nguyên dương.')
+        time_limit, per_topic, mix = 15, 0, {}
+
+    source_exams = [exam_id for exam_id in form_data['source_exams'] if exam_id in pool.topics_by_exam]
+    blueprint = None
+    if not errors:
+        try:
+            blueprint = build_blueprint(source_exams, pool.topics(source_exams), per_topic, mix,
+                                        form_data['shuffle_options'])
+        except BlueprintError as exc:
+            errors.append(str(exc))
+    if blueprint:
+        for section in blueprint['sections']:
+            available = sum(len(pool.candidates(source_exams, section['topic'], difficulty)) for difficulty in DIFFICULTIES)
+            if available < per_topic:
+                errors.append(f'Chủ đề "{section["topic"]}" chỉ có {available} câu, ít hơn {per_topic} câu mỗi chủ đề.')
+
+    if errors:
+        for message in errors:
+            flash(message, 'danger')
+        return render_form()
+
+    exam_record = {
+        'id': f"exam_{grade}_{uuid.uuid4().hex[:6]}",
+        'title': form_data['title'],
+        'description': form_data['description'],
+        'time_limit': time_limit,
+        'questions': [],
+        'blueprint': blueprint,
+        'allow_multiple_answers': any(
+            choice.get('allow_multiple_answers') for choice in source_choices if choice['id'] in source_exams
+        ),
+        'created_by': session.get('user_id'),
+        'created_by_name': session.get('username'),
+        'created_at': datetime.now().isoformat()
+    }
+    db.add_exam(grade, exam_record)
+    flash(f'Đã tạo đề ngẫu nhiên "{exam_record["title"]}" gồm {len(blueprint["sections"]) * per_topic} câu mỗi lượt làm.', 'success')
+    return redirect(url_for('teacher_exams'))
+
+@app.route('/teacher/question-duplicates')
+@login_required
+@teacher_required
+def question_duplicates():
+    """Báo cáo các nhóm câu hỏi gần trùng trong toàn bộ ngân hàng đề."""
+    groups = db.get_question_index().duplicate_groups()
+    return render_template('question_duplicates.html',
+                           groups=groups[:DUPLICATE_REPORT_LIMIT],
+                           total_groups=len(groups),
+                           total_questions=sum(group['size'] for group in groups),
+                           grade_labels=GRADE_LABELS,
+                           username=session.get('username'))
+
+@app.route('/teacher/exams/<grade>/<exam_id>/answer-key', methods=['POST'])
+@login_required
+@teacher_required
+def update_exam_answer_key(grade, exam_id):
+    """
+    Sửa đáp án đúng của các câu một lựa chọn rồi chấm lại mọi bài đã nộp ở nền.
+    Body: {"answers": {"<số thứ tự câu>": "B" hoặc ["A", "C"]}}
+    """
+    if grade not in AVAILABLE_GRADES:
+        return jsonify({'success': False, 'message': 'Lớp không hợp lệ'}), 400
+
+    exam = db.get_exam(grade, exam_id)
+    if not exam:
+        return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
+
+    owner_id = exam.get('created_by')
+    if owner_id and owner_id != session.get('user_id'):
+        return jsonify({'success': False, 'message': 'Bạn chỉ có thể sửa đáp án đề thi do mình tạo'}), 403
+
+    data = request.get_json(silent=True) or {}
+    answers = data.get('answers')
+    if not isinstance(answers, dict) or not answers:
+        return jsonify({'success': False, 'message': 'Chưa có đáp án nào cần sửa'}), 400
+
+    questions_by_number = {str(question.get('number')): question for question in exam.get('questions', [])}
+    changes = {}
+    for number, value in answers.items():
+        question = questions_by_number.get(str(number))
+        if question is None:
+            return jsonify({'success': False, 'message': f'Không tìm thấy câu {number}'}), 400
+        if question.get('type') == 'tl2':
+            # Bài nộp chỉ lưu số ý sai của câu đúng/sai nên không chấm lại được
+            return jsonify({'success': False, 'message': f'Câu {number} là câu đúng/sai, chưa hỗ trợ sửa đáp án'}), 400
+
+        option_token_map = {normalize_answer_token(key): key for key in (question.get('options') or {})}
+        tokens = normalize_correct_answers(value)
+        if not tokens or not tokens <= option_token_map.keys():
+            return jsonify({'success': False, 'message': f'Đáp án câu {number} không khớp với các lựa chọn'}), 400
+        if len(tokens) > 1 and not exam.get('allow_multiple_answers'):
+            return jsonify({'success': False, 'message': f'Đề không cho phép nhiều đáp án đúng (câu {number})'}), 400
+        if tokens == normalize_correct_answers(question.get('correct_answer')):
+            continue
+        keys = [option_token_map[token] for token in sorted(tokens)]
+        changes[str(number)] = keys if len(keys) > 1 else keys[0]
+
+    if not changes:
+        return jsonify({'success': True, 'message': 'Đáp án không thay đổi', 'job_id': None})
+
+    updated_exam = db.update_answer_key(grade, exam_id, changes)
+    if updated_exam is None:
+        return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
+
+    job_id = enqueue_regrade_job(db, leaderboards, grade, updated_exam, sorted(changes, key=str),
+                                 session.get('user_id'), on_finished=exam_analytics.invalidate)
+    logger.info('Answer key updated: exam=%s questions=%s job=%s', exam_id, ','.join(changes), job_id)
+    return jsonify({
+        'success': True,
+        'message': f'Đã sửa đáp án {len(changes)} câu, đang chấm lại các bài đã nộp.',
+        'job_id': job_id
+    }), 202
+
+@app.route('/teacher/exams/regrade/<job_id>')
+@login_required
+@teacher_required
+def regrade_status(job_id):
+    job = get_import_job(job_id)
+    if not job or job.get('created_by') != session.get('user_id'):
+        return jsonify({'success': False, 'message': 'Không tìm thấy tác vụ chấm lại'}), 404
+
+    return jsonify({
+        'success': True,
+        'job': {
+            'id': job['id'],
+            'status': job['status'],
+            'progress': job['progress'],
+            'message': job.get('message'),
+            'exam_id': job.get('exam_id'),
+            **job.get('result', {})
+        }
+    })
+
 @app.route('/teacher/delete_exam', methods=['POST'])
 @login_required
 @teacher_required
@@ -792,8 +1005,7 @@ def delete_exam():
         if grade not in AVAILABLE_GRADES or not exam_id:
             return jsonify({'success': False, 'message': 'Thiếu thông tin đề thi'}), 400
 
-        bank = db.load_exam_bank(grade)
-        exam = next((e for e in bank.get('exams', []) if e.get('id') == exam_id), None)
+        exam = db.get_exam_summary(grade, exam_id)
 
         if not exam:
             return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
@@ -832,7 +1044,7 @@ def view_submissions():
     submissions_with_details = []
     for sub in filtered_submissions:
         student = get_user_by_id(sub['user_id'])
-        course = db.get_course_by_id(sub.get('course_id'))
+        course = db.get_course_summary(sub.get('course_id'))
         
         if student and course:
             submissions_with_details.append({
@@ -860,6 +1072,17 @@ def not_found(error):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    message = error.description if isinstance(error, attachment_store.AttachmentTooLarge) else (
+        f'Dung lượng tải lên vượt quá giới hạn ({app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)}MB)'
+    )
+    if request.endpoint in FORUM_ATTACHMENT_ENDPOINTS or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'success': False, 'message': message}), 413
+    flash(message, 'danger')
+    return redirect(request.referrer or url_for('index'))
+
+
 @app.errorhandler(500)
 def internal_error(error):
     return render_template('500.html'), 500
@@ -868,6 +1091,28 @@ def internal_error(error):
 
 ########################
 ###############33
+def attempt_seed_key(grade, exam_id):
+    return f'exam_seed_{grade}_{exam_id}'
+
+def generate_attempt_exam(grade, exam, renew=False):
+    """
+    Đề ngẫu nhiên theo ma trận: dựng đề của lượt làm hiện tại từ seed lưu trong session.
+    renew=True (bắt đầu lượt mới) thì tạo seed mới. Không lưu bản đề riêng của từng học sinh.
+    """
+    pool = db.get_question_pool(grade)
+    pool_signature = pool.signature(exam['blueprint'])
+    key = attempt_seed_key(grade, exam['id'])
+    attempt = session.get(key)
+    if renew or not isinstance(attempt, dict):
+        attempt = {'seed': new_seed(), 'pool': pool_signature}
+        session[key] = attempt
+        session.modified = True
+    elif attempt.get('pool') != pool_signature:
+        session.pop(key, None)
+        session.modified = True
+        raise BlueprintError('Ngân hàng câu hỏi của đề đã thay đổi trong lúc làm bài, vui lòng làm lại.')
+    return generate_exam(exam, pool, attempt['seed'])
+
 @app.route('/tracnghiem/lam-bai/<grade>/<exam_id>')
 @login_required
 def lam_bai_tracnghiem(grade, exam_id):
@@ -884,6 +1129,7 @@ def lam_bai_tracnghiem(grade, exam_id):
     try:
         with open(json_file, 'r', encoding='utf-8') as f:
             exams_data = json.load(f)
+            metrics.record_json_read(json_file, metrics.file_size(f))
             exams = exams_data.get('exams', [])
             
             exam = next((e for e in exams if e['id'] == exam_id), None)
@@ -896,7 +1142,7 @@ def lam_bai_tracnghiem(grade, exam_id):
             
             if not isinstance(time_limit, (int, float)) or time_limit <= 0:
                 time_limit = 15
-                print(f"Warning: Invalid time_limit in exam {exam_id}, using default 15 minutes")
+                logger.warning('Invalid time_limit in exam %s, using default 15 minutes', exam_id)
             
             session_key = f'exam_start_{grade}_{exam_id}'
             reset_param = request.args.get('reset', 'no')
@@ -911,11 +1157,11 @@ def lam_bai_tracnghiem(grade, exam_id):
             
             if reset_param == 'yes':
                 should_create_new_session = True
-                print(f"Reset session for exam {exam_id}")
+                logger.debug('Reset session for exam %s', exam_id)
             
             elif session_key not in session:
                 should_create_new_session = True
-                print(f"New session for exam {exam_id}")
+                logger.debug('New session for exam %s', exam_id)
             else:
                 try:
                     start_time_str = session.get(session_key)
@@ -928,10 +1174,10 @@ def lam_bai_tracnghiem(grade, exam_id):
                     elapsed_seconds = (current_time - start_time).total_seconds()
                     
                     if elapsed_seconds < 0:
-                        print(f"ERROR: Negative elapsed time for exam {exam_id}")
+                        logger.warning('Negative elapsed time for exam %s', exam_id)
                         should_create_new_session = True
                     elif elapsed_seconds > (time_limit * 60 * 2):
-                        print(f"WARNING: Session too old for exam {exam_id}")
+                        logger.info('Session too old for exam %s', exam_id)
                         should_create_new_session = True
                     else:
                         remaining_time = (time_limit * 60) - elapsed_seconds
@@ -944,10 +1190,10 @@ def lam_bai_tracnghiem(grade, exam_id):
                             session.modified = True
                             return redirect(url_for('tracnghiem'))
                         
-                        print(f"Exam {exam_id}: {int(remaining_time)}s remaining")
+                        logger.debug('Exam %s: %ds remaining', exam_id, remaining_time)
                 
                 except (ValueError, KeyError, TypeError, AttributeError) as e:
-                    print(f"Session error for exam {exam_id}: {e}")
+                    logger.info('Session error for exam %s: %s', exam_id, e)
                     should_create_new_session = True
             
             if should_create_new_session:
@@ -956,22 +1202,24 @@ def lam_bai_tracnghiem(grade, exam_id):
                 session.permanent = True
                 session.modified = True
                 remaining_time = time_limit * 60
-                print(f"Created new session for exam {exam_id}, expires in {time_limit} minutes")
+                logger.debug('Created new session for exam %s, expires in %s minutes', exam_id, time_limit)
             
 
             remaining_time = max(1, min(remaining_time, time_limit * 60))
             remaining_time = int(remaining_time)  # Convert to integer
+
+            if exam.get('blueprint'):
+                try:
+                    exam = generate_attempt_exam(grade, exam, renew=should_create_new_session)
+                except BlueprintError as exc:
+                    flash(str(exc), 'warning')
+                    return redirect(url_for('lam_bai_tracnghiem', grade=grade, exam_id=exam_id, reset='yes'))
+                if not exam['questions']:
+                    flash('Ngân hàng câu hỏi chưa có câu nào phù hợp với ma trận đề', 'danger')
+                    return redirect(url_for('tracnghiem'))
             
-            # . LOG (cho debug)
-            print(f"""
-            ===== EXAM SESSION INFO =====
-            Exam: {exam_id} | Grade: {grade}
-            Time Limit: {time_limit} minutes
-            Remaining: {remaining_time} seconds ({remaining_time//60}m {remaining_time%60}s)
-            Session Key: {session_key}
-            Session Permanent: {session.permanent}
-            ============================
-            """)
+            logger.debug('Exam session: exam=%s grade=%s time_limit=%smin remaining=%ds key=%s permanent=%s',
+                         exam_id, grade, time_limit, remaining_time, session_key, session.permanent)
             
 
             for question in exam.get('questions', []):
@@ -995,14 +1243,12 @@ def lam_bai_tracnghiem(grade, exam_id):
     
     except json.JSONDecodeError as e:
         flash(' Dữ liệu đề thi bị lỗi định dạng', 'danger')
-        print(f"JSON decode error: {e}")
+        logger.error('JSON decode error in %s: %s', json_file, e)
         return redirect(url_for('tracnghiem'))
     
     except Exception as e:
         flash(f' Lỗi không xác định: {str(e)}', 'danger')
-        print(f"Unexpected error in lam_bai_tracnghiem: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Unexpected error in lam_bai_tracnghiem')
         return redirect(url_for('tracnghiem'))
 
 
@@ -1028,6 +1274,7 @@ def api_check_exam_time(grade, exam_id):
         json_file = f'data/lop{grade}.json'
         with open(json_file, 'r', encoding='utf-8') as f:
             exams_data = json.load(f)
+            metrics.record_json_read(json_file, metrics.file_size(f))
             exams = exams_data.get('exams', [])
             exam = next((e for e in exams if e['id'] == exam_id), None)
             
@@ -1067,7 +1314,7 @@ def api_check_exam_time(grade, exam_id):
         })
     
     except (ValueError, KeyError, TypeError) as e:
-        print(f"Error in api_check_exam_time: {e}")
+        logger.info('Error in api_check_exam_time: %s', e)
         return jsonify({
             'success': False,
             'message': f'Lỗi session: {str(e)}',
@@ -1076,7 +1323,7 @@ def api_check_exam_time(grade, exam_id):
         })
     
     except Exception as e:
-        print(f"Unexpected error in api_check_exam_time: {e}")
+        logger.exception('Unexpected error in api_check_exam_time')
         return jsonify({
             'success': False,
             'message': f'Lỗi: {str(e)}',
@@ -1092,50 +1339,33 @@ def tracnghiem():
     """
     Trang chọn đề thi trắc nghiệm
     """
-    print("========= DEBUG TRACNGHIEM =========")
-    print(f"User ID: {session.get('user_id')}")
-    print(f"Role: {session.get('role')}")
-    print(f"Username: {session.get('username')}")
-    print("====================================")
-    
-    try:
-        exams_by_grade = {grade: [] for grade in AVAILABLE_GRADES}
+    logger.debug('tracnghiem: user_id=%s role=%s username=%s',
+                 session.get('user_id'), session.get('role'), session.get('username'))
+
+    def load_exams():
+        # Chỉ đọc bản tóm tắt (không kèm câu hỏi) của từng khối, và chỉ khi ngân hàng đề thay đổi
+        exams_by_grade = db.get_all_exam_summaries(AVAILABLE_GRADES)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('tracnghiem: %s', ', '.join(
+                f'{grade}={len(exams_by_grade[grade])}' for grade in AVAILABLE_GRADES
+            ))
+
+        return {
+            'exams_by_grade': exams_by_grade,
+            'grade_labels': GRADE_LABELS,
+            'grade_order': AVAILABLE_GRADES
+        }
 
-        # Đọc đề thi từ tất cả các khối
-        for grade in AVAILABLE_GRADES:
-            json_file = f'data/lop{grade}.json'
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    exams_data = json.load(f)
-                    exams = exams_data.get('exams', [])
-
-                    for exam in exams:
-                        exam['grade'] = grade
-                    exams_by_grade[grade].extend(exams)
-                    print(f"✓ Loaded {len(exams)} exams from grade {grade}")
-
-            except FileNotFoundError:
-                print(f"✗ File {json_file} không tồn tại")
-                continue
-            except json.JSONDecodeError:
-                print(f"✗ File {json_file} bị lỗi định dạng")
-                continue
-
-        total_exams = sum(len(exams) for exams in exams_by_grade.values())
-        print(f"Total exams: {total_exams}")
-        for grade in AVAILABLE_GRADES:
-            print(f"Grade {grade}: {len(exams_by_grade[grade])}")
-
-        return render_template('tracnghiem.html',
-                             exams_by_grade=exams_by_grade,
-                             grade_labels=GRADE_LABELS,
-                             grade_order=AVAILABLE_GRADES,
-                             username=session.get('username'))
+    try:
+        return render_cached_page(
+            'tracnghiem.html', 'partials/tracnghiem_exams.html', 'exams_html',
+            ['exams'], load_exams,
+            username=session.get('username')
+        )
     
     except Exception as e:
-        print(f"ERROR in tracnghiem route: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Error in tracnghiem route')
         flash(f'Lỗi khi tải danh sách đề thi: {str(e)}', 'danger')
         return redirect(url_for('student_dashboard'))
 
@@ -1181,6 +1411,7 @@ def nop_bai_tracnghiem():
         json_file = f'data/lop{grade}.json'
         with open(json_file, 'r', encoding='utf-8') as f:
             exams_data = json.load(f)
+            metrics.record_json_read(json_file, metrics.file_size(f))
             exams = exams_data.get('exams', [])
             exam = next((e for e in exams if e['id'] == exam_id), None)
             
@@ -1199,6 +1430,7 @@ def nop_bai_tracnghiem():
                 if elapsed_seconds > (time_limit * 60):
                     # Nộp muộn - không chấp nhận
                     session.pop(session_key, None)
+                    session.pop(attempt_seed_key(grade, exam_id), None)
                     session.modified = True
                     
                     return jsonify({
@@ -1211,6 +1443,21 @@ def nop_bai_tracnghiem():
                     'success': False,
                     'message': 'Session không hợp lệ'
                 }), 403
+
+            if exam.get('blueprint'):
+                # Đề ngẫu nhiên: dựng lại đúng đề của lượt làm từ seed trong session rồi mới chấm
+                if attempt_seed_key(grade, exam_id) not in session:
+                    return jsonify({
+                        'success': False,
+                        'message': 'Session không hợp lệ'
+                    }), 403
+                try:
+                    exam = generate_attempt_exam(grade, exam)
+                except BlueprintError as exc:
+                    return jsonify({
+                        'success': False,
+                        'message': str(exc)
+                    }), 409
             questions = exam.get('questions', [])
             total_questions = len(questions)
             total_points = 0.0
@@ -1317,6 +1564,7 @@ def nop_bai_tracnghiem():
 
 
             session.pop(session_key, None)
+            session.pop(attempt_seed_key(grade, exam_id), None)
             session.modified = True
             
             # Lưu kết quả
@@ -1331,29 +1579,19 @@ def nop_bai_tracnghiem():
                 'total_questions': total_questions,
                 'total_points': round(total_points, 2),
                 'question_breakdown': question_breakdown,
-                'submitted_at': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
                 'time_spent_seconds': int(elapsed_seconds)  # 
             }
+            if exam.get('seed') is not None:
+                result_data['seed'] = exam['seed']
             
             try:
-                results_file = 'data/exam_results.json'
-                os.makedirs('data', exist_ok=True)
-                
-                try:
-                    with open(results_file, 'r', encoding='utf-8') as f:
-                        all_results = json.load(f)
-                except FileNotFoundError:
-                    all_results = []
-                
-                all_results.append(result_data)
-                
-                with open(results_file, 'w', encoding='utf-8') as f:
-                    json.dump(all_results, f, ensure_ascii=False, indent=2)
-                
-                print(f"✅ Saved result: User {session['user_id']}, Score: {score}")
+                saved_result = db.add_exam_result(result_data)
+                exam_analytics.record_result(saved_result)
+                leaderboards.refresh()
+                logger.info('Saved result: user=%s exam=%s score=%s', session['user_id'], exam_id, score)
             
-            except Exception as e:
-                print(f"❌ Error saving result: {e}")
+            except Exception:
+                logger.exception('Error saving result')
             
             return jsonify({
                 'success': True,
@@ -1378,9 +1616,7 @@ def nop_bai_tracnghiem():
         }), 500
     
     except Exception as e:
-        print(f"ERROR in nop_bai_tracnghiem: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Error in nop_bai_tracnghiem')
         return jsonify({
             'success': False,
             'message': f'Lỗi server: {str(e)}'
@@ -1394,35 +1630,43 @@ def lich_su_tracnghiem():
     """
     try:
         user_id = session.get('user_id')
-        results_file = 'data/exam_results.json'
+        # Chỉ lấy các bài của học sinh này, đã theo thứ tự mới nhất trước
+        user_results = db.get_user_exam_results(user_id)
         
-        try:
-            with open(results_file, 'r', encoding='utf-8') as f:
-                all_results = json.load(f)
-        except FileNotFoundError:
-            all_results = []
-        except json.JSONDecodeError:
-            print("ERROR: exam_results.json bị lỗi định dạng")
-            all_results = []
-        
-
-        user_results = [r for r in all_results if r.get('user_id') == user_id]
-        user_results.sort(key=lambda x: x.get('submitted_at', ''), reverse=True)
-        
-        print(f"User {user_id} có {len(user_results)} bài đã làm")
+        logger.debug('User %s có %d bài đã làm', user_id, len(user_results))
         
         return render_template('lichsu_tracnghiem.html', 
                              results=user_results,
                              username=session.get('username'))
     
     except Exception as e:
-        print(f"ERROR in lich_su_tracnghiem: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Error in lich_su_tracnghiem')
         flash(f'Lỗi khi tải lịch sử: {str(e)}', 'danger')
         return redirect(url_for('tracnghiem'))
 
 
+@app.route('/tracnghiem/bang-xep-hang/<grade>/<exam_id>')
+@login_required
+def bang_xep_hang(grade, exam_id):
+    """Bảng xếp hạng (lần làm tốt nhất của mỗi học sinh) và phân bố điểm của một đề."""
+    exam = db.get_exam_summary(grade, exam_id) if grade in AVAILABLE_GRADES else None
+    if not exam:
+        flash('Đề thi không tồn tại', 'danger')
+        return redirect(url_for('tracnghiem'))
+
+    board = leaderboards.get(grade, exam_id)
+    return render_template('bang_xep_hang.html',
+                           exam=exam,
+                           grade=grade,
+                           grade_labels=GRADE_LABELS,
+                           top=board.top(LEADERBOARD_SIZE),
+                           my_rank=board.rank_of(session.get('user_id')),
+                           histogram=board.histogram(),
+                           attempts=board.attempts,
+                           students=len(board.best),
+                           username=session.get('username'))
+
+
 @app.route('/tracnghiem/reset/<grade>/<exam_id>')
 @login_required
 
@@ -1448,37 +1692,18 @@ def ket_qua_tracnghiem(grade, exam_id):
     """
     try:
         user_id = session.get('user_id')
+        result = db.get_latest_exam_result(user_id, grade, exam_id)
         
-
-        results_file = 'data/exam_results.json'
-        
-        try:
-            with open(results_file, 'r', encoding='utf-8') as f:
-                all_results = json.load(f)
-        except FileNotFoundError:
-            flash('Không tìm thấy kết quả bài làm', 'warning')
-            return redirect(url_for('tracnghiem'))
-        
-
-        matching_results = [
-            r for r in all_results 
-            if r.get('user_id') == user_id 
-            and r.get('grade') == grade 
-            and r.get('exam_id') == exam_id
-        ]
-        
-        if not matching_results:
+        if not result:
             flash('Không tìm thấy kết quả bài làm', 'warning')
             return redirect(url_for('tracnghiem'))
         
-        result = matching_results[-1]
-        
         return render_template('ketqua.html', 
                              result=result,
                              username=session.get('username'))
     
     except Exception as e:
-        print(f"ERROR in ket_qua_tracnghiem: {str(e)}")
+        logger.exception('Error in ket_qua_tracnghiem')
         flash(f'Lỗi khi hiển thị kết quả: {str(e)}', 'danger')
         return redirect(url_for('tracnghiem'))
         ####################
@@ -1488,47 +1713,45 @@ def ket_qua_tracnghiem(grade, exam_id):
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx', 'txt', 'zip', 'rar'}
 MAX_FILE_SIZE = 10 * 1024 * 1024
+FORUM_ATTACHMENT_ENDPOINTS = ('forum_create_post', 'forum_edit_post', 'forum_add_comment')
+
+attachment_store.init_app(app, FORUM_ATTACHMENT_ENDPOINTS, FORUM_UPLOAD_FOLDER, MAX_FILE_SIZE)
+# File upload không còn được phục vụ qua /static; đính kèm diễn đàn đi qua forum_attachment
+file_delivery.init_app(app, [FORUM_UPLOAD_FOLDER, EXAM_UPLOAD_FOLDER])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_forum_attachments():
+    """Lưu các file đính kèm của request hiện tại vào kho theo nội dung (file trùng chỉ lưu một lần)."""
+    return attachment_store.save_attachments(
+        request.files.getlist('files'), FORUM_UPLOAD_FOLDER, MAX_FILE_SIZE, allowed_file
+    )
+
 def allowed_exam_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXAM_EXTENSIONS
 
+def is_exam_archive(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXAM_ARCHIVE_EXTENSIONS
+
 def ensure_directory(path):
     os.makedirs(path, exist_ok=True)
 
-def normalize_answer_token(value):
-    if value is None:
-        return ''
-    token = str(value).strip()
-    if not token:
-        return ''
-    token = token.split('.')[0]
-    return token.strip().upper()
-
-def normalize_correct_answers(value):
-    if isinstance(value, list):
-        tokens = {normalize_answer_token(v) for v in value}
-        return {t for t in tokens if t}
-    token = normalize_answer_token(value)
-    return {token} if token else set()
-
-def format_correct_answer(value):
-    if isinstance(value, list):
-        return ', '.join(str(v).strip() for v in value if str(v).strip())
-    return str(value).strip()
-
-def calculate_tl2_score(mistakes_count):
-    if mistakes_count <= 0:
-        return 1.0
-    if mistakes_count == 1:
-        return 0.5
-    if mistakes_count == 2:
-        return 0.25
-    if mistakes_count == 3:
-        return 0.1
-    return 0.0
+@app.route('/forum/files/<name>')
+@login_required
+def forum_attachment(name):
+    """Tải file đính kèm diễn đàn: chỉ người đã đăng nhập, và chỉ file còn thuộc một bài viết/bình luận."""
+    path = os.path.join(FORUM_UPLOAD_FOLDER, name).replace('\\', '/')
+    attachment = db.get_forum_attachment(path)
+    if not attachment:
+        abort(404)
+    is_original = attachment['path'] == path
+    return file_delivery.send_stored_file(
+        path,
+        download_name=attachment.get('filename') if is_original else None,
+        as_attachment=is_original and request.args.get('download') == '1',
+        etag=attachment.get('sha256') if is_original else None
+    )
 
 @app.route('/forum')
 @login_required
@@ -1601,29 +1824,7 @@ def forum_create_post():
             
             tags = [tag.strip() for tag in tags_str.split(',') if tag.strip()] if tags_str else []
             
-            attachments = []
-            if 'files' in request.files:
-                files = request.files.getlist('files')
-                for file in files:
-                    if file and file.filename and allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        unique_filename = f"{uuid.uuid4().hex[:8]}_{filename}"
-                        
-                        os.makedirs(FORUM_UPLOAD_FOLDER, exist_ok=True)
-                        file_path = os.path.join(FORUM_UPLOAD_FOLDER, unique_filename)
-                        file.save(file_path)
-                        
-                        file_size = os.path.getsize(file_path)
-                        
-                        file_ext = filename.rsplit('.', 1)[1].lower()
-                        file_type = 'image' if file_ext in {'png', 'jpg', 'jpeg', 'gif'} else 'file'
-                        
-                        attachments.append({
-                            'type': file_type,
-                            'filename': filename,
-                            'path': file_path.replace('\\', '/'),
-                            'size': file_size
-                        })
+            attachments = save_forum_attachments()
             
             user = get_user_by_id(session['user_id'])
             
@@ -1638,6 +1839,7 @@ def forum_create_post():
             }
             
             post_id = db.create_forum_post(post_data)
+            image_variants.schedule_variants(attachments, db.set_attachment_variants)
             
             return jsonify({'success': True, 'post_id': post_id, 'message': 'Tạo bài viết thành công'})
         
@@ -1671,29 +1873,7 @@ def forum_edit_post(post_id):
             
             tags = [tag.strip() for tag in tags_str.split(',') if tag.strip()] if tags_str else []
             
-            attachments = post.get('attachments', [])
-            
-            if 'files' in request.files:
-                files = request.files.getlist('files')
-                for file in files:
-                    if file and file.filename and allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        unique_filename = f"{uuid.uuid4().hex[:8]}_{filename}"
-                        
-                        os.makedirs(FORUM_UPLOAD_FOLDER, exist_ok=True)
-                        file_path = os.path.join(FORUM_UPLOAD_FOLDER, unique_filename)
-                        file.save(file_path)
-                        
-                        file_size = os.path.getsize(file_path)
-                        file_ext = filename.rsplit('.', 1)[1].lower()
-                        file_type = 'image' if file_ext in {'png', 'jpg', 'jpeg', 'gif'} else 'file'
-                        
-                        attachments.append({
-                            'type': file_type,
-                            'filename': filename,
-                            'path': file_path.replace('\\', '/'),
-                            'size': file_size
-                        })
+            attachments = post.get('attachments', []) + save_forum_attachments()
             
             post_data = {
                 'title': title,
@@ -1705,6 +1885,7 @@ def forum_edit_post(post_id):
             success = db.update_forum_post(post_id, post_data)
             
             if success:
+                image_variants.schedule_variants(attachments, db.set_attachment_variants)
                 return jsonify({'success': True, 'message': 'Cập nhật bài viết thành công'})
             else:
                 return jsonify({'success': False, 'message': 'Cập nhật thất bại'})
@@ -1729,14 +1910,13 @@ def forum_delete_post(post_id):
     if post['author_id'] != session['user_id']:
         return jsonify({'success': False, 'message': 'Bạn không có quyền xóa bài viết này'})
     
-    for attachment in post.get('attachments', []):
-        try:
-            if os.path.exists(attachment['path']):
-                os.remove(attachment['path'])
-        except:
-            pass
+    released = list(post.get('attachments', []))
+    for comment in db.get_comments_by_post(post_id):
+        released.extend(comment.get('attachments', []))
     
     db.delete_forum_post(post_id)
+    # File có thể đang được bài viết/bình luận khác dùng chung (cùng nội dung) nên chỉ xóa khi không còn ai tham chiếu
+    attachment_store.release_attachments(released, db.is_attachment_referenced)
     
     return jsonify({'success': True, 'message': 'Xóa bài viết thành công'})
 
@@ -1756,28 +1936,7 @@ def forum_add_comment(post_id):
         if not content:
             return jsonify({'success': False, 'message': 'Vui lòng nhập nội dung bình luận'})
         
-        attachments = []
-        if 'files' in request.files:
-            files = request.files.getlist('files')
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4().hex[:8]}_{filename}"
-                    
-                    os.makedirs(FORUM_UPLOAD_FOLDER, exist_ok=True)
-                    file_path = os.path.join(FORUM_UPLOAD_FOLDER, unique_filename)
-                    file.save(file_path)
-                    
-                    file_size = os.path.getsize(file_path)
-                    file_ext = filename.rsplit('.', 1)[1].lower()
-                    file_type = 'image' if file_ext in {'png', 'jpg', 'jpeg', 'gif'} else 'file'
-                    
-                    attachments.append({
-                        'type': file_type,
-                        'filename': filename,
-                        'path': file_path.replace('\\', '/'),
-                        'size': file_size
-                    })
+        attachments = save_forum_attachments()
         
         user = get_user_by_id(session['user_id'])
         
@@ -1792,6 +1951,7 @@ def forum_add_comment(post_id):
         }
         
         comment_id = db.add_comment(comment_data)
+        image_variants.schedule_variants(attachments, db.set_attachment_variants)
         
         return jsonify({'success': True, 'comment_id': comment_id, 'message': 'Thêm bình luận thành công'})
     
@@ -1811,14 +1971,8 @@ def forum_delete_comment(comment_id):
     if comment['author_id'] != session['user_id']:
         return jsonify({'success': False, 'message': 'Bạn không có quyền xóa bình luận này'})
     
-    for attachment in comment.get('attachments', []):
-        try:
-            if os.path.exists(attachment['path']):
-                os.remove(attachment['path'])
-        except:
-            pass
-    
     db.delete_comment(comment_id)
+    attachment_store.release_attachments(comment.get('attachments', []), db.is_attachment_referenced)
     
     return jsonify({'success': True, 'message': 'Xóa bình luận thành công'})
 
@@ -1919,48 +2073,70 @@ def delete_chat_message(message_id):
 @app.route('/lop10')
 @login_required
 def lop10():
-    return render_template('lop10.html', username=session.get('username'))
+    return static_assets.render_page('lop10.html')
 
 
 @app.route('/lop11')
 @login_required
 def lop11():
-    return render_template('lop11.html', username=session.get('username'))
+    return static_assets.render_page('lop11.html')
 
 
 @app.route('/lop12')
 @login_required
 def lop12():
-    return render_template('lop12.html', username=session.get('username'))
+    return static_assets.render_page('lop12.html')
 
 
 @app.route('/onthi')
 @login_required
 def onthi():
-    return render_template('onthi/onthi_main.html', username=session.get('username'))
+    return static_assets.render_page('onthi/onthi_main.html')
 
 
 @app.route('/onthi/de-tham-khao')
 @login_required
 def onthi_de_tham_khao():
-    return render_template('onthi/de_tham_khao.html', username=session.get('username'))
+    return static_assets.render_page('onthi/de_tham_khao.html')
 
 
 @app.route('/onthi/tai-lieu-on-luyen')
 @login_required
 def onthi_tai_lieu():
-    return render_template('onthi/tai_lieu_on_luyen.html', username=session.get('username'))
+    return static_assets.render_page('onthi/tai_lieu_on_luyen.html')
 
 
 @app.route('/onthi/de-chinh-thuc')
 @login_required
 def onthi_de_chinh_thuc():
-    return render_template('onthi/de_chinh_thuc.html', username=session.get('username'))
+    return static_assets.render_page('onthi/de_chinh_thuc.html')
 ################
 @app.route('/xinchao')
 @login_required
 def xinchao():
     return render_template('menu.html', username=session.get('username'))
+
+
+@app.cli.command('build-static')
+def build_static_command():
+    """Tạo bản static có mã băm + nén sẵn và render sẵn các trang tĩnh."""
+    files = static_assets.build(PRERENDERED_PAGES)
+    print(f'Đã build {len(files)} file tĩnh và {len(PRERENDERED_PAGES)} trang render sẵn')
+
+@app.cli.command('migrate-courses')
+def migrate_courses_command():
+    """Tách bài học đang nhúng trong courses.json ra file riêng từng bài (data/lessons/)."""
+    print(f'Đã tách {db.migrate_courses()} bài học')
+
+@app.cli.command('rebuild-leaderboards')
+def rebuild_leaderboards_command():
+    """Tính lại bảng xếp hạng và phân bố điểm của mọi đề từ log kết quả."""
+    total = leaderboards.rebuild()
+    boards = leaderboards.boards()
+    print(f'Đã duyệt {total} bài nộp của {len(boards)} đề')
+    for (grade, exam_id), board in sorted(boards.items()):
+        leaders = ', '.join(f"{entry['username'] or entry['user_id']} ({entry['score']})" for entry in board.top(3))
+        print(f'  {grade}/{exam_id}: {board.attempts} lượt, {len(board.best)} học sinh; dẫn đầu: {leaders}')
 #########################3
 if __name__ == '__main__':
     ensure_directory('data')
@@ -0,0 +1,250 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict
+
+from utils import metrics
+
+# Số lời gọi AI chạy đồng thời tối đa; phải nhỏ hơn số thread của gunicorn
+# để luôn còn chỗ cho các route khác (nộp bài thi, ...)
+AI_MAX_IN_FLIGHT = int(os.getenv('AI_MAX_IN_FLIGHT', '4'))
+# Số request tối đa được đứng chờ kết quả của một lời gọi giống hệt đang chạy (xem gemini_api.RequestCoalescer);
+# cùng với AI_MAX_IN_FLIGHT, đây là trần số thread worker có thể bị giữ bởi độ trễ của AI
+AI_MAX_FOLLOWERS = int(os.getenv('AI_MAX_FOLLOWERS', str(AI_MAX_IN_FLIGHT)))
+# Thời gian chờ một chỗ trống (giây); 0 = báo bận ngay
+AI_QUEUE_WAIT = float(os.getenv('AI_QUEUE_WAIT', '0'))
+# Hạn chót cho một lời gọi (và khoảng lặng tối đa giữa 2 chunk khi stream)
+AI_CALL_TIMEOUT = float(os.getenv('AI_CALL_TIMEOUT', '20'))
+AI_STREAM_TIMEOUT = float(os.getenv('AI_STREAM_TIMEOUT', '60'))
+AI_BREAKER_THRESHOLD = int(os.getenv('AI_BREAKER_THRESHOLD', '5'))
+AI_BREAKER_COOLDOWN = float(os.getenv('AI_BREAKER_COOLDOWN', '30'))
+# Mỗi user được hỏi tối đa AI_RATE_LIMIT lần trong AI_RATE_WINDOW giây
+AI_RATE_LIMIT = int(os.getenv('AI_RATE_LIMIT', '10'))
+AI_RATE_WINDOW = float(os.getenv('AI_RATE_WINDOW', '60'))
+
+
+class AIGatewayError(Exception):
+    """Lỗi do gateway chủ động từ chối/cắt lời gọi; nội dung là thông báo hiển thị cho người dùng."""
+
+
+class AIBusyError(AIGatewayError):
+    def __init__(self):
+        super().__init__('Xin lỗi, dịch vụ AI đang quá tải. Vui lòng thử lại sau giây lát.')
+
+
+class AITimeoutError(AIGatewayError):
+    def __init__(self):
+        super().__init__('Xin lỗi, dịch vụ AI phản hồi quá chậm. Vui lòng thử lại sau.')
+
+
+class AICircuitOpenError(AIGatewayError):
+    def __init__(self):
+        super().__init__('Xin lỗi, dịch vụ AI đang tạm thời gián đoạn. Vui lòng thử lại sau ít phút.')
+
+
+class AIRateLimitedError(AIGatewayError):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(f'Bạn đang gửi quá nhiều câu hỏi. Vui lòng đợi {retry_after} giây rồi thử lại.')
+
+
+class CircuitBreaker:
+    """
+    Sau `threshold` lỗi liên tiếp thì mở mạch: mọi lời gọi bị từ chối ngay trong `cooldown` giây.
+    Hết thời gian đó cho đúng một lời gọi thử (half-open); thành công thì đóng mạch lại.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """Giới hạn theo cửa sổ trượt cho từng user."""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._hits: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def check(self, key) -> None:
+        if self.limit <= 0 or key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.setdefault(str(key), deque())
+            while hits and now - hits[0] >= self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                raise AIRateLimitedError(int(self.window - (now - hits[0])) + 1)
+            hits.append(now)
+
+
+class AIGateway:
+    """
+    Mọi lời gọi tới dịch vụ AI đi qua đây. Lời gọi chạy trên thread pool riêng
+    nên request chỉ chờ tối đa `call_timeout` giây, không bao giờ bị treo theo API.
+    """
+
+    def __init__(self, max_in_flight=AI_MAX_IN_FLIGHT, queue_wait=AI_QUEUE_WAIT,
+                 call_timeout=AI_CALL_TIMEOUT, stream_timeout=AI_STREAM_TIMEOUT,
+                 breaker=None, rate_limiter=None, max_followers=AI_MAX_FOLLOWERS):
+        self.max_in_flight = max_in_flight
+        self.max_followers = max_followers
+        self.queue_wait = queue_wait
+        self.call_timeout = call_timeout
+        self.stream_timeout = stream_timeout
+        self.breaker = breaker or CircuitBreaker(AI_BREAKER_THRESHOLD, AI_BREAKER_COOLDOWN)
+        self.rate_limiter = rate_limiter or RateLimiter(AI_RATE_LIMIT, AI_RATE_WINDOW)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._followers = threading.BoundedSemaphore(max_followers) if max_followers > 0 else None
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='ai-gateway')
+
+    def check_rate_limit(self, user_id) -> None:
+        self.rate_limiter.check(user_id)
+
+    def _admit(self) -> None:
+        if self.queue_wait > 0:
+            acquired = self._slots.acquire(timeout=self.queue_wait)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            raise AIBusyError()
+        # Hỏi circuit breaker sau khi đã có chỗ, để lời gọi thử (half-open) chắc chắn được chạy
+        if not self.breaker.allow():
+            self._slots.release()
+            raise AICircuitOpenError()
+
+    def wait_for(self, event: threading.Event) -> None:
+        """
+        Chờ một lời gọi đang chạy ở request khác (event được set khi nó xong), tối đa call_timeout giây.
+        Số request đứng chờ như vậy bị giới hạn bởi max_followers; vượt quá thì báo bận ngay.
+        """
+        if self._followers is None or not self._followers.acquire(blocking=False):
+            raise AIBusyError()
+        try:
+            if not event.wait(self.call_timeout):
+                raise AITimeoutError()
+        finally:
+            self._followers.release()
+
+    def _submit(self, fn):
+        # Chỗ trống chỉ được trả khi lời gọi thật sự kết thúc (kể cả sau khi đã quá hạn),
+        # nên số thread đang chờ API không bao giờ vượt max_in_flight
+        try:
+            future = self._executor.submit(fn)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """Chạy fn(*args, **kwargs) với hạn chót call_timeout; lỗi quá hạn/bận/mạch mở là AIGatewayError."""
+        with metrics.track('ai.call'):
+            self._admit()
+            future = self._submit(lambda: fn(*args, **kwargs))
+            try:
+                result = future.result(timeout=self.call_timeout)
+            except FutureTimeoutError:
+                self.breaker.record_failure()
+                raise AITimeoutError()
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def stream(self, factory):
+        """
+        Như call() cho API trả về iterator: factory() chạy trên thread pool, các chunk được chuyển qua hàng đợi.
+        Mỗi chunk phải tới trong call_timeout giây và cả luồng xong trong stream_timeout giây.
+        """
+        with metrics.track('ai.stream'):
+            yield from self._stream(factory)
+
+    def _stream(self, factory):
+        self._admit()
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for item in factory():
+                    if cancelled.is_set():
+                        return
+                    chunks.put(('item', item))
+                chunks.put(('end', None))
+            except Exception as e:
+                chunks.put(('error', e))
+
+        self._submit(produce)
+        deadline = time.monotonic() + self.stream_timeout
+        try:
+            while True:
+                wait = min(self.call_timeout, deadline - time.monotonic())
+                try:
+                    if wait <= 0:
+                        raise queue.Empty
+                    kind, value = chunks.get(timeout=wait)
+                except queue.Empty:
+                    self.breaker.record_failure()
+                    raise AITimeoutError()
+                if kind == 'item':
+                    yield value
+                elif kind == 'error':
+                    self.breaker.record_failure()
+                    raise value
+                else:
+                    self.breaker.record_success()
+                    return
+        finally:
+            # Người dùng ngắt kết nối hoặc quá hạn: báo thread sản xuất dừng sớm
+            cancelled.set()
+
+    def status(self) -> Dict:
+        return {
+            'circuit': self.breaker.state,
+            'failures': self.breaker.failures,
+            'max_in_flight': self.max_in_flight,
+            'max_followers': self.max_followers
+        }
+
+
+gateway = AIGateway()
+metrics.registry.register(metrics.Gauge(
+    'app_ai_circuit_open', 'Circuit breaker của dịch vụ AI đang mở (1) hay đóng (0)',
+    lambda: 0 if gateway.breaker.state == CircuitBreaker.CLOSED else 1
+))
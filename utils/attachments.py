@@ -0,0 +1,159 @@
+import hashlib
+import os
+import uuid
+from typing import Callable, Dict, Iterable, List
+
+from flask import Request, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+
+from utils.exam_cache import UPLOAD_CHUNK_SIZE
+from utils.image_variants import read_dimensions
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+class AttachmentTooLarge(RequestEntityTooLarge):
+    def __init__(self, filename: str, max_size: int):
+        self.filename = filename
+        self.max_size = max_size
+        super().__init__(f'File "{filename}" vượt quá dung lượng cho phép ({max_size // (1024 * 1024)}MB)')
+
+
+class HashingUploadFile:
+    """
+    File tạm nhận dữ liệu upload trực tiếp từ parser multipart: vừa ghi xuống đĩa vừa tính SHA-256.
+    Vượt max_size thì xóa file và dừng ngay, không đọc tiếp phần còn lại của file đó.
+    Chưa finalize() mà đã đóng (request kết thúc) thì file tạm cũng bị xóa.
+    """
+
+    def __init__(self, folder: str, max_size: int, filename: str = ''):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_size = max_size
+        self.filename = filename
+        self.path = os.path.join(folder, f'.upload_{uuid.uuid4().hex}')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._file = open(self.path, 'w+b')
+        self._finalized = False
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.discard()
+            raise AttachmentTooLarge(self.filename, self.max_size)
+        self.digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read/seek/tell/flush... của file bên dưới (FileStorage cần các hàm này)
+        return getattr(self._file, name)
+
+    def discard(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        if not self._finalized:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        self.discard()
+
+    def finalize(self, extension: str):
+        """Chuyển file tạm vào kho theo nội dung (<sha256>.<ext>); file trùng nội dung chỉ giữ một bản."""
+        self._file.close()
+        sha256 = self.digest.hexdigest()
+        final_path = os.path.join(self.folder, f'{sha256}.{extension}' if extension else sha256)
+        if os.path.exists(final_path):
+            os.remove(self.path)
+        else:
+            os.replace(self.path, final_path)
+        self._finalized = True
+        return final_path, sha256
+
+
+class AttachmentRequest(Request):
+    """Request mà file upload của các endpoint đính kèm được ghi thẳng vào kho, không qua file tạm chung."""
+    upload_targets: Dict[str, tuple] = {}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        target = self.upload_targets.get(self.endpoint)
+        if target is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        folder, max_size = target
+        if max_size and content_length and content_length > max_size:
+            raise AttachmentTooLarge(filename or '', max_size)
+        return HashingUploadFile(folder, max_size, filename or '')
+
+
+def init_app(app, endpoints: Iterable[str], folder: str, max_size: int) -> None:
+    app.request_class = AttachmentRequest
+    AttachmentRequest.upload_targets.update({endpoint: (folder, max_size) for endpoint in endpoints})
+
+    @app.before_request
+    def parse_attachment_uploads():
+        # Đọc form ngay tại đây để lỗi quá dung lượng (413) tới errorhandler,
+        # không bị khối try/except chung trong view nuốt mất
+        if request.method == 'POST' and request.endpoint in AttachmentRequest.upload_targets:
+            request.files
+
+
+def save_attachment(file_storage, folder: str, max_size: int) -> Dict:
+    filename = secure_filename(file_storage.filename)
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    upload = file_storage.stream
+    if not isinstance(upload, HashingUploadFile):
+        # Upload không đi qua AttachmentRequest: chép từng khối sang kho
+        upload = HashingUploadFile(folder, max_size, filename)
+        try:
+            while True:
+                chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload.write(chunk)
+        except Exception:
+            upload.discard()
+            raise
+    size = upload.size
+    file_path, sha256 = upload.finalize(extension)
+    attachment = {
+        'type': 'image' if extension in IMAGE_EXTENSIONS else 'file',
+        'filename': filename,
+        'path': file_path.replace('\\', '/'),
+        'size': size,
+        'sha256': sha256
+    }
+    if attachment['type'] == 'image':
+        attachment.update(read_dimensions(file_path) or {})
+    return attachment
+
+
+def save_attachments(files, folder: str, max_size: int, allowed: Callable[[str], bool]) -> List[Dict]:
+    """Lưu các file hợp lệ trong danh sách upload; file có đuôi không cho phép bị bỏ qua như trước."""
+    return [
+        save_attachment(file, folder, max_size)
+        for file in files
+        if file and file.filename and allowed(file.filename)
+    ]
+
+
+def release_attachments(attachments: Iterable[Dict], is_referenced: Callable[[str], bool]) -> int:
+    """Xóa file của các đính kèm không còn bài viết/bình luận nào dùng (file được dùng chung khi trùng nội dung)."""
+    removed = 0
+    by_path = {attachment['path']: attachment for attachment in attachments if attachment.get('path')}
+    for path, attachment in by_path.items():
+        if is_referenced(path):
+            continue
+        # Xóa cả các bản thu nhỏ / bản cho web sinh ra từ file này
+        for file_path in (path, attachment.get('thumbnail'), attachment.get('web')):
+            if not file_path:
+                continue
+            try:
+                os.remove(file_path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
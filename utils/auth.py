@@ -3,19 +3,27 @@ import json
 import os
 from datetime import datetime
 
+from utils import metrics
+from utils.fragment_cache import fragment_cache
+
 USERS_FILE = 'data/users.json'
+fragment_cache.register('users', USERS_FILE)
 
 def load_users():
     """Load users từ file JSON"""
     if not os.path.exists(USERS_FILE):
         return []
     with open(USERS_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        users = json.load(f)
+        metrics.record_json_read(USERS_FILE, metrics.file_size(f))
+        return users
 
 def save_users(users):
     """Lưu users vào file JSON"""
     with open(USERS_FILE, 'w', encoding='utf-8') as f:
         json.dump(users, f, ensure_ascii=False, indent=2)
+        metrics.record_json_write(USERS_FILE, metrics.file_size(f))
+    fragment_cache.invalidate_path(USERS_FILE)
 
 def register_user(username, password, email, role='student'):
     """
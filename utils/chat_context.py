@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List
+
+from utils import gemini_api
+from utils.ai_gateway import AIGatewayError, gateway
+
+CONVERSATIONS_FOLDER = os.getenv('AI_CONVERSATIONS_FOLDER', 'data/ai_conversations')
+# Ngân sách token (ước lượng) cho phần lịch sử gửi kèm mỗi lượt hỏi
+CONTEXT_TOKEN_BUDGET = int(os.getenv('AI_CONTEXT_TOKEN_BUDGET', '2000'))
+SUMMARY_MAX_CHARS = 1200
+TURN_SUMMARY_CHARS = 160
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng thô: ~4 ký tự một token."""
+    return len(text or '') // 4 + 1
+
+
+def _user_lock(user_id) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(str(user_id), threading.Lock())
+
+
+def _conversation_file(user_id) -> str:
+    safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', str(user_id))
+    return os.path.join(CONVERSATIONS_FOLDER, f'{safe_id}.json')
+
+
+def load_conversation(user_id) -> Dict:
+    try:
+        with open(_conversation_file(user_id), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError):
+        state = {}
+    state.setdefault('summary', '')
+    state.setdefault('turns', [])
+    return state
+
+
+def save_conversation(user_id, state: Dict) -> None:
+    os.makedirs(CONVERSATIONS_FOLDER, exist_ok=True)
+    filename = _conversation_file(user_id)
+    state['updated_at'] = datetime.now().isoformat()
+    temp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_filename, filename)
+
+
+def clear_conversation(user_id) -> None:
+    try:
+        os.remove(_conversation_file(user_id))
+    except OSError:
+        pass
+
+
+@contextmanager
+def conversation(user_id):
+    """Khóa + đọc hội thoại của user, lưu lại khi khối lệnh kết thúc không lỗi."""
+    with _user_lock(user_id):
+        state = load_conversation(user_id)
+        yield state
+        save_conversation(user_id, state)
+
+
+def _summarize_turn(turn: Dict) -> str:
+    speaker = 'Học sinh' if turn.get('role') == 'user' else 'Trợ lý'
+    content = ' '.join((turn.get('content') or '').split())
+    if len(content) > TURN_SUMMARY_CHARS:
+        content = content[:TURN_SUMMARY_CHARS].rsplit(' ', 1)[0] + '...'
+    return f'{speaker}: {content}'
+
+
+def trim_to_budget(state: Dict, budget: int = CONTEXT_TOKEN_BUDGET) -> Dict:
+    """
+    Gộp các lượt cũ nhất vào phần tóm tắt cho tới khi lịch sử nằm trong ngân sách token.
+    Tóm tắt được làm cục bộ (rút gọn từng lượt) nên không tốn thêm lần gọi API nào.
+    """
+    turns = state['turns']
+    # Tóm tắt chiếm tối đa ~1/3 ngân sách (4 ký tự ~ 1 token)
+    summary_limit = min(SUMMARY_MAX_CHARS, budget * 4 // 3)
+
+    def total_tokens():
+        return estimate_tokens(state['summary']) + sum(estimate_tokens(t['content']) for t in turns)
+
+    # Luôn giữ nguyên văn cặp hỏi-đáp gần nhất
+    while len(turns) > 2 and total_tokens() > budget:
+        # Bỏ theo từng cặp hỏi-đáp để lịch sử vẫn bắt đầu bằng lượt của học sinh
+        oldest = [turns.pop(0)]
+        if turns and turns[0].get('role') == 'assistant':
+            oldest.append(turns.pop(0))
+        lines = [state['summary']] if state['summary'] else []
+        lines.extend(_summarize_turn(turn) for turn in oldest)
+        summary = '\n'.join(lines)
+        if len(summary) > summary_limit:
+            summary = summary[-summary_limit:].split('\n', 1)[-1]
+        state['summary'] = summary
+    return state
+
+
+def history_for_model(state: Dict) -> List[Dict]:
+    history = []
+    if state.get('summary'):
+        history.append({'role': 'user', 'content': f"Tóm tắt phần trò chuyện trước:\n{state['summary']}"})
+        history.append({'role': 'assistant', 'content': 'Đã nắm được nội dung trước đó.'})
+    history.extend(state.get('turns', []))
+    return history
+
+
+def _record_turn(state: Dict, user_message: str, reply: str) -> None:
+    state['turns'].append({'role': 'user', 'content': user_message})
+    state['turns'].append({'role': 'assistant', 'content': reply})
+    trim_to_budget(state)
+
+
+def answer_with_context(user_id, user_message: str) -> str:
+    """
+    Trả lời theo ngữ cảnh hội thoại đã lưu của user: đúng một lần gọi API mỗi lượt.
+    Lượt đầu tiên (chưa có lịch sử) dùng đường có cache của chat_with_gemini.
+    """
+    if not gemini_api.is_configured():
+        return gemini_api.NOT_CONFIGURED_MESSAGE
+    try:
+        gateway.check_rate_limit(user_id)
+    except AIGatewayError as e:
+        return str(e)
+
+    # Như bản stream: không giữ khóa hội thoại trong lúc chờ API, để các tin nhắn gửi dồn của
+    # cùng một user không xếp hàng chiếm thread worker; chỉ khóa khi ghi lượt mới
+    state = load_conversation(user_id)
+    try:
+        if state['turns'] or state['summary']:
+            response = gemini_api.send_with_context(user_message, history_for_model(state))
+            reply = gemini_api.remove_markdown_formatting(response.text)
+        else:
+            reply = gemini_api.answer(user_message)
+    except AIGatewayError as e:
+        return str(e)
+    except Exception as e:
+        return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
+
+    with conversation(user_id) as latest:
+        _record_turn(latest, user_message, reply)
+    return reply
+
+
+def stream_answer_with_context(user_id, user_message: str):
+    """Như answer_with_context nhưng trả về từng đoạn văn bản khi API sinh ra."""
+    if not gemini_api.is_configured():
+        yield gemini_api.NOT_CONFIGURED_MESSAGE
+        return
+    try:
+        gateway.check_rate_limit(user_id)
+    except AIGatewayError as e:
+        yield str(e)
+        return
+
+    state = load_conversation(user_id)
+    parts = []
+    try:
+        if state['turns'] or state['summary']:
+            chunks = gemini_api.send_with_context(user_message, history_for_model(state), stream=True)
+            texts = gemini_api.iter_clean_text(chunks)
+        else:
+            texts = gemini_api.stream_answer(user_message)
+        for text in texts:
+            parts.append(text)
+            yield text
+    except AIGatewayError as e:
+        yield str(e)
+        return
+    except Exception as e:
+        yield f"Xin lỗi, có lỗi xảy ra: {str(e)}"
+        return
+
+    # Không giữ khóa trong lúc stream; chỉ khóa khi ghi lượt mới
+    with conversation(user_id) as latest:
+        _record_turn(latest, user_message, ''.join(parts))
@@ -1,12 +1,51 @@
+import hashlib
 import json
 import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from bisect import insort
 from datetime import datetime
+from functools import wraps
+
+from utils import metrics
+from utils.exam_blueprint import QuestionPool, blueprint_question_count
+from utils.exam_cache import questions_fingerprint
+from utils.fragment_cache import fragment_cache
+from utils.grading import compile_answer_key, encode_breakdown
+from utils.question_index import QuestionIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có khóa file, migrate_courses vẫn cho cùng kết quả ở mọi process
+    fcntl = None
 
 SUPPORTED_GRADES = ['10', '11', '12', 'TN-THPT']
+RESULT_TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+# Id khóa học/bài học được dùng làm tên thư mục/file nên chỉ nhận dạng slug
+_SLUG_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Trường của khóa học mà update_course nhận từ form sửa khóa học
+COURSE_EDITABLE_FIELDS = ('title', 'description', 'lessons')
+
+
+def _synchronized(lock_name):
+    """Chạy method trong khóa `lock_name` của Database, để các lần đọc-sửa-ghi cùng một file JSON không ghi đè lên nhau."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with getattr(self, lock_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 
 class Database:
     def __init__(self):
         self.courses_file = 'data/courses.json'
+        # Nội dung từng bài học: data/lessons/<course_id>/<lesson_id>.json
+        self.lessons_dir = 'data/lessons'
         self.exercises_file = 'data/exercises.json'
         self.progress_file = 'data/progress.json'
         self.documents_file = 'data/documents.json'
@@ -14,7 +53,18 @@ class Database:
         self.forum_posts_file = 'data/forum_posts.json'
         self.forum_comments_file = 'data/forum_comments.json'
         self.chat_messages_file = 'data/chat_messages.json'
+        self.exam_results_file = 'data/exam_results.json'
+        # Chỉ mục dựng từ file JSON, giữ trong bộ nhớ: tên -> (file nguồn, tem file, giá trị)
+        self._indexes = {}
+        # Mọi hàm ghi forum_posts.json/forum_comments.json (kể cả từ thread tạo ảnh thu nhỏ) dùng chung khóa này
+        self._forum_lock = threading.RLock()
+        # Nộp bài, chấm lại và xóa kết quả cùng ghi exam_results.json
+        self._results_lock = threading.RLock()
         self._init_files()
+        # Các trang danh sách được cache theo những file này (xem utils/fragment_cache.py)
+        fragment_cache.register('courses', self.courses_file)
+        fragment_cache.register('documents', self.documents_file)
+        fragment_cache.register('exams', *self._get_exam_files())
     
     def _init_files(self):
         files = [
@@ -25,7 +75,8 @@ class Database:
             self.submissions_file,
             self.forum_posts_file,
             self.forum_comments_file,
-            self.chat_messages_file
+            self.chat_messages_file,
+            self.exam_results_file
         ]
         for file in files:
             if not os.path.exists(file):
@@ -35,18 +86,117 @@ class Database:
     def _load_json(self, filename):
         try:
             with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
+                metrics.record_json_read(filename, metrics.file_size(f))
+                return data
         except (json.JSONDecodeError, FileNotFoundError):
             return []
     
-    def _save_json(self, filename, data):
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def _save_json(self, filename, data, compact=False):
+        # Ghi ra file tạm rồi thay thế để tiến trình khác không đọc phải file ghi dở
+        temp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            if compact:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            else:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            metrics.record_json_write(filename, metrics.file_size(f))
+        os.replace(temp_filename, filename)
+        fragment_cache.invalidate_path(filename)
+        # mtime có thể chưa kịp đổi giữa hai lần ghi liên tiếp, nên bỏ chỉ mục ngay tại đây
+        for name in [name for name, (sources, _, _) in self._indexes.items() if filename in sources]:
+            self._indexes.pop(name, None)
     
     def _get_exam_file(self, grade):
         grade_str = str(grade)
         return f'data/lop{grade_str}.json'
 
+    def _get_exam_files(self):
+        return tuple(self._get_exam_file(grade) for grade in SUPPORTED_GRADES)
+
+    def _get_exam_summary_file(self, grade):
+        return f'data/lop{str(grade)}_summary.json'
+
+    @staticmethod
+    def _file_stamp(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _get_index(self, name, sources, build):
+        """Chỉ mục `name` dựng bằng build(); dựng lại khi một trong các file nguồn đổi (kể cả do process khác ghi)."""
+        stamp = [self._file_stamp(filename) for filename in sources]
+        cached = self._indexes.get(name)
+        if cached is not None and cached[1] == stamp:
+            return cached[2]
+        value = build()
+        self._indexes[name] = (tuple(sources), stamp, value)
+        return value
+
+    def _peek_index(self, name, sources):
+        """Chỉ mục `name` nếu đã dựng và còn khớp với file nguồn; không tự dựng."""
+        cached = self._indexes.get(name)
+        if cached is not None and cached[1] == [self._file_stamp(filename) for filename in sources]:
+            return cached[2]
+        return None
+
+    def _set_index(self, name, sources, value):
+        # Dùng sau khi chính process này vừa ghi file nguồn và đã tự cập nhật chỉ mục
+        self._indexes[name] = (tuple(sources), [self._file_stamp(filename) for filename in sources], value)
+
+    @staticmethod
+    def _summarize_exam(exam, grade):
+        return {
+            'id': exam.get('id'),
+            'title': exam.get('title', 'Không có tiêu đề'),
+            'description': exam.get('description', ''),
+            'time_limit': exam.get('time_limit', 15),
+            'question_count': blueprint_question_count(exam['blueprint']) if exam.get('blueprint') else len(exam.get('questions', [])),
+            'is_random': bool(exam.get('blueprint')),
+            'allow_multiple_answers': exam.get('allow_multiple_answers', False),
+            'created_by': exam.get('created_by'),
+            'created_by_name': exam.get('created_by_name', 'Không rõ'),
+            'created_at': exam.get('created_at'),
+            'grade': str(grade)
+        }
+
+    def _save_exam_summaries(self, grade, exams):
+        # Ghi kèm tem của file ngân hàng để nhận ra khi file bị sửa ngoài Database
+        summaries = [self._summarize_exam(exam, grade) for exam in exams if isinstance(exam, dict)]
+        self._save_json(self._get_exam_summary_file(grade), {
+            'bank_stamp': self._file_stamp(self._get_exam_file(grade)),
+            'exams': summaries
+        })
+        return summaries
+
+    def get_exam_summaries(self, grade):
+        """Danh sách đề của một khối (không kèm nội dung câu hỏi), đọc từ file tóm tắt."""
+        bank_stamp = self._file_stamp(self._get_exam_file(grade))
+        if bank_stamp is None:
+            return []
+        try:
+            summary_file = self._get_exam_summary_file(grade)
+            with open(summary_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                metrics.record_json_read(summary_file, metrics.file_size(f))
+        except (json.JSONDecodeError, FileNotFoundError):
+            data = {}
+        if isinstance(data, dict) and data.get('bank_stamp') == bank_stamp and 'exams' in data:
+            return data['exams']
+        return self._save_exam_summaries(grade, self.load_exam_bank(grade).get('exams', []))
+
+    def get_all_exam_summaries(self, grades=None):
+        return {str(grade): self.get_exam_summaries(grade) for grade in (grades or SUPPORTED_GRADES)}
+
+    def get_exam_summary(self, grade, exam_id):
+        return next((exam for exam in self.get_exam_summaries(grade) if exam.get('id') == exam_id), None)
+
+    def get_exam(self, grade, exam_id):
+        """Đề thi đầy đủ (kèm câu hỏi)."""
+        return next((exam for exam in self.load_exam_bank(grade).get('exams', []) if exam.get('id') == exam_id), None)
+
     def load_exam_bank(self, grade):
         filename = self._get_exam_file(grade)
         if not os.path.exists(filename):
@@ -54,6 +204,7 @@ class Database:
         try:
             with open(filename, 'r', encoding='utf-8') as f:
                 data = json.load(f)
+                metrics.record_json_read(filename, metrics.file_size(f))
                 if isinstance(data, dict):
                     data.setdefault('exams', [])
                     exams = data.get('exams', [])
@@ -89,13 +240,43 @@ class Database:
         elif 'exams' not in data:
             data['exams'] = []
         self._save_json(filename, data)
+        self._save_exam_summaries(grade, data['exams'])
 
     def add_exam(self, grade, exam_data):
+        return self.add_exams(grade, [exam_data])[0]
+
+    def add_exams(self, grade, exam_records):
+        """Thêm nhiều đề vào ngân hàng với một lần đọc/ghi file."""
+        if not exam_records:
+            return []
+        bank_files = self._get_exam_files()
+        question_index = self._peek_index('questions', bank_files)
         exams_data = self.load_exam_bank(grade)
-        exams = exams_data.setdefault('exams', [])
-        exams.append(exam_data)
+        exams_data.setdefault('exams', []).extend(exam_records)
         self.save_exam_bank(grade, exams_data)
-        return exam_data.get('id')
+        if question_index is not None:
+            # Chỉ mục câu hỏi đã dựng thì thêm đề mới vào luôn thay vì dựng lại cả ngân hàng
+            for exam in exam_records:
+                question_index.add_exam(grade, exam)
+            self._set_index('questions', bank_files, question_index)
+        return [exam.get('id') for exam in exam_records]
+
+    def get_question_pool(self, grade):
+        """Câu hỏi của một khối chia theo đề nguồn, chủ đề, độ khó (dùng cho đề ngẫu nhiên theo ma trận)."""
+        filename = self._get_exam_file(grade)
+        return self._get_index(f'question_pool:{grade}', (filename,),
+                               lambda: QuestionPool(self.load_exam_bank(grade).get('exams', [])))
+
+    def get_question_index(self):
+        """Chỉ mục câu hỏi gần trùng của toàn bộ ngân hàng đề (xem utils/question_index.py)."""
+        def build():
+            index = QuestionIndex()
+            for grade in SUPPORTED_GRADES:
+                for exam in self.load_exam_bank(grade).get('exams', []):
+                    index.add_exam(grade, exam)
+            return index
+
+        return self._get_index('questions', self._get_exam_files(), build)
 
     def delete_exam(self, grade, exam_id):
         exams_data = self.load_exam_bank(grade)
@@ -107,8 +288,51 @@ class Database:
         self.save_exam_bank(grade, exams_data)
         return True
 
+    def update_answer_key(self, grade, exam_id, answers):
+        """
+        Sửa đáp án đúng của các câu trong một đề. answers: {số thứ tự câu: đáp án (chuỗi hoặc danh sách)}.
+        Trả về đề sau khi sửa, None nếu không tìm thấy đề.
+        """
+        exams_data = self.load_exam_bank(grade)
+        exam = next((item for item in exams_data.get('exams', []) if item.get('id') == exam_id), None)
+        if exam is None:
+            return None
+        for question in exam.get('questions', []):
+            number = str(question.get('number'))
+            if number in answers:
+                question['correct_answer'] = answers[number]
+        exam['questions_hash'] = questions_fingerprint(exam.get('questions', []))
+        exam['answer_key_updated_at'] = datetime.now().isoformat()
+        self.save_exam_bank(grade, exams_data)
+        return exam
+
+    @_synchronized('_results_lock')
+    def apply_regraded_results(self, updates):
+        """
+        Ghi điểm chấm lại vào log kết quả. updates: {result id: các trường mới}.
+        Đọc lại file trong khóa kết quả, ngay trước khi ghi, để không mất bài nộp trong lúc chấm; ghi một lần (atomic).
+        """
+        if not updates:
+            return 0
+        results = [self._prepare_result(result) for result in self._load_json(self.exam_results_file)
+                   if isinstance(result, dict)]
+        regraded_ts = time.time()
+        applied = 0
+        for result in results:
+            fields = updates.get(result.get('id'))
+            if fields is None:
+                continue
+            if 'breakdown' in fields:
+                result.pop('question_breakdown', None)
+            result.update(fields, regraded_ts=regraded_ts)
+            applied += 1
+        if applied:
+            self._save_json(self.exam_results_file, results, compact=True)
+        return applied
+
+    @_synchronized('_results_lock')
     def delete_exam_results(self, exam_id, grade=None):
-        results = self._load_json('data/exam_results.json')
+        results = self._load_json(self.exam_results_file)
         if not results:
             return 0
         filtered = [
@@ -120,15 +344,107 @@ class Database:
         ]
         removed = len(results) - len(filtered)
         if removed:
-            self._save_json('data/exam_results.json', filtered)
+            self._save_json(self.exam_results_file, [self._prepare_result(result) for result in filtered], compact=True)
         return removed
 
+    @staticmethod
+    def _prepare_result(result):
+        """
+        Bổ sung id và submitted_ts (epoch, dùng để sắp xếp) cho kết quả cũ chỉ có chuỗi submitted_at.
+        Id của kết quả cũ suy ra từ nội dung nên giữ nguyên giữa các lần đọc.
+        question_breakdown dạng danh sách dict được nén thành `breakdown` (xem utils/grading.py).
+        """
+        if not isinstance(result.get('submitted_ts'), (int, float)):
+            try:
+                result['submitted_ts'] = datetime.strptime(result.get('submitted_at', ''), RESULT_TIME_FORMAT).timestamp()
+            except (TypeError, ValueError):
+                result['submitted_ts'] = 0
+        if not result.get('id'):
+            source = '|'.join(str(result.get(key, '')) for key in ('user_id', 'grade', 'exam_id', 'submitted_at', 'score'))
+            result['id'] = f"result_{hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]}"
+        if isinstance(result.get('question_breakdown'), list):
+            packed = encode_breakdown(result['question_breakdown'])
+            if packed is not None:
+                result['breakdown'] = packed
+                del result['question_breakdown']
+        return result
+
+    @staticmethod
+    def _index_result(index, result):
+        # Các danh sách luôn theo thứ tự thời gian nộp tăng dần (cùng thời điểm thì theo thứ tự trong file)
+        index['seq'] += 1
+        key = (result['submitted_ts'], index['seq'])
+        insort(index['by_user'].setdefault(str(result.get('user_id')), []), (key, result))
+        insort(index['by_exam'].setdefault((str(result.get('grade')), result.get('exam_id')), []), (key, result))
+
+    def _get_results_index(self):
+        """Kết quả thi kèm chỉ mục theo user_id và theo (khối, đề)."""
+        def build():
+            index = {'results': [], 'by_user': {}, 'by_exam': {}, 'seq': 0}
+            for result in self._load_json(self.exam_results_file):
+                if isinstance(result, dict):
+                    index['results'].append(self._prepare_result(result))
+                    self._index_result(index, result)
+            return index
+
+        return self._get_index('exam_results', (self.exam_results_file,), build)
+
+    @_synchronized('_results_lock')
+    def add_exam_result(self, result):
+        """Lưu một bài nộp; chỉ mục trong bộ nhớ được cập nhật luôn thay vì dựng lại."""
+        result = dict(result)
+        result.setdefault('id', f"result_{uuid.uuid4().hex[:12]}")
+        result.setdefault('submitted_ts', time.time())
+        result.setdefault('submitted_at', datetime.fromtimestamp(result['submitted_ts']).strftime(RESULT_TIME_FORMAT))
+        self._prepare_result(result)
+        index = self._get_results_index()
+        index['results'].append(result)
+        # File kết quả lớn dần theo số bài nộp nên không thụt lề
+        self._save_json(self.exam_results_file, index['results'], compact=True)
+        self._index_result(index, result)
+        self._set_index('exam_results', (self.exam_results_file,), index)
+        return result
+
+    def get_all_exam_results(self):
+        """
+        Toàn bộ log kết quả theo thứ tự lưu. Bài nộp mới được nối vào chính danh sách này;
+        khi file bị ghi lại (xóa, chấm lại, process khác ghi) thì trả về một danh sách mới.
+        """
+        return self._get_results_index()['results']
+
+    def get_user_exam_results(self, user_id):
+        """Các bài nộp của một học sinh, mới nhất trước."""
+        rows = self._get_results_index()['by_user'].get(str(user_id), [])
+        return [result for _, result in reversed(rows)]
+
+    def get_latest_exam_result(self, user_id, grade, exam_id):
+        for _, result in reversed(self._get_results_index()['by_user'].get(str(user_id), [])):
+            if str(result.get('grade')) == str(grade) and result.get('exam_id') == exam_id:
+                return result
+        return None
+
+    def get_exam_results(self, grade, exam_id):
+        """Các bài nộp của một đề, theo thứ tự thời gian nộp."""
+        return [result for _, result in self._get_results_index()['by_exam'].get((str(grade), exam_id), [])]
+
+    def get_questions_hash_index(self):
+        index = {}
+        for grade in SUPPORTED_GRADES:
+            for exam in self.load_exam_bank(grade).get('exams', []):
+                exam_hash = exam.get('questions_hash') or questions_fingerprint(exam.get('questions', []))
+                index.setdefault(exam_hash, []).append(
+                    {'grade': grade, 'id': exam.get('id'), 'title': exam.get('title', '')}
+                )
+        return index
+
+    def find_exams_by_questions_hash(self, questions_hash):
+        return self.get_questions_hash_index().get(questions_hash, [])
+
     def get_exams_by_teacher(self, teacher_id):
         exams_by_grade = {}
         for grade in SUPPORTED_GRADES:
-            bank = self.load_exam_bank(grade)
             exams = [
-                exam for exam in bank.get('exams', [])
+                exam for exam in self.get_exam_summaries(grade)
                 if exam.get('created_by') == teacher_id
             ]
             if exams:
@@ -136,26 +452,171 @@ class Database:
         return exams_by_grade
 
     def get_all_courses(self):
+        """Manifest các khóa học: thông tin khóa và danh sách tóm tắt bài học theo thứ tự, không kèm nội dung bài."""
         return self._load_json(self.courses_file)
-    
+
+    @staticmethod
+    def _is_slug(value):
+        return bool(_SLUG_ID.fullmatch(str(value)))
+
+    def _get_lesson_file(self, course_id, lesson_id):
+        if not (self._is_slug(course_id) and self._is_slug(lesson_id)):
+            raise ValueError(f'Id khóa học/bài học không hợp lệ: {course_id}/{lesson_id}')
+        return os.path.join(self.lessons_dir, str(course_id), f'{lesson_id}.json')
+
+    @staticmethod
+    def _new_id(prefix, taken=()):
+        while True:
+            new_id = f'{prefix}{uuid.uuid4().hex[:12]}'
+            if new_id not in taken:
+                return new_id
+
+    @staticmethod
+    def _summarize_lesson(lesson):
+        return {
+            'id': lesson['id'],
+            'title': lesson.get('title', ''),
+            'question_count': len(lesson.get('questions') or [])
+        }
+
+    def _write_lesson(self, course_id, lesson):
+        os.makedirs(os.path.join(self.lessons_dir, str(course_id)), exist_ok=True)
+        self._save_json(self._get_lesson_file(course_id, lesson['id']), lesson)
+
+    @staticmethod
+    def _migrated_lesson_id(course_id, position):
+        # Id suy ra từ khóa học + vị trí: process nào chạy migrate cũng cấp cùng một id
+        return f"lesson_{hashlib.sha1(f'{course_id}:{position}'.encode('utf-8')).hexdigest()[:12]}"
+
+    def migrate_courses(self):
+        """
+        Tách bài học đang nhúng trong courses.json (định dạng cũ) ra file riêng từng bài; trả về số bài đã tách.
+        Id bài học cũ được giữ nguyên để tiến độ học đã lưu vẫn khớp; id không dùng được làm tên file thì
+        được thay bằng id suy ra từ khóa học và vị trí bài. Chạy trong khóa file nên các worker khởi động
+        cùng lúc không migrate chồng lên nhau.
+        """
+        lock_file = open(f'{self.courses_file}.lock', 'w')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            courses = self._load_json(self.courses_file)
+            migrated = 0
+            for course in courses:
+                summaries = []
+                taken = set()
+                for position, lesson in enumerate(course.get('lessons', [])):
+                    if 'questions' not in lesson and 'video_url' not in lesson:
+                        summaries.append(lesson)
+                        taken.add(str(lesson.get('id')))
+                        continue
+                    lesson = dict(lesson)
+                    if not self._is_slug(lesson.get('id') or '') or str(lesson['id']) in taken:
+                        lesson['id'] = self._migrated_lesson_id(course['id'], position)
+                    lesson['id'] = str(lesson['id'])
+                    taken.add(lesson['id'])
+                    self._write_lesson(course['id'], lesson)
+                    summaries.append(self._summarize_lesson(lesson))
+                    migrated += 1
+                course['lessons'] = summaries
+            if migrated:
+                self._save_json(self.courses_file, courses)
+            return migrated
+        finally:
+            lock_file.close()
+
+    def get_lesson(self, course_id, lesson_id):
+        """Nội dung đầy đủ của một bài học (video, tài liệu, câu hỏi); None nếu không có."""
+        if not (self._is_slug(course_id) and self._is_slug(lesson_id)):
+            return None
+        lesson_file = self._get_lesson_file(course_id, lesson_id)
+        if not os.path.exists(lesson_file):
+            return None
+        lesson = self._load_json(lesson_file)
+        return lesson if isinstance(lesson, dict) else None
+
+    def get_lesson_answer_key(self, course_id, lesson_id):
+        """
+        Đáp án đã biên dịch của một bài học (xem grading.compile_answer_key); None nếu không có bài học.
+        Mỗi bài có một chỉ mục riêng nên nơi gọi phải kiểm tra bài có trong manifest trước.
+        """
+        if not (self._is_slug(course_id) and self._is_slug(lesson_id)):
+            return None
+        lesson_file = self._get_lesson_file(course_id, lesson_id)
+
+        def build():
+            lesson = self.get_lesson(course_id, lesson_id)
+            return compile_answer_key(lesson.get('questions', [])) if lesson else None
+
+        # Mỗi bài một chỉ mục riêng, dựng lại khi chính file bài đó đổi
+        return self._get_index(f'lesson_answer_key:{course_id}:{lesson_id}', (lesson_file,), build)
+
+    @staticmethod
+    def _catalogue_entries(course):
+        return [
+            {
+                'course_id': course.get('id'),
+                'course_title': course.get('title', ''),
+                'lesson_id': lesson.get('id'),
+                'lesson_title': lesson.get('title', ''),
+                'question_count': lesson.get('question_count', 0)
+            }
+            for lesson in course.get('lessons', []) if lesson.get('question_count')
+        ]
+
+    def get_exercise_catalogue(self):
+        """Các bài học có câu hỏi (khóa học, bài học, số câu), dựng từ manifest nên không đọc nội dung bài."""
+        def build():
+            return [entry for course in self.get_all_courses() for entry in self._catalogue_entries(course)]
+
+        return list(self._get_index('exercise_catalogue', (self.courses_file,), build))
+
+    def get_course_summary(self, course_id):
+        """Thông tin khóa học trong manifest (bài học chỉ có id, tên, số câu)."""
+        return next((c for c in self.get_all_courses() if c['id'] == course_id), None)
+
     def get_course_by_id(self, course_id):
-        courses = self.get_all_courses()
-        return next((c for c in courses if c['id'] == course_id), None)
+        """Khóa học kèm nội dung đầy đủ các bài, chỉ đọc file của các bài thuộc khóa này."""
+        course = self.get_course_summary(course_id)
+        if not course:
+            return None
+        lessons = (self.get_lesson(course_id, summary['id']) for summary in course.get('lessons', []))
+        course['lessons'] = [lesson for lesson in lessons if lesson]
+        return course
     
     def get_courses_by_teacher(self, teacher_id):
         courses = self.get_all_courses()
         return [c for c in courses if c['teacher_id'] == teacher_id]
-    
+
+    def _save_lessons(self, course_id, lessons, current=None):
+        """
+        Ghi các bài học của khóa theo thứ tự gửi lên; chỉ ghi file của bài mới hoặc bài có nội dung đổi.
+        Bài có id không thuộc khóa (hoặc không có id) được cấp id mới. Trả về danh sách tóm tắt cho manifest.
+        """
+        current = current or {}
+        taken = set(current)
+        summaries = []
+        for lesson in lessons:
+            lesson = dict(lesson)
+            lesson_id = str(lesson.get('id') or '')
+            if lesson_id not in current or lesson_id in {summary['id'] for summary in summaries}:
+                lesson_id = self._new_id('lesson_', taken)
+            lesson['id'] = lesson_id
+            taken.add(lesson_id)
+            if current.get(lesson_id) != lesson:
+                self._write_lesson(course_id, lesson)
+            summaries.append(self._summarize_lesson(lesson))
+        return summaries
+
     def create_course(self, course_data, teacher_id):
         courses = self.get_all_courses()
-        course_id = f"course_{len(courses) + 1}"
+        course_id = self._new_id('course_', {c['id'] for c in courses})
         
         new_course = {
             'id': course_id,
             'teacher_id': teacher_id,
             'title': course_data['title'],
             'description': course_data.get('description', ''),
-            'lessons': course_data.get('lessons', []),
+            'lessons': self._save_lessons(course_id, course_data.get('lessons', [])),
             'created_at': datetime.now().isoformat()
         }
         
@@ -167,16 +628,46 @@ class Database:
         courses = self.get_all_courses()
         for i, course in enumerate(courses):
             if course['id'] == course_id:
-                courses[i].update(course_data)
-                courses[i]['updated_at'] = datetime.now().isoformat()
-                self._save_json(self.courses_file, courses)
+                # Chỉ nhận các trường giáo viên được sửa; id, teacher_id, created_at giữ nguyên
+                updated = dict(course, **{key: course_data[key] for key in COURSE_EDITABLE_FIELDS if key in course_data})
+                removed = set()
+                if 'lessons' in course_data:
+                    current = {}
+                    for summary in course.get('lessons', []):
+                        lesson = self.get_lesson(course_id, summary['id'])
+                        if lesson:
+                            current[summary['id']] = lesson
+                    updated['lessons'] = self._save_lessons(course_id, course_data['lessons'], current)
+                    removed = set(current) - {summary['id'] for summary in updated['lessons']}
+                # Manifest chỉ ghi lại khi thông tin khóa hoặc thứ tự/tóm tắt bài học đổi
+                if updated != course:
+                    updated['updated_at'] = datetime.now().isoformat()
+                    courses[i] = updated
+                    self._save_json(self.courses_file, courses)
+                # Xóa file bài đã bỏ sau khi manifest không còn trỏ tới chúng
+                for lesson_id in removed:
+                    try:
+                        os.remove(self._get_lesson_file(course_id, lesson_id))
+                    except OSError:
+                        pass
                 return True
         return False
+
+    def delete_course(self, course_id):
+        courses = self.get_all_courses()
+        remaining = [c for c in courses if c['id'] != course_id]
+        if len(remaining) == len(courses):
+            return False
+        self._save_json(self.courses_file, remaining)
+        if self._is_slug(course_id):
+            shutil.rmtree(os.path.join(self.lessons_dir, str(course_id)), ignore_errors=True)
+        return True
     
     def get_all_exercises(self):
         return self._load_json(self.exercises_file)
     
     def save_exercise_submission(self, user_id, submission_data):
+        by_user = self._peek_index('submissions_by_user', (self.submissions_file,))
         submissions = self._load_json(self.submissions_file)
         
         submission = {
@@ -187,10 +678,28 @@ class Database:
             'answers': submission_data['answers'],
             'submitted_at': submission_data.get('submitted_at', datetime.now().isoformat())
         }
+        # Điểm chấm sẵn (nếu có) được ghi cùng bài nộp trong một lần ghi file
+        for field in ('score', 'correct', 'total'):
+            if field in submission_data:
+                submission[field] = submission_data[field]
         
         submissions.append(submission)
         self._save_json(self.submissions_file, submissions)
+        if by_user is not None:
+            by_user.setdefault(str(user_id), []).append(submission)
+            self._set_index('submissions_by_user', (self.submissions_file,), by_user)
         return submission['id']
+
+    def get_user_submissions(self, user_id):
+        """Bài nộp bài tập của một học sinh, theo thứ tự nộp."""
+        def build():
+            by_user = {}
+            for submission in self._load_json(self.submissions_file):
+                if isinstance(submission, dict):
+                    by_user.setdefault(str(submission.get('user_id')), []).append(submission)
+            return by_user
+
+        return list(self._get_index('submissions_by_user', (self.submissions_file,), build).get(str(user_id), []))
     
     def get_student_progress(self, user_id):
         progress_list = self._load_json(self.progress_file)
@@ -276,6 +785,7 @@ class Database:
         posts = self.get_all_forum_posts()
         return [p for p in posts if p['author_id'] == user_id]
     
+    @_synchronized('_forum_lock')
     def create_forum_post(self, post_data):
         posts = self._load_json(self.forum_posts_file)
         post_id = f"post_{len(posts) + 1:04d}"
@@ -299,6 +809,7 @@ class Database:
         self._save_json(self.forum_posts_file, posts)
         return post_id
     
+    @_synchronized('_forum_lock')
     def update_forum_post(self, post_id, post_data):
         posts = self._load_json(self.forum_posts_file)
         
@@ -319,6 +830,7 @@ class Database:
         
         return False
     
+    @_synchronized('_forum_lock')
     def delete_forum_post(self, post_id):
         posts = self._load_json(self.forum_posts_file)
         posts = [p for p in posts if p['id'] != post_id]
@@ -330,6 +842,7 @@ class Database:
         
         return True
     
+    @_synchronized('_forum_lock')
     def increment_post_views(self, post_id):
         posts = self._load_json(self.forum_posts_file)
         
@@ -357,6 +870,7 @@ class Database:
         post_comments.sort(key=lambda x: x.get('created_at', ''))
         return post_comments
     
+    @_synchronized('_forum_lock')
     def add_comment(self, comment_data):
         comments = self._load_json(self.forum_comments_file)
         comment_id = f"comment_{len(comments) + 1:04d}"
@@ -379,6 +893,7 @@ class Database:
         
         return comment_id
     
+    @_synchronized('_forum_lock')
     def delete_comment(self, comment_id):
         comments = self._load_json(self.forum_comments_file)
         
@@ -395,6 +910,45 @@ class Database:
         
         return True
     
+    def is_attachment_referenced(self, path):
+        """File đính kèm còn được bài viết hoặc bình luận nào dùng không (file trùng nội dung được dùng chung)."""
+        for item in self._load_json(self.forum_posts_file) + self._load_json(self.forum_comments_file):
+            if any(attachment.get('path') == path for attachment in item.get('attachments', [])):
+                return True
+        return False
+    
+    def get_forum_attachment(self, path):
+        """
+        Tìm đính kèm (file gốc, bản thu nhỏ hoặc bản web) đang được bài viết/bình luận dùng.
+        Chỉ mục đường dẫn -> đính kèm giữ trong bộ nhớ, dựng lại khi file diễn đàn đổi.
+        """
+        def build():
+            index = {}
+            for item in self._load_json(self.forum_posts_file) + self._load_json(self.forum_comments_file):
+                for attachment in item.get('attachments', []):
+                    for key in ('path', 'thumbnail', 'web'):
+                        if attachment.get(key):
+                            index[attachment[key]] = attachment
+            return index
+
+        sources = (self.forum_posts_file, self.forum_comments_file)
+        return self._get_index('forum_attachments', sources, build).get(path)
+    
+    @_synchronized('_forum_lock')
+    def set_attachment_variants(self, path, variants):
+        """Ghi kích thước + đường dẫn bản thu nhỏ/bản web vào mọi đính kèm trỏ tới file `path`."""
+        for filename in (self.forum_posts_file, self.forum_comments_file):
+            items = self._load_json(filename)
+            changed = False
+            for item in items:
+                for attachment in item.get('attachments', []):
+                    if attachment.get('path') == path:
+                        attachment.update(variants)
+                        changed = True
+            if changed:
+                self._save_json(filename, items)
+    
+    @_synchronized('_forum_lock')
     def _update_comments_count(self, post_id):
         posts = self._load_json(self.forum_posts_file)
         comments = self.get_comments_by_post(post_id)
@@ -0,0 +1,167 @@
+import copy
+import hashlib
+import random
+import re
+from typing import Dict, Iterable, List
+
+from utils.grading import normalize_answer_token
+
+DIFFICULTIES = ('easy', 'medium', 'hard')
+DIFFICULTY_LABELS = {'easy': 'Dễ', 'medium': 'Trung bình', 'hard': 'Khó'}
+DEFAULT_DIFFICULTY = 'medium'
+
+# Lựa chọn/giải thích nhắc tới chữ cái của lựa chọn khác ("Cả A và B", "đáp án C") thì không đảo thứ tự
+_OPTION_REFERENCE = re.compile(r'(?<![\w])[A-H](?![\w])')
+
+
+class BlueprintError(ValueError):
+    """Ma trận đề không hợp lệ hoặc ngân hàng câu hỏi không còn khớp với ma trận."""
+
+
+def question_topic(question: Dict, exam: Dict) -> str:
+    """Chủ đề của câu: trường `topic` của câu, của đề, hoặc tên đề nguồn."""
+    return str(question.get('topic') or exam.get('topic') or exam.get('title') or exam.get('id')).strip()
+
+
+def question_difficulty(question: Dict) -> str:
+    difficulty = str(question.get('difficulty') or '').strip().lower()
+    return difficulty if difficulty in DIFFICULTIES else DEFAULT_DIFFICULTY
+
+
+class QuestionPool:
+    """
+    Câu hỏi của một khối, chia sẵn theo (chủ đề, độ khó) và theo đề nguồn.
+    Thứ tự câu trong mỗi nhóm cố định (theo thứ tự trong ngân hàng) để cùng seed luôn ra cùng đề.
+    """
+
+    def __init__(self, exams: Iterable[Dict]):
+        self.groups: Dict[tuple, List[tuple]] = {}
+        self.topics_by_exam: Dict[str, List[str]] = {}
+        for exam in exams:
+            if exam.get('blueprint'):
+                continue
+            topics = self.topics_by_exam.setdefault(exam.get('id'), [])
+            for question in exam.get('questions', []):
+                if not isinstance(question, dict):
+                    continue
+                topic = question_topic(question, exam)
+                if topic not in topics:
+                    topics.append(topic)
+                key = (exam.get('id'), topic, question_difficulty(question))
+                self.groups.setdefault(key, []).append((exam.get('id'), question))
+
+    def topics(self, exam_ids: Iterable[str]) -> List[str]:
+        topics = []
+        for exam_id in exam_ids:
+            for topic in self.topics_by_exam.get(exam_id, []):
+                if topic not in topics:
+                    topics.append(topic)
+        return topics
+
+    def candidates(self, exam_ids: Iterable[str], topic: str, difficulty: str) -> List[tuple]:
+        found = []
+        for exam_id in exam_ids:
+            found.extend(self.groups.get((exam_id, topic, difficulty), []))
+        return found
+
+    def signature(self, blueprint: Dict) -> str:
+        """Dấu vân tay của các câu mà ma trận có thể rút, để phát hiện ngân hàng đã đổi giữa lúc làm và lúc nộp."""
+        digest = hashlib.sha1()
+        for section in blueprint.get('sections', []):
+            for difficulty in DIFFICULTIES:
+                for exam_id, question in self.candidates(blueprint.get('source_exams', []), section['topic'], difficulty):
+                    digest.update(f"{exam_id}:{question.get('id')}|".encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+
+def build_blueprint(source_exams: List[str], topics: List[str], per_topic: int,
+                    mix: Dict[str, int], shuffle_options: bool = True) -> Dict:
+    """
+    Ma trận đề: mỗi chủ đề lấy per_topic câu, chia theo tỉ lệ độ khó `mix` (vd. {'easy': 3, 'medium': 5, 'hard': 2}).
+    """
+    weights = {difficulty: max(0, int(mix.get(difficulty, 0))) for difficulty in DIFFICULTIES}
+    if per_topic <= 0 or not topics or not source_exams:
+        raise BlueprintError('Cần chọn ít nhất một đề nguồn và số câu mỗi chủ đề lớn hơn 0.')
+    if not sum(weights.values()):
+        weights = {difficulty: 1 for difficulty in DIFFICULTIES}
+
+    # Chia per_topic câu theo tỉ lệ, phần dư cho các mức có phần lẻ lớn nhất
+    total_weight = sum(weights.values())
+    exact = {difficulty: per_topic * weight / total_weight for difficulty, weight in weights.items()}
+    counts = {difficulty: int(value) for difficulty, value in exact.items()}
+    for difficulty in sorted(DIFFICULTIES, key=lambda item: -(exact[item] - counts[item]))[:per_topic - sum(counts.values())]:
+        counts[difficulty] += 1
+
+    return {
+        'source_exams': list(source_exams),
+        'sections': [{'topic': topic, 'counts': dict(counts)} for topic in topics],
+        'shuffle_options': bool(shuffle_options)
+    }
+
+
+def blueprint_question_count(blueprint: Dict) -> int:
+    return sum(sum(section.get('counts', {}).values()) for section in blueprint.get('sections', []))
+
+
+def new_seed() -> int:
+    return random.SystemRandom().randrange(1 << 31)
+
+
+def _can_shuffle_options(question: Dict) -> bool:
+    texts = list((question.get('options') or {}).values()) + [question.get('explanation') or '']
+    return not any(_OPTION_REFERENCE.search(str(text)) for text in texts)
+
+
+def _shuffle_options(question: Dict, rng: random.Random) -> None:
+    options = question.get('options') or {}
+    keys = list(options.keys())
+    order = list(range(len(keys)))
+    rng.shuffle(order)
+    # Nội dung lựa chọn đổi chỗ, các chữ cái A/B/C/D giữ nguyên vị trí
+    question['options'] = {keys[new]: options[keys[old]] for new, old in enumerate(order)}
+    moved = {normalize_answer_token(keys[old]): keys[new] for new, old in enumerate(order)}
+
+    correct = question.get('correct_answer')
+    if isinstance(correct, list):
+        question['correct_answer'] = sorted(moved.get(normalize_answer_token(value), value) for value in correct)
+    elif correct is not None:
+        question['correct_answer'] = moved.get(normalize_answer_token(correct), correct)
+
+
+def generate_exam(exam: Dict, pool: QuestionPool, seed: int) -> Dict:
+    """
+    Dựng đề cho một lượt làm từ ma trận của `exam` và seed. Cùng seed và cùng ngân hàng luôn ra cùng đề
+    (kể cả thứ tự lựa chọn), nên lúc nộp bài chỉ cần seed để chấm lại.
+    Nhóm độ khó thiếu câu thì lấy bù từ các câu còn lại của cùng chủ đề.
+    """
+    blueprint = exam.get('blueprint') or {}
+    source_exams = blueprint.get('source_exams', [])
+    rng = random.Random(f"{exam.get('id')}:{seed}")
+
+    picked = []
+    for section in blueprint.get('sections', []):
+        leftovers = []
+        shortage = 0
+        for difficulty in DIFFICULTIES:
+            candidates = pool.candidates(source_exams, section['topic'], difficulty)
+            wanted = section.get('counts', {}).get(difficulty, 0)
+            order = rng.sample(range(len(candidates)), len(candidates))
+            picked.extend(candidates[index] for index in order[:wanted])
+            leftovers.extend(candidates[index] for index in order[wanted:])
+            shortage += max(0, wanted - len(candidates))
+        picked.extend(leftovers[:shortage])
+    rng.shuffle(picked)
+
+    questions = []
+    for position, (source_exam, source_question) in enumerate(picked, start=1):
+        question = copy.deepcopy(source_question)
+        question['source'] = {'exam_id': source_exam, 'id': source_question.get('id'), 'number': source_question.get('number')}
+        question['id'] = position
+        question['number'] = position
+        if blueprint.get('shuffle_options', True) and _can_shuffle_options(question):
+            _shuffle_options(question, rng)
+        questions.append(question)
+
+    generated = dict(exam, questions=questions)
+    generated['seed'] = seed
+    return generated
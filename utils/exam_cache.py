@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List, Optional
+
+EXAM_CACHE_FOLDER = os.getenv('EXAM_CACHE_FOLDER', 'data/exam_cache')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Tăng khi thay đổi cách parse/chuẩn hóa câu hỏi để bỏ qua cache cũ
+PARSER_CACHE_VERSION = 1
+
+
+def write_upload_temp(file_storage, folder: str):
+    """
+    Ghi file upload ra file tạm theo từng khối, vừa ghi vừa tính SHA-256.
+    Trả về (đường dẫn file tạm, sha256); dùng publish_upload để đưa vào tên theo nội dung.
+    """
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    temp_path = os.path.join(folder, f'.upload_{uuid.uuid4().hex}')
+    stream = getattr(file_storage, 'stream', file_storage)
+    with open(temp_path, 'wb') as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return temp_path, digest.hexdigest()
+
+
+def publish_upload(temp_path: str, folder: str, sha256: str, extension: str = 'docx') -> str:
+    """Đổi file tạm thành <sha256>.<extension>; đã có file cùng nội dung thì bỏ file tạm."""
+    final_path = os.path.join(folder, f'{sha256}.{extension}')
+    if os.path.exists(final_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, final_path)
+    return final_path
+
+
+def save_upload_by_hash(file_storage, folder: str, extension: str = 'docx'):
+    """
+    Ghi file upload theo nội dung (<sha256>.<extension>) nên upload lại cùng file không tạo bản sao.
+    Trả về (đường dẫn, sha256).
+    """
+    temp_path, sha256 = write_upload_temp(file_storage, folder)
+    return publish_upload(temp_path, folder, sha256, extension), sha256
+
+
+def _cache_path(sha256: str, allow_multiple: bool) -> str:
+    mode = 'multi' if allow_multiple else 'single'
+    return os.path.join(EXAM_CACHE_FOLDER, f'{sha256}_{mode}.json')
+
+
+def get_cached_questions(sha256: Optional[str], allow_multiple: bool) -> Optional[Dict]:
+    """Lấy danh sách câu hỏi đã parse + kiểm tra của file có cùng SHA-256 và chế độ đáp án."""
+    if not sha256:
+        return None
+    try:
+        with open(_cache_path(sha256, allow_multiple), 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError):
+        return None
+    if entry.get('version') != PARSER_CACHE_VERSION:
+        return None
+    return entry
+
+
+def store_cached_questions(sha256: Optional[str], allow_multiple: bool, questions: List[Dict],
+                           allow_multiple_answers: bool) -> None:
+    if not sha256:
+        return
+    os.makedirs(EXAM_CACHE_FOLDER, exist_ok=True)
+    path = _cache_path(sha256, allow_multiple)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': PARSER_CACHE_VERSION,
+            'questions': questions,
+            'allow_multiple_answers': allow_multiple_answers,
+            'questions_hash': questions_fingerprint(questions)
+        }, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def questions_fingerprint(questions: List[Dict]) -> str:
+    """Dấu vân tay của bộ câu hỏi (nội dung, lựa chọn, đáp án) để phát hiện đề trùng."""
+    canonical = []
+    for question in questions:
+        if not isinstance(question, dict):
+            continue
+        correct = question.get('correct_answer')
+        if isinstance(correct, list):
+            correct = sorted(str(token).strip().upper() for token in correct)
+        else:
+            correct = str(correct or '').strip().upper()
+        options = question.get('options') or {}
+        canonical.append([
+            ' '.join(str(question.get('question', '')).split()).lower(),
+            sorted((str(key).upper(), ' '.join(str(value).split()).lower()) for key, value in options.items()),
+            correct
+        ])
+    payload = json.dumps(canonical, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
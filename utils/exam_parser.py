@@ -1,9 +1,11 @@
 import os
 import re
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 from docx import Document
 
+from utils.grading import normalize_correct_answers
+
 
 class ExamParseError(Exception):
     """Ngoại lệ riêng cho lỗi đọc đề thi."""
@@ -46,9 +48,14 @@ def _paragraph_has_underlined_letter(paragraph, letter: str) -> bool:
     return False
 
 
-def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> List[Dict]:
+def parse_docx_exam(
+    file_path: str,
+    allow_multiple_answers: bool = False,
+    on_progress: Optional[Callable[[int, int], None]] = None
+) -> List[Dict]:
     """
     Đọc file .docx và chuyển thành danh sách câu hỏi trắc nghiệm.
+    on_progress(done, total) được gọi theo số đoạn văn đã đọc (nếu có).
     Mỗi phần tử có dạng:
     {
         'number': int,
@@ -107,7 +114,12 @@ def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> Lis
         questions.append(current_question.copy())
         current_option_letter = None
 
-    for paragraph in document.paragraphs:
+    paragraphs = document.paragraphs
+    total_paragraphs = len(paragraphs)
+
+    for paragraph_index, paragraph in enumerate(paragraphs, start=1):
+        if on_progress:
+            on_progress(paragraph_index, total_paragraphs)
         raw_text = (paragraph.text or '').replace('\xa0', ' ')
         if not raw_text.strip():
             continue
@@ -208,3 +220,64 @@ def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> Lis
         raise ExamParseError('Không tìm thấy câu hỏi trắc nghiệm hợp lệ trong file.')
 
     return questions
+
+
+def find_multiple_answer_questions(questions: List[Dict]) -> List[int]:
+    """Trả về số thứ tự các câu có nhiều hơn 1 đáp án đúng."""
+    return [
+        item.get('number')
+        for item in questions
+        if len(normalize_correct_answers(item.get('correct_answer'))) > 1
+    ]
+
+
+def build_exam_questions(parsed_questions: List[Dict]) -> Tuple[List[Dict], bool]:
+    """
+    Kiểm tra và chuẩn hóa câu hỏi đã parse thành dạng lưu trong ngân hàng đề.
+    Trả về (questions, has_tl2_question).
+    """
+    questions: List[Dict] = []
+    has_tl2_question = False
+    for idx, item in enumerate(parsed_questions, start=1):
+        options = item.get('options', {})
+        correct_answer = item.get('correct_answer')
+        question_type = item.get('type', 'tl1')
+
+        if not options or len(options) < 2:
+            raise ExamParseError(f'Câu {item.get("number", idx)} không có đủ lựa chọn.')
+
+        if question_type == 'tl2':
+            has_tl2_question = True
+            if len(options) != 4:
+                raise ExamParseError(f'Câu {item.get("number", idx)} (TL2) cần đúng 4 ý để đánh giá Đúng/Sai.')
+
+        option_keys = {key.upper(): key for key in options.keys()}
+        correct_tokens = normalize_correct_answers(correct_answer)
+        if not correct_tokens:
+            raise ExamParseError(f'Không xác định được đáp án đúng cho câu {item.get("number", idx)}.')
+
+        invalid_tokens = [token for token in correct_tokens if token not in option_keys]
+        if invalid_tokens:
+            raise ExamParseError(
+                f'Đáp án {", ".join(invalid_tokens)} của câu {item.get("number", idx)} không trùng với lựa chọn A/B/C/D.'
+            )
+
+        def convert_token(token):
+            # Map back to original key casing (A vs a) if needed
+            return option_keys.get(token, token)
+
+        if question_type == 'tl2' or len(correct_tokens) > 1:
+            normalized_correct = [convert_token(token) for token in sorted(correct_tokens)]
+        else:
+            normalized_correct = convert_token(next(iter(correct_tokens)))
+
+        questions.append({
+            'id': item.get('number', idx),
+            'number': item.get('number', idx),
+            'question': item.get('question', '').strip(),
+            'options': options,
+            'correct_answer': normalized_correct,
+            'explanation': item.get('explanation', '').strip(),
+            'type': question_type
+        })
+    return questions, has_tl2_question
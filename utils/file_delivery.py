@@ -0,0 +1,73 @@
+import os
+from typing import Iterable, Optional
+
+from flask import abort, current_app, request
+from werkzeug.utils import send_file
+
+# Cách trả file đã kiểm tra quyền:
+#   direct     - Python tự gửi (có Range/If-None-Match; gunicorn dùng sendfile() khi gửi trọn file)
+#   x-accel    - nginx gửi qua X-Accel-Redirect, cần location internal trỏ về thư mục ứng dụng:
+#                    location /_protected/ { internal; alias /duong/dan/toi/ung_dung/; }
+#   x-sendfile - Apache mod_xsendfile / lighttpd gửi qua header X-Sendfile (đường dẫn tuyệt đối)
+FILE_DELIVERY_MODE = os.getenv('FILE_DELIVERY_MODE', 'direct').lower()
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/_protected/')
+# File lưu theo nội dung (<sha256>.<ext>) không bao giờ đổi nên trình duyệt được cache lâu
+PRIVATE_IMMUTABLE_MAX_AGE = 31536000
+
+
+def init_app(app, protected_folders: Iterable[str]) -> None:
+    """Chặn truy cập trực tiếp qua /static tới các thư mục upload; file chỉ được lấy qua route có kiểm tra quyền."""
+    static_folder = os.path.abspath(app.static_folder)
+    prefixes = []
+    for folder in protected_folders:
+        relative = os.path.relpath(os.path.abspath(folder), static_folder)
+        if not relative.startswith('..'):
+            prefixes.append(relative.replace(os.sep, '/').rstrip('/') + '/')
+    prefixes = tuple(prefixes)
+
+    @app.before_request
+    def block_protected_static():
+        if prefixes and request.endpoint == 'static':
+            filename = (request.view_args or {}).get('filename', '')
+            if filename.replace('\\', '/').lstrip('/').startswith(prefixes):
+                abort(404)
+
+
+def send_stored_file(path: str, download_name: Optional[str] = None, as_attachment: bool = False,
+                     etag: Optional[str] = None):
+    """
+    Trả file `path` (tương đối so với thư mục ứng dụng) sau khi view đã kiểm tra quyền.
+    Ở chế độ x-accel/x-sendfile, Python chỉ trả header; web server đọc file và tự xử lý Range.
+    """
+    absolute_path = os.path.join(current_app.root_path, path)
+    if not os.path.isfile(absolute_path):
+        abort(404)
+
+    offload = FILE_DELIVERY_MODE in ('x-accel', 'x-sendfile')
+    response = send_file(
+        absolute_path,
+        request.environ,
+        download_name=download_name,
+        as_attachment=as_attachment,
+        etag=etag or True,
+        max_age=PRIVATE_IMMUTABLE_MAX_AGE,
+        use_x_sendfile=offload,
+        response_class=current_app.response_class,
+        # Tự gửi thì tự xử lý Range (tải tiếp được); giao cho web server thì chỉ còn 304
+        conditional=not offload
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+
+    if offload:
+        response = response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+        elif FILE_DELIVERY_MODE == 'x-accel':
+            relative = os.path.relpath(absolute_path, current_app.root_path).replace(os.sep, '/')
+            response.headers.pop('X-Sendfile', None)
+            response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + relative
+        # Thân response rỗng, độ dài do web server đặt theo file thật
+        response.headers.pop('Content-Length', None)
+    return response
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Tuple
+
+from flask import current_app, make_response, render_template, request, session
+from markupsafe import Markup
+
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', '128'))
+
+
+class FragmentCache:
+    """
+    Cache HTML đã render của các trang ít thay đổi, khóa theo "tem phiên bản" của các tập dữ liệu nguồn.
+    Tem gồm mtime/kích thước của file dữ liệu (thấy được thay đổi do worker khác ghi) và bộ đếm trong
+    tiến trình, tăng mỗi khi Database ghi file (thấy ngay cả khi mtime chưa kịp đổi).
+    """
+
+    def __init__(self, max_entries: int = FRAGMENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._collections: Dict[str, Tuple[str, ...]] = {}
+        self._counters: Dict[str, int] = {}
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, *paths: str) -> None:
+        self._collections[name] = tuple(os.path.normpath(path) for path in paths)
+
+    def invalidate(self, *names: str) -> None:
+        with self._lock:
+            for name in names:
+                self._counters[name] = self._counters.get(name, 0) + 1
+
+    def invalidate_path(self, path: str) -> None:
+        path = os.path.normpath(path)
+        self.invalidate(*[name for name, paths in self._collections.items() if path in paths])
+
+    def version(self, *names: str) -> str:
+        parts = []
+        for name in names:
+            parts.append(f'{name}:{self._counters.get(name, 0)}')
+            for path in self._collections.get(name, ()):
+                try:
+                    stat = os.stat(path)
+                    parts.append(f'{stat.st_mtime_ns}:{stat.st_size}')
+                except OSError:
+                    parts.append('-')
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+    def get_or_render(self, key, collections: Iterable[str], render: Callable[[], str]):
+        """Trả về (html, tem phiên bản); chỉ gọi render() khi dữ liệu nguồn đã đổi hoặc chưa có trong cache."""
+        stamp = self.version(*collections)
+        cache_key = (key, stamp)
+        with self._lock:
+            html = self._items.get(cache_key)
+            if html is not None:
+                self._items.move_to_end(cache_key)
+                return html, stamp
+
+        html = render()
+        with self._lock:
+            self._items[cache_key] = html
+            self._items.move_to_end(cache_key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return html, stamp
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+fragment_cache = FragmentCache()
+_template_stamp = None
+
+
+def _get_template_stamp() -> str:
+    # Đổi giao diện (deploy mới) thì ETag cũng đổi; giống nhau giữa các worker cùng một bản deploy
+    global _template_stamp
+    if _template_stamp is None:
+        latest = 0
+        for root, _, names in os.walk(os.path.join(current_app.root_path, current_app.template_folder)):
+            for name in names:
+                latest = max(latest, os.stat(os.path.join(root, name)).st_mtime_ns)
+        _template_stamp = str(latest)
+    return _template_stamp
+
+
+def render_cached_page(template_name: str, fragment_template: str, fragment_var: str,
+                       collections: Iterable[str], load_context: Callable[[], Dict],
+                       fragment_key=(), **page_context):
+    """
+    Render trang với phần danh sách lấy từ fragment cache (load_context chỉ chạy khi cache trượt).
+    Trang có ETag theo tem dữ liệu + người dùng; trình duyệt gửi lại If-None-Match thì trả 304.
+    """
+    collections = tuple(collections)
+    html, stamp = fragment_cache.get_or_render(
+        (fragment_template,) + tuple(fragment_key),
+        collections,
+        lambda: render_template(fragment_template, **load_context())
+    )
+
+    # Còn thông báo flash chưa hiển thị thì không cho trả 304
+    cacheable = not session.get('_flashes')
+    etag_source = '|'.join([
+        stamp, _get_template_stamp(), template_name, request.full_path,
+        str(session.get('user_id')), str(session.get('role')), str(session.get('username'))
+    ])
+    etag = hashlib.sha1(etag_source.encode('utf-8')).hexdigest()
+    if cacheable and etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        page_context[fragment_var] = Markup(html)
+        response = make_response(render_template(template_name, **page_context))
+    if cacheable:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -1,17 +1,458 @@
+import abc
+import json
 import os
+import random
 import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
 
 import google.generativeai as genai
 
+from utils.ai_gateway import AIGatewayError, gateway
+
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_CONTEXT_MODEL = os.getenv("GEMINI_CONTEXT_MODEL", "gemini-2.0-flash-exp")
+# 'real' gọi Gemini; 'replay' trả lời bằng bản ghi trong GEMINI_REPLAY_FILE;
+# 'fake' (tên cũ: 'stub') trả lời mẫu với độ trễ/lỗi giả lập - để đo tải khi không có mạng
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "real").lower()
+# Khi đặt, backend real ghi thêm mọi câu hỏi/câu trả lời vào file này (định dạng của GEMINI_REPLAY_FILE)
+GEMINI_RECORD_FILE = os.getenv("GEMINI_RECORD_FILE")
+GEMINI_REPLAY_FILE = os.getenv("GEMINI_REPLAY_FILE", "data/gemini_replay.jsonl")
+GEMINI_REPLAY_SPEED = float(os.getenv("GEMINI_REPLAY_SPEED", "0"))
+# Mặc định câu hỏi chưa có bản ghi là lỗi; đặt 0 để trả về câu trả lời đánh dấu REPLAY_MISS_PREFIX
+GEMINI_REPLAY_STRICT = os.getenv("GEMINI_REPLAY_STRICT", "1") == "1"
+REPLAY_MISS_PREFIX = "[Không có bản ghi replay]"
+GEMINI_FAKE_LATENCY = float(os.getenv("GEMINI_FAKE_LATENCY", os.getenv("GEMINI_STUB_DELAY", "0")))
+GEMINI_FAKE_JITTER = float(os.getenv("GEMINI_FAKE_JITTER", "0"))
+GEMINI_FAKE_ERROR_RATE = float(os.getenv("GEMINI_FAKE_ERROR_RATE", "0"))
+GEMINI_FAKE_SEED = os.getenv("GEMINI_FAKE_SEED")
+CHAT_CACHE_SIZE = int(os.getenv("GEMINI_CACHE_SIZE", "256"))
+CHAT_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "3600"))
 
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
+SYSTEM_PROMPT = """
+        Bạn là trợ lý AI cho học sinh THPT ôn thi môn Tin học.
+        Nhiệm vụ của bạn là:
+        - Giải đáp thắc mắc về lập trình, thuật toán, cấu trúc dữ liệu
+        - Hướng dẫn học sinh giải bài tập tin học
+        - Giải thích các khái niệm tin học một cách dễ hiểu
+        - Trả lời bằng tiếng Việt, ngắn gọn và rõ ràng
+
+        QUAN TRỌNG: Trả lời bằng văn bản thuần túy, KHÔNG sử dụng bất kỳ ký tự định dạng nào như:
+        - Dấu # cho tiêu đề
+        - Dấu ** hoặc * cho in đậm/nghiêng
+        - Dấu ``` cho code block
+        - Dấu ` cho inline code
+        Chỉ viết văn bản bình thường, dễ đọc.
+        """
+
+CONTEXT_SYSTEM_INSTRUCTION = """
+            Bạn là trợ lý AI cho học sinh THPT ôn thi môn Tin học.
+            Trả lời bằng văn bản thuần túy, KHÔNG sử dụng ký tự định dạng Markdown như #, **, *, ```.
+            Chỉ viết văn bản bình thường, dễ đọc.
+            """
+
+# Cặp lượt mở đầu mỗi phiên chat có ngữ cảnh, thay cho system_instruction mà client đang dùng chưa hỗ trợ
+CONTEXT_INSTRUCTION_HISTORY = [
+    {'role': 'user', 'parts': [' '.join(CONTEXT_SYSTEM_INSTRUCTION.split())]},
+    {'role': 'model', 'parts': ['Đã hiểu, tôi sẽ trả lời bằng văn bản thuần túy.']}
+]
+
+NOT_CONFIGURED_MESSAGE = "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+
+
+class ResponseCache:
+    """Cache LRU có thời hạn (TTL) cho câu trả lời của AI."""
+
+    def __init__(self, max_size=256, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class _PendingCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """Gộp các yêu cầu giống hệt nhau đang chạy đồng thời thành một lần gọi API."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute):
+        with self._lock:
+            call = self._pending.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _PendingCall()
+                self._pending[key] = call
+
+        if not is_leader:
+            # Người đi sau cũng tính vào giới hạn của gateway và có hạn chót như lời gọi thật
+            gateway.wait_for(call.event)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = compute()
+            return call.result
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            call.event.set()
+
+
+class _TextResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+def _question_of(prompt):
+    """Lấy phần câu hỏi của học sinh ra khỏi prompt đầy đủ (tin nhắn hội thoại được giữ nguyên)."""
+    return prompt.rsplit("Câu hỏi của học sinh:", 1)[-1].strip()
+
+
+class _OfflineModel(abc.ABC):
+    """Cơ sở cho các model không gọi mạng, có cùng giao diện generate_content/start_chat với GenerativeModel."""
+    chunk_size = 8
+
+    def __init__(self):
+        self.calls = 0
+        self.last_history = None
+        self._lock = threading.Lock()
+
+    def start_chat(self, history=None):
+        return _OfflineChat(self, history)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        text, latency = self._respond(_question_of(prompt))
+        if stream:
+            return self._stream_chunks(text, latency)
+        if latency:
+            time.sleep(latency)
+        return _TextResponse(text)
+
+    @abc.abstractmethod
+    def _respond(self, question):
+        """Trả về (nội dung trả lời, độ trễ giây)."""
+
+    def _stream_chunks(self, text, latency):
+        # Cắt nhỏ tùy ý (kể cả giữa dấu **) để giống cách API trả từng phần
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        for piece in pieces:
+            if latency:
+                time.sleep(latency / len(pieces))
+            yield _TextResponse(piece)
+
+
+class _OfflineChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, message, stream=False, **kwargs):
+        self.model.last_history = self.history
+        return self.model.generate_content(message, stream=stream)
+
+
+class FakeModel(_OfflineModel):
+    """
+    Trả lời mẫu sau độ trễ latency ± jitter giây, có thể gây lỗi ngẫu nhiên theo error_rate.
+    Cùng seed thì cùng chuỗi độ trễ/lỗi, để kết quả đo lặp lại được.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    def _respond(self, question):
+        with self._lock:
+            roll = self._random.random()
+            offset = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        if roll < self.error_rate:
+            raise RuntimeError("Lỗi giả lập từ backend fake")
+        text = f"Trả lời mẫu cho câu hỏi: **{question}**\nĐây là câu trả lời giả lập, không gọi Gemini."
+        return text, max(0.0, self.latency + offset)
+
+
+class ReplayModel(_OfflineModel):
+    """
+    Trả lời bằng các bản ghi trong file JSONL: {"prompt": ..., "response": ..., "latency_ms": ...}.
+    Câu hỏi được so khớp sau normalize_prompt; câu chưa có bản ghi thì báo lỗi (strict), hoặc trả về
+    câu trả lời bắt đầu bằng REPLAY_MISS_PREFIX và được đếm trong `misses`, không bao giờ mượn bản ghi của câu khác.
+    speed nhân với độ trễ đã ghi: 0 = trả ngay, 1 = như lúc ghi.
+    """
+
+    def __init__(self, path, speed=0.0, strict=True):
+        super().__init__()
+        self.path = path
+        self.speed = speed
+        self.strict = strict
+        self.misses = 0
+        self.records = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('prompt') and 'response' in record:
+                        self.records[normalize_prompt(record['prompt'])] = record
+        except FileNotFoundError:
+            pass
+
+    def _respond(self, question):
+        record = self.records.get(normalize_prompt(question))
+        if record is None:
+            if self.strict:
+                raise LookupError(f"Không có câu trả lời đã ghi cho câu hỏi: {question}")
+            with self._lock:
+                self.misses += 1
+            return f"{REPLAY_MISS_PREFIX} {question}", 0.0
+        return record['response'], record.get('latency_ms', 0) / 1000 * self.speed
+
+
+class RecordingModel:
+    """Bọc model thật: mỗi câu hỏi + câu trả lời + độ trễ được ghi thêm vào file JSONL cho ReplayModel."""
+
+    def __init__(self, model, path):
+        self.model = model
+        self.path = path
+        self._lock = threading.Lock()
+
+    def start_chat(self, history=None):
+        return _RecordingChat(self, self.model.start_chat(history=history))
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return self._record(
+            _question_of(prompt), lambda: self.model.generate_content(prompt, stream=stream, **kwargs), stream
+        )
+
+    def _record(self, question, call, stream):
+        started = time.monotonic()
+        response = call()
+        if stream:
+            return self._record_stream(question, response, started)
+        self._write(question, response.text, started)
+        return response
+
+    def _record_stream(self, question, chunks, started):
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk.text)
+            yield chunk
+        self._write(question, ''.join(parts), started)
+
+    def _write(self, question, text, started):
+        record = {
+            'prompt': question,
+            'response': text,
+            'latency_ms': int((time.monotonic() - started) * 1000)
+        }
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class _RecordingChat:
+    def __init__(self, recorder, chat):
+        self.recorder = recorder
+        self.chat = chat
+
+    def send_message(self, message, stream=False, **kwargs):
+        return self.recorder._record(
+            message, lambda: self.chat.send_message(message, stream=stream, **kwargs), stream
+        )
+
+
+class GeminiBackend(abc.ABC):
+    """Giao diện backend: cung cấp model cho câu hỏi đơn và model cho hội thoại nhiều lượt."""
+    name = ''
+    requires_api_key = False
+
+    @abc.abstractmethod
+    def get_model(self):
+        """Model cho câu hỏi đơn."""
+
+    def get_chat_model(self):
+        return self.get_model()
+
+
+class RealBackend(GeminiBackend):
+    """Gọi Gemini thật; nếu có record_file thì ghi lại mọi câu trả lời để replay."""
+    name = 'real'
+    requires_api_key = True
+
+    def __init__(self, record_file=None):
+        self.record_file = record_file
+        self._model = None
+        self._chat_model = None
+        self._lock = threading.Lock()
+
+    def _wrap(self, model):
+        return RecordingModel(model, self.record_file) if self.record_file else model
+
+    def get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._wrap(genai.GenerativeModel(GEMINI_MODEL))
+        return self._model
+
+    def get_chat_model(self):
+        if self._chat_model is None:
+            with self._lock:
+                if self._chat_model is None:
+                    # google-generativeai 0.3.2 chưa có system_instruction: chỉ dẫn được gửi trong
+                    # lịch sử mở đầu của mỗi phiên chat (xem send_with_context)
+                    self._chat_model = self._wrap(genai.GenerativeModel(
+                        GEMINI_CONTEXT_MODEL,
+                        generation_config={
+                            'temperature': 0.7,
+                        }
+                    ))
+        return self._chat_model
+
+
+class ReplayBackend(GeminiBackend):
+    name = 'replay'
+
+    def __init__(self, path, speed=0.0, strict=True):
+        self.model = ReplayModel(path, speed=speed, strict=strict)
+
+    def get_model(self):
+        return self.model
+
+
+class FakeBackend(GeminiBackend):
+    name = 'fake'
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.model = FakeModel(latency=latency, jitter=jitter, error_rate=error_rate, seed=seed)
+
+    def get_model(self):
+        return self.model
+
+
+def create_backend(name=None):
+    """Tạo backend theo tên ('real', 'replay', 'fake'; 'stub' là tên cũ của 'fake') và cấu hình môi trường."""
+    name = (name or GEMINI_BACKEND).lower()
+    if name == "replay":
+        return ReplayBackend(GEMINI_REPLAY_FILE, speed=GEMINI_REPLAY_SPEED, strict=GEMINI_REPLAY_STRICT)
+    if name in ("fake", "stub"):
+        return FakeBackend(
+            latency=GEMINI_FAKE_LATENCY,
+            jitter=GEMINI_FAKE_JITTER,
+            error_rate=GEMINI_FAKE_ERROR_RATE,
+            seed=GEMINI_FAKE_SEED
+        )
+    if name == "real":
+        return RealBackend(GEMINI_RECORD_FILE)
+    raise ValueError(f"GEMINI_BACKEND không hợp lệ: {name}")
+
+
+response_cache = ResponseCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+_coalescer = RequestCoalescer()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Backend dùng chung cho cả tiến trình, tạo một lần."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """Đổi backend lúc chạy (dùng khi đo tải); xóa cache để không trả lời bằng kết quả của backend cũ."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+    response_cache.clear()
+
+
+def get_model():
+    return get_backend().get_model()
+
+
+def get_chat_model():
+    return get_backend().get_chat_model()
+
+
+def is_configured():
+    return not get_backend().requires_api_key or bool(GEMINI_API_KEY)
+
+
+def normalize_prompt(text):
+    """Chuẩn hóa câu hỏi làm khóa cache: Unicode NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu cuối."""
+    text = unicodedata.normalize("NFC", text or "")
+    text = re.sub(r"\s+", " ", text).strip().casefold()
+    return text.rstrip("?.!。 ")
+
+
 def remove_markdown_formatting(text):
     """
     Loại bỏ các ký tự định dạng Markdown
     """
+    return _strip_markdown(text).strip()
+
+def _strip_markdown(text):
 
     text = re.sub(r'#+\s*', '', text)
     
@@ -29,85 +470,212 @@ def remove_markdown_formatting(text):
    
     text = re.sub(r'`(.+?)`', r'\1', text)
     
-    return text.strip()
+    return text
+
+class MarkdownStreamCleaner:
+    """
+    Bỏ định dạng Markdown cho từng phần văn bản khi stream.
+    Chỉ xả phần đã "an toàn" (hết dòng, hoặc tới khoảng trắng khi các dấu *, _, ` đã đóng)
+    để không cắt đôi một cặp định dạng giữa hai chunk.
+    """
+
+    SAFE_FLUSH_LENGTH = 80
+
+    def __init__(self):
+        self._buffer = ''
+        self._started = False
+
+    def _emit(self, text):
+        cleaned = _strip_markdown(text)
+        if not self._started:
+            cleaned = cleaned.lstrip()
+            self._started = bool(cleaned)
+        return cleaned
+
+    @staticmethod
+    def _is_balanced(text):
+        return all(text.count(marker) % 2 == 0 for marker in ('*', '_', '`'))
+
+    def feed(self, chunk):
+        self._buffer += chunk or ''
+        cut = self._buffer.rfind('\n') + 1
+        if not cut and len(self._buffer) >= self.SAFE_FLUSH_LENGTH:
+            space = self._buffer.rfind(' ')
+            if space > 0 and self._is_balanced(self._buffer[:space]):
+                cut = space + 1
+        if not cut:
+            return ''
+        ready, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        return self._emit(ready)
+
+    def flush(self):
+        ready, self._buffer = self._buffer, ''
+        return self._emit(ready).rstrip()
+
+
+def _build_prompt(user_message):
+    return f"{SYSTEM_PROMPT}\n\nCâu hỏi của học sinh: {user_message}"
+
+def _generate_answer(user_message):
+    # google-generativeai 0.3.2 không nhận request_options: hạn chót của lời gọi do gateway quản lý
+    response = gateway.call(get_model().generate_content, _build_prompt(user_message))
+    return remove_markdown_formatting(response.text)
+
+def answer(user_message):
+    """Trả lời một câu hỏi độc lập (có cache + gộp yêu cầu); lỗi từ API được ném ra."""
+    cache_key = normalize_prompt(user_message)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    clean_text = _coalescer.run(cache_key, lambda: _generate_answer(user_message))
+    response_cache.set(cache_key, clean_text)
+    return clean_text
 
 def chat_with_gemini(user_message):
     """
     Gửi tin nhắn đến Gemini AI và nhận phản hồi
+    Câu hỏi giống nhau (sau chuẩn hóa) được trả từ cache; các yêu cầu trùng đang chờ chỉ gọi API một lần.
     """
-    if not GEMINI_API_KEY:
-        return "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+    if not is_configured():
+        return NOT_CONFIGURED_MESSAGE
+
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        system_prompt = """
-        Bạn là trợ lý AI cho học sinh THPT ôn thi môn Tin học.
-        Nhiệm vụ của bạn là:
-        - Giải đáp thắc mắc về lập trình, thuật toán, cấu trúc dữ liệu
-        - Hướng dẫn học sinh giải bài tập tin học
-        - Giải thích các khái niệm tin học một cách dễ hiểu
-        - Trả lời bằng tiếng Việt, ngắn gọn và rõ ràng
-        
-        QUAN TRỌNG: Trả lời bằng văn bản thuần túy, KHÔNG sử dụng bất kỳ ký tự định dạng nào như:
-        - Dấu # cho tiêu đề
-        - Dấu ** hoặc * cho in đậm/nghiêng
-        - Dấu ``` cho code block
-        - Dấu ` cho inline code
-        Chỉ viết văn bản bình thường, dễ đọc.
-        """
-        
-        full_prompt = f"{system_prompt}\n\nCâu hỏi của học sinh: {user_message}"
-        
-        response = model.generate_content(full_prompt)
-        
-        clean_text = remove_markdown_formatting(response.text)
-        
-        return clean_text
-    
+        return answer(user_message)
+    except AIGatewayError as e:
+        return str(e)
     except Exception as e:
         return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
 
+def iter_clean_text(chunks):
+    """Bỏ Markdown cho từng chunk trả về từ API khi stream."""
+    cleaner = MarkdownStreamCleaner()
+    for chunk in chunks:
+        text = cleaner.feed(chunk.text)
+        if text:
+            yield text
+    text = cleaner.flush()
+    if text:
+        yield text
+
+def stream_answer(user_message):
+    """Như answer() nhưng trả về generator; câu trả lời đầy đủ được lưu vào cache."""
+    cache_key = normalize_prompt(user_message)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = _build_prompt(user_message)
+    chunks = gateway.stream(
+        lambda: get_model().generate_content(prompt, stream=True)
+    )
+    parts = []
+    for text in iter_clean_text(chunks):
+        parts.append(text)
+        yield text
+    response_cache.set(cache_key, ''.join(parts))
+
+def stream_chat_with_gemini(user_message):
+    """
+    Như chat_with_gemini nhưng trả về generator các đoạn văn bản (đã bỏ Markdown) ngay khi API sinh ra.
+    """
+    if not is_configured():
+        yield NOT_CONFIGURED_MESSAGE
+        return
+
+    try:
+        yield from stream_answer(user_message)
+    except AIGatewayError as e:
+        yield str(e)
+    except Exception as e:
+        yield f"Xin lỗi, có lỗi xảy ra: {str(e)}"
+
+def to_gemini_history(chat_history):
+    """Chuyển lịch sử [{'role': 'user'|'assistant', 'content'}] sang định dạng history của Gemini."""
+    return [
+        {'role': 'model' if msg['role'] == 'assistant' else 'user', 'parts': [msg['content']]}
+        for msg in chat_history
+        if msg.get('content')
+    ]
+
+def send_with_context(user_message, chat_history, stream=False):
+    """
+    Một lần gọi API duy nhất cho mỗi lượt: lịch sử (cả 2 vai) được truyền thẳng vào start_chat.
+    Khi stream=True trả về iterator các chunk (đã qua gateway).
+    """
+    history = CONTEXT_INSTRUCTION_HISTORY + to_gemini_history(chat_history)
+    chat = get_chat_model().start_chat(history=history)
+    if stream:
+        return gateway.stream(
+            lambda: chat.send_message(user_message, stream=True)
+        )
+    return gateway.call(chat.send_message, user_message)
+
 def chat_with_context(user_message, chat_history=[]):
     """
     Chat với context (lịch sử hội thoại)
     chat_history: [{'role': 'user', 'content': '...'}, {'role': 'assistant', 'content': '...'}]
     """
-    if not GEMINI_API_KEY:
-        return "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+    if not is_configured():
+        return NOT_CONFIGURED_MESSAGE
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config={
-                'temperature': 0.7,
-            },
-            system_instruction="""
-            Bạn là trợ lý AI cho học sinh THPT ôn thi môn Tin học.
-            Trả lời bằng văn bản thuần túy, KHÔNG sử dụng ký tự định dạng Markdown như #, **, *, ```.
-            Chỉ viết văn bản bình thường, dễ đọc.
-            """
-        )
-        
+        response = send_with_context(user_message, chat_history)
+        return remove_markdown_formatting(response.text)
+    except AIGatewayError as e:
+        return str(e)
+    except Exception as e:
+        return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
 
-        chat = model.start_chat(history=[])
-        
+def benchmark(total=200, concurrency=8, distinct=20):
+    """
+    Gửi `total` câu hỏi (xoay vòng trong `distinct` câu khác nhau) từ `concurrency` luồng qua chat_with_gemini,
+    đi qua đủ cache, gộp yêu cầu và gateway. Trả về thống kê độ trễ (giây) và số lần gọi backend.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-        for msg in chat_history:
-            if msg['role'] == 'user':
-                chat.send_message(msg['content'])
-        
+    questions = [f"Câu hỏi kiểm thử số {i}" for i in range(distinct)]
+    latencies = []
+    failures = 0
 
-        response = chat.send_message(user_message)
-        
+    def ask(i):
+        started = time.monotonic()
+        reply = chat_with_gemini(questions[i % distinct])
+        return time.monotonic() - started, reply.startswith("Xin lỗi")
 
-        clean_text = remove_markdown_formatting(response.text)
-        
-        return clean_text
-    
-    except Exception as e:
-        return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, failed in executor.map(ask, range(total)):
+            latencies.append(latency)
+            failures += failed
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    model = get_model()
+    return {
+        'backend': get_backend().name,
+        'requests': total,
+        'failures': failures,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(total / elapsed, 1) if elapsed else None,
+        'p50': round(latencies[len(latencies) // 2], 4),
+        'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4),
+        'max': round(latencies[-1], 4),
+        'backend_calls': getattr(model, 'calls', None),
+        'replay_misses': getattr(model, 'misses', None),
+        'gateway': gateway.status()
+    }
 
 # Test
 if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        # python -m utils.gemini_api bench [số yêu cầu] [số luồng] [số câu khác nhau]
+        args = [int(value) for value in sys.argv[2:5]]
+        print(json.dumps(benchmark(*args), ensure_ascii=False, indent=2))
+        sys.exit(0)
+
     print("=== Test chat_with_gemini ===")
     response1 = chat_with_gemini("Giải thích thuật toán sắp xếp nổi bọt")
     print(response1)
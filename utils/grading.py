@@ -0,0 +1,138 @@
+def normalize_answer_token(value):
+    if value is None:
+        return ''
+    token = str(value).strip()
+    if not token:
+        return ''
+    token = token.split('.')[0]
+    return token.strip().upper()
+
+def normalize_correct_answers(value):
+    if isinstance(value, list):
+        tokens = {normalize_answer_token(v) for v in value}
+        return {t for t in tokens if t}
+    token = normalize_answer_token(value)
+    return {token} if token else set()
+
+def format_correct_answer(value):
+    if isinstance(value, list):
+        return ', '.join(str(v).strip() for v in value if str(v).strip())
+    return str(value).strip()
+
+def calculate_tl2_score(mistakes_count):
+    if mistakes_count <= 0:
+        return 1.0
+    if mistakes_count == 1:
+        return 0.5
+    if mistakes_count == 2:
+        return 0.25
+    if mistakes_count == 3:
+        return 0.1
+    return 0.0
+
+# question_breakdown được lưu gọn theo thứ tự câu trong đề, mỗi câu một ký tự:
+#   t: loại câu ('s' = một đáp án, 't' = đúng/sai TL2)
+#   s: câu 's' là đáp án đã chọn ('-' = bỏ trống), câu 't' là số ý sai (0-9)
+#   c: điểm của câu theo BREAKDOWN_SCORE_CODES
+#   n: số thứ tự câu, chỉ có khi không phải 1..N
+# Đáp án dài hơn một ký tự thì 's' là danh sách thay vì chuỗi.
+BREAKDOWN_SCORE_CODES = {1.0: '1', 0.5: 'h', 0.25: 'q', 0.1: 't', 0.0: '0'}
+BREAKDOWN_SCORES = {code: score for score, code in BREAKDOWN_SCORE_CODES.items()}
+BREAKDOWN_TYPES = {'standard': 's', 'tl2': 't'}
+BREAKDOWN_TYPE_NAMES = {code: name for name, code in BREAKDOWN_TYPES.items()}
+
+def encode_breakdown(breakdown):
+    """Nén question_breakdown (danh sách dict); trả về None nếu có giá trị không biểu diễn gọn được."""
+    types, selections, scores, numbers = [], [], [], []
+    for item in breakdown:
+        question_type = BREAKDOWN_TYPES.get(item.get('type', 'standard'))
+        score_code = BREAKDOWN_SCORE_CODES.get(float(item.get('score', 0)))
+        if question_type is None or score_code is None:
+            return None
+        if question_type == 't':
+            mistakes = int(item.get('mistakes', 0))
+            if not 0 <= mistakes <= 9:
+                return None
+            selections.append(str(mistakes))
+        else:
+            selections.append(item.get('selected') or '-')
+        types.append(question_type)
+        scores.append(score_code)
+        numbers.append(item.get('question_number'))
+
+    packed = {'t': ''.join(types), 'c': ''.join(scores)}
+    packed['s'] = ''.join(selections) if all(len(value) == 1 for value in selections) else selections
+    if numbers != list(range(1, len(numbers) + 1)):
+        packed['n'] = numbers
+    return packed
+
+def iter_breakdown(packed):
+    """Duyệt (số câu, loại, lựa chọn, điểm) mà không dựng lại danh sách dict; lựa chọn câu TL2 là số ý sai."""
+    if not packed:
+        return
+    numbers = packed.get('n') or range(1, len(packed['t']) + 1)
+    for number, question_type, selected, score_code in zip(numbers, packed['t'], packed['s'], packed['c']):
+        if question_type == 't':
+            yield number, 'tl2', int(selected), BREAKDOWN_SCORES[score_code]
+        else:
+            yield number, 'standard', '' if selected == '-' else selected, BREAKDOWN_SCORES[score_code]
+
+def compile_answer_key(questions):
+    """Đáp án của đề theo thứ tự câu: (loại, tập đáp án đúng đã chuẩn hóa), dùng để chấm lại bài đã lưu."""
+    return [
+        (BREAKDOWN_TYPES.get(question.get('type', 'standard'), 's'),
+         frozenset(normalize_correct_answers(question.get('correct_answer'))))
+        for question in questions
+    ]
+
+def count_correct(answer_key, answers):
+    """Số câu một lựa chọn trả lời đúng; answers theo vị trí câu dạng chuỗi ('0', '1', ...), một lượt qua đáp án."""
+    correct = 0
+    for position, (_, correct_choices) in enumerate(answer_key):
+        user_choice = normalize_answer_token(answers.get(str(position), ''))
+        if user_choice and user_choice in correct_choices:
+            correct += 1
+    return correct
+
+def regrade_result(result, answer_key):
+    """
+    Chấm lại một bài đã lưu theo đáp án mới, dựa trên lựa chọn trong breakdown.
+    Câu TL2 chỉ lưu số ý sai nên giữ nguyên điểm cũ. Trả về các trường cần cập nhật,
+    None nếu điểm không đổi hoặc breakdown không khớp với đề (số câu, loại câu).
+    """
+    items = list(iter_breakdown(result['breakdown'])) if 'breakdown' in result else [
+        (item.get('question_number'), item.get('type', 'standard'),
+         item.get('mistakes', 0) if item.get('type') == 'tl2' else item.get('selected', ''),
+         float(item.get('score', 0)))
+        for item in result.get('question_breakdown', [])
+    ]
+    if not items or len(items) != len(answer_key):
+        return None
+
+    breakdown = []
+    changed = False
+    for (number, question_type, selected, score), (key_type, correct) in zip(items, answer_key):
+        if BREAKDOWN_TYPES.get(question_type) != key_type:
+            return None
+        if question_type == 'tl2':
+            breakdown.append({'question_number': number, 'type': 'tl2', 'score': score, 'mistakes': selected})
+            continue
+        new_score = 1.0 if selected and selected in correct else 0.0
+        changed = changed or new_score != score
+        breakdown.append({'question_number': number, 'type': 'standard', 'score': new_score, 'selected': selected})
+    if not changed:
+        return None
+
+    total_points = sum(item['score'] for item in breakdown)
+    total_questions = result.get('total_questions') or len(breakdown)
+    updates = {
+        'score': round((total_points / total_questions) * 10, 2),
+        'correct_count': sum(1 for item in breakdown if item['score'] >= 0.999),
+        'total_points': round(total_points, 2)
+    }
+    packed = encode_breakdown(breakdown) if 'breakdown' in result else None
+    if packed is not None:
+        updates['breakdown'] = packed
+    else:
+        updates['question_breakdown'] = breakdown
+    return updates
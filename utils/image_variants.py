@@ -0,0 +1,106 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Chưa cài Pillow: ảnh được giữ nguyên như khi tải lên
+    Image = None
+
+THUMBNAIL_MAX_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', '480'))
+WEB_MAX_SIZE = int(os.getenv('IMAGE_WEB_SIZE', '1600'))
+JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '82'))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    return Image is not None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='image-variants')
+    return _executor
+
+
+def read_dimensions(path: str) -> Optional[Dict]:
+    """Đọc kích thước ảnh (chỉ phần header, không giải nén ảnh); đã tính cả chiều xoay EXIF."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            orientation = image.getexif().get(0x0112)
+    except (OSError, ValueError):
+        return None
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return {'width': width, 'height': height}
+
+
+def _variant_path(path: str, name: str, extension: str) -> str:
+    return f'{os.path.splitext(path)[0]}.{name}.{extension}'
+
+
+def _save_variant(image, path: str, name: str, max_size: int) -> Optional[str]:
+    variant = image.copy()
+    variant.thumbnail((max_size, max_size), Image.LANCZOS)
+    # Ảnh có nền trong suốt giữ PNG, còn lại nén lại thành JPEG
+    if variant.mode in ('RGBA', 'LA') or 'transparency' in variant.info:
+        target = _variant_path(path, name, 'png')
+        variant.save(target, 'PNG', optimize=True)
+    else:
+        target = _variant_path(path, name, 'jpg')
+        variant.convert('RGB').save(target, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return target.replace('\\', '/')
+
+
+def build_variants(path: str) -> Optional[Dict]:
+    """
+    Tạo bản thu nhỏ (thumbnail) và bản cho web cạnh file gốc; bỏ qua ảnh động (GIF nhiều khung).
+    Bản cho web chỉ được giữ khi nhỏ hơn file gốc.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            if getattr(image, 'is_animated', False):
+                return None
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            variants = {
+                'width': image.width,
+                'height': image.height,
+                'thumbnail': _save_variant(image, path, 'thumb', THUMBNAIL_MAX_SIZE)
+            }
+            web = _save_variant(image, path, 'web', WEB_MAX_SIZE)
+            if os.path.getsize(web) < os.path.getsize(path):
+                variants['web'] = web
+            else:
+                os.remove(web)
+            return variants
+    except (OSError, ValueError):
+        return None
+
+
+def schedule_variants(attachments: Iterable[Dict], on_done: Callable[[str, Dict], None]) -> None:
+    """Tạo biến thể cho các ảnh đính kèm ở luồng nền; xong thì gọi on_done(đường dẫn gốc, thông tin biến thể)."""
+    if Image is None:
+        return
+
+    def process(path):
+        variants = build_variants(path)
+        if variants:
+            on_done(path, variants)
+
+    for attachment in attachments:
+        if attachment.get('type') == 'image' and not attachment.get('thumbnail'):
+            _get_executor().submit(process, attachment['path'])
@@ -0,0 +1,532 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, Optional
+
+from utils.database import Database
+from utils.exam_cache import (
+    get_cached_questions,
+    publish_upload,
+    questions_fingerprint,
+    store_cached_questions,
+    write_upload_temp,
+)
+from utils.exam_parser import (
+    ExamParseError,
+    build_exam_questions,
+    find_multiple_answer_questions,
+    parse_docx_exam,
+)
+from utils.question_index import QuestionIndex
+
+IMPORT_JOBS_DB = os.getenv('IMPORT_JOBS_DB', 'data/import_jobs.sqlite3')
+IMPORT_JOB_WORKERS = int(os.getenv('IMPORT_JOB_WORKERS', '2'))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+BATCH_MAX_MEMBERS = int(os.getenv('IMPORT_BATCH_MAX_FILES', '100'))
+BATCH_MEMBER_MAX_SIZE = 20 * 1024 * 1024
+
+# Phần trăm tiến độ dành cho bước đọc file, phần còn lại cho kiểm tra + lưu đề
+PARSE_PROGRESS_SHARE = 80
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_database: Optional[Database] = None
+
+
+def _connect():
+    os.makedirs(os.path.dirname(IMPORT_JOBS_DB) or '.', exist_ok=True)
+    conn = sqlite3.connect(IMPORT_JOBS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            progress INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            exam_id TEXT,
+            payload TEXT NOT NULL,
+            result TEXT,
+            created_by TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        '''
+    )
+    return conn
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def create_job(payload: Dict, created_by: Optional[str]) -> str:
+    """Tạo bản ghi job ở trạng thái chờ xử lý."""
+    job_id = uuid.uuid4().hex
+    timestamp = _now()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(
+                'INSERT INTO import_jobs (id, status, progress, message, payload, created_by, created_at, updated_at) '
+                'VALUES (?, ?, 0, ?, ?, ?, ?, ?)',
+                (job_id, STATUS_QUEUED, 'Đang chờ xử lý', json.dumps(payload, ensure_ascii=False),
+                 created_by, timestamp, timestamp)
+            )
+    finally:
+        conn.close()
+    return job_id
+
+
+def update_job(job_id: str, **fields) -> None:
+    if 'result' in fields and fields['result'] is not None:
+        fields['result'] = json.dumps(fields['result'], ensure_ascii=False)
+    fields['updated_at'] = _now()
+    columns = ', '.join(f'{key} = ?' for key in fields)
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(f'UPDATE import_jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+    finally:
+        conn.close()
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """Lấy trạng thái job (không kèm payload nội bộ)."""
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    job = dict(row)
+    job.pop('payload', None)
+    job['result'] = json.loads(job['result']) if job.get('result') else {}
+    return job
+
+
+def _load_payload(job_id: str) -> Dict:
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT payload FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row['payload']) if row else {}
+
+
+def _update_payload(conn, job_id: str, update) -> None:
+    row = conn.execute('SELECT payload FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    if row:
+        payload = json.loads(row['payload'])
+        update(payload)
+        conn.execute('UPDATE import_jobs SET payload = ? WHERE id = ?',
+                     (json.dumps(payload, ensure_ascii=False), job_id))
+
+
+def store_upload(job_id: str, file_storage, folder: str, extension: str = 'docx', primary: bool = False):
+    """
+    Lưu file upload theo nội dung và ghi tham chiếu của job tới file đó (payload['uploads']).
+    File chỉ xuất hiện dưới tên <sha256> bên trong cùng transaction ghi với _release_upload, nên job khác
+    không thể xóa mất file trước khi tham chiếu được ghi. primary: đây là file chính của job (file_path).
+    Trả về (đường dẫn, sha256).
+    """
+    temp_path, sha256 = write_upload_temp(file_storage, folder)
+
+    def add_reference(payload):
+        payload['uploads'] = payload.get('uploads', []) + [file_path]
+        if primary:
+            payload.update(file_path=file_path, sha256=sha256)
+
+    conn = _connect()
+    try:
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        file_path = publish_upload(temp_path, folder, sha256, extension)
+        _update_payload(conn, job_id, add_reference)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+        _remove_upload(temp_path)
+    return file_path, sha256
+
+
+def _release_upload(job_id: Optional[str], file_path: Optional[str]) -> None:
+    """
+    Job không cần file upload nữa. File lưu theo nội dung nên nhiều job có thể dùng chung một file:
+    chỉ xóa khi không còn job đang chờ/đang chạy nào giữ tham chiếu tới nó.
+    """
+    if job_id is None or not file_path:
+        _remove_upload(file_path)
+        return
+    conn = _connect()
+    try:
+        conn.isolation_level = None
+        # Bỏ tham chiếu và kiểm tra trong cùng một transaction ghi để hai job không cùng tưởng file còn người dùng
+        conn.execute('BEGIN IMMEDIATE')
+
+        def drop_reference(payload):
+            uploads = payload.get('uploads', [])
+            if file_path in uploads:
+                uploads.remove(file_path)
+
+        _update_payload(conn, job_id, drop_reference)
+        in_use = conn.execute(
+            "SELECT 1 FROM import_jobs AS job, json_each(job.payload, '$.uploads') AS upload "
+            'WHERE job.status IN (?, ?) AND upload.value = ? LIMIT 1',
+            (STATUS_QUEUED, STATUS_RUNNING, file_path)
+        ).fetchone()
+        if in_use is None:
+            _remove_upload(file_path)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max(1, IMPORT_JOB_WORKERS))
+        return _executor
+
+
+def _get_database() -> Database:
+    # Một Database cho mỗi process để chỉ mục (câu hỏi, hash đề, ...) được giữ giữa các job
+    global _database
+    if _database is None:
+        _database = Database()
+    return _database
+
+
+def _on_job_finished(job_id: str, future) -> None:
+    # Worker chết giữa chừng (BrokenProcessPool, ...) thì job vẫn phải kết thúc
+    exc = future.exception()
+    if exc is not None:
+        update_job(job_id, status=STATUS_FAILED, message=f'Lỗi không xác định khi xử lý file: {exc}')
+
+
+def create_import_job(exam_meta: Dict, created_by: Optional[str], kind: Optional[str] = None) -> str:
+    """
+    Tạo job import ở trạng thái chờ, trước khi lưu file (xem store_upload).
+    exam_meta: grade, title, description, time_limit, allow_multiple, created_by_name
+    """
+    payload = dict(exam_meta, created_by=created_by, uploads=[])
+    if kind:
+        payload['kind'] = kind
+    return create_job(payload, created_by)
+
+
+def abandon_import_job(job_id: str, message: str) -> None:
+    """Job không được đưa vào hàng đợi: đánh dấu thất bại và trả lại các file upload nó đang giữ."""
+    update_job(job_id, status=STATUS_FAILED, message=message)
+    for file_path in _load_payload(job_id).get('uploads', []):
+        _release_upload(job_id, file_path)
+
+
+def enqueue_import_job(job_id: str) -> str:
+    """Đưa job import một file đề (đã có file qua store_upload) vào hàng đợi của process pool."""
+    # File đã từng được import thì job lấy câu hỏi từ cache nên xong rất nhanh, nhưng vẫn chạy trong worker
+    future = _get_executor().submit(run_import_job, job_id)
+    future.add_done_callback(lambda f: _on_job_finished(job_id, f))
+    return job_id
+
+
+def build_exam_record(payload: Dict, questions, allow_multiple_answers: bool,
+                      questions_hash: Optional[str] = None) -> Dict:
+    grade = payload['grade']
+    return {
+        'id': f"exam_{grade}_{uuid.uuid4().hex[:6]}",
+        'title': payload['title'],
+        'description': payload.get('description', ''),
+        'time_limit': payload['time_limit'],
+        'questions': questions,
+        'questions_hash': questions_hash or questions_fingerprint(questions),
+        'allow_multiple_answers': allow_multiple_answers,
+        'created_by': payload.get('created_by'),
+        'created_by_name': payload.get('created_by_name'),
+        'created_at': _now()
+    }
+
+
+def _remove_upload(file_path: Optional[str]) -> None:
+    try:
+        os.remove(file_path)
+    except (OSError, TypeError):
+        pass
+
+
+class MultipleAnswersNotAllowed(ExamParseError):
+    """Đề có câu nhiều đáp án đúng nhưng giáo viên chưa bật tùy chọn cho phép."""
+
+    def __init__(self, question_numbers):
+        self.question_numbers = question_numbers
+        question_list = ', '.join(str(num) for num in question_numbers[:5])
+        more_suffix = '...' if len(question_numbers) > 5 else ''
+        super().__init__(
+            f'Đề thi có các câu {question_list}{more_suffix} được đánh dấu nhiều đáp án đúng. '
+            'Vui lòng bật tùy chọn "Cho phép nhiều đáp án đúng" trước khi import.'
+        )
+
+    def __reduce__(self):
+        # Để ngoại lệ giữ nguyên khi trả về từ process worker
+        return (self.__class__, (self.question_numbers,))
+
+
+def load_exam_questions(file_path: str, sha256: Optional[str], allow_multiple: bool,
+                        on_progress=None, job_id: Optional[str] = None) -> Dict:
+    """
+    Lấy bộ câu hỏi đã kiểm tra của một file đề (từ cache nếu có, nếu không thì parse một lượt).
+    Trả về dict: questions, allow_multiple_answers, questions_hash, from_cache.
+    Sau khi xử lý, job_id bỏ tham chiếu tới file upload (xem _release_upload).
+    """
+    cached = get_cached_questions(sha256, allow_multiple)
+    if cached:
+        _release_upload(job_id, file_path)
+        return dict(cached, from_cache=True)
+
+    try:
+        # Luôn đọc ở chế độ nhiều đáp án rồi tự phát hiện câu có nhiều đáp án,
+        # tránh phải đọc lại file khi gặp lỗi "nhiều đáp án đúng"
+        parsed_questions = parse_docx_exam(file_path, allow_multiple_answers=True, on_progress=on_progress)
+    except ExamParseError as exc:
+        # Một job khác cùng nội dung có thể vừa parse xong và xóa file
+        cached = get_cached_questions(sha256, allow_multiple)
+        _release_upload(job_id, file_path)
+        if cached:
+            return dict(cached, from_cache=True)
+        raise ExamParseError(f'Lỗi khi đọc file đề: {exc}') from exc
+    except Exception:
+        _release_upload(job_id, file_path)
+        raise
+
+    try:
+        questions_with_multiple = find_multiple_answer_questions(parsed_questions)
+        if questions_with_multiple and not allow_multiple:
+            raise MultipleAnswersNotAllowed(questions_with_multiple)
+
+        questions, has_tl2_question = build_exam_questions(parsed_questions)
+        allow_multiple_answers = bool(questions_with_multiple or has_tl2_question)
+        store_cached_questions(sha256, allow_multiple, questions, allow_multiple_answers)
+    finally:
+        # Xóa sau khi ghi cache để job khác cùng nội dung luôn thấy file hoặc cache
+        _release_upload(job_id, file_path)
+    return {
+        'questions': questions,
+        'allow_multiple_answers': allow_multiple_answers,
+        'questions_hash': questions_fingerprint(questions),
+        'from_cache': False
+    }
+
+
+def run_import_job(job_id: str) -> None:
+    """Chạy trong process worker: đọc file một lượt, kiểm tra và lưu đề vào ngân hàng."""
+    payload = _load_payload(job_id)
+    update_job(job_id, status=STATUS_RUNNING, progress=0, message='Đang đọc file đề')
+
+    last_reported = {'percent': 0}
+
+    def report_parse_progress(done, total):
+        percent = int(done * PARSE_PROGRESS_SHARE / total) if total else PARSE_PROGRESS_SHARE
+        if percent - last_reported['percent'] >= 5:
+            last_reported['percent'] = percent
+            update_job(job_id, progress=percent)
+
+    try:
+        entry = load_exam_questions(payload.get('file_path'), payload.get('sha256'),
+                                    bool(payload.get('allow_multiple')), on_progress=report_parse_progress,
+                                    job_id=job_id)
+    except MultipleAnswersNotAllowed as exc:
+        update_job(job_id, status=STATUS_FAILED, message=str(exc),
+                   result={'needs_multiple': True, 'questions_with_multiple': exc.question_numbers})
+        return
+    except ExamParseError as exc:
+        update_job(job_id, status=STATUS_FAILED, message=str(exc))
+        return
+    except Exception as exc:
+        update_job(job_id, status=STATUS_FAILED, message=f'Lỗi không xác định khi xử lý file: {exc}')
+        return
+
+    update_job(job_id, progress=PARSE_PROGRESS_SHARE, message='Đang lưu đề thi')
+
+    db = _get_database()
+    exam_record = build_exam_record(payload, entry['questions'], entry['allow_multiple_answers'],
+                                    entry.get('questions_hash'))
+    duplicates = db.find_exams_by_questions_hash(exam_record['questions_hash'])
+    similar_questions = [] if duplicates else db.get_question_index().match_exam(entry['questions'])
+
+    try:
+        db.add_exam(payload['grade'], exam_record)
+    except Exception as exc:
+        update_job(job_id, status=STATUS_FAILED, message=f'Không thể lưu đề thi: {exc}')
+        return
+
+    question_count = len(entry['questions'])
+    message = f'Đã tạo đề thi "{payload["title"]}" với {question_count} câu hỏi cho khối {payload["grade"]}.'
+    if duplicates:
+        titles = ', '.join(f'"{item["title"]}" (khối {item["grade"]})' for item in duplicates[:3])
+        message += f' Lưu ý: bộ câu hỏi trùng hoàn toàn với đề {titles}.'
+    elif similar_questions:
+        numbers = ', '.join(str(item['number']) for item in similar_questions[:5])
+        more_suffix = '...' if len(similar_questions) > 5 else ''
+        message += (f' Lưu ý: {len(similar_questions)} câu ({numbers}{more_suffix}) gần trùng với câu đã có '
+                    'trong ngân hàng, xem báo cáo câu hỏi trùng.')
+
+    update_job(
+        job_id,
+        status=STATUS_DONE,
+        progress=100,
+        exam_id=exam_record['id'],
+        message=message,
+        result={
+            'question_count': question_count,
+            'grade': payload['grade'],
+            'from_cache': entry['from_cache'],
+            'duplicate_of': duplicates,
+            'similar_questions': similar_questions
+        }
+    )
+
+
+def _batch_member_title(payload: Dict, member_name: str) -> str:
+    stem = os.path.splitext(os.path.basename(member_name))[0].replace('_', ' ').strip()
+    prefix = payload.get('title', '').strip()
+    return f'{prefix} - {stem}' if prefix else stem
+
+
+def enqueue_batch_import_job(job_id: str, db: Database) -> str:
+    """
+    Import nhiều đề từ một file .zip chứa các file .docx (job tạo bằng create_import_job(..., kind='batch')).
+    Các file được parse song song trên process pool, đề hợp lệ được ghi vào ngân hàng trong một lần.
+    Luồng điều phối chạy trong web process nên dùng chính `db` của app (chung khóa ghi và chỉ mục).
+    """
+    worker = threading.Thread(target=_run_batch_job_safely, args=(job_id, db), daemon=True)
+    worker.start()
+    return job_id
+
+
+def _run_batch_job_safely(job_id: str, db: Database) -> None:
+    try:
+        run_batch_import_job(job_id, db)
+    except Exception as exc:
+        update_job(job_id, status=STATUS_FAILED, message=f'Lỗi không xác định khi xử lý file: {exc}')
+
+
+def _extract_batch_members(job_id: str, zip_path: str, folder: str):
+    members = []
+    errors = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            base_name = os.path.basename(name)
+            if info.is_dir() or not base_name or name.startswith('__MACOSX/') or base_name.startswith('~$'):
+                continue
+            if not base_name.lower().endswith('.docx'):
+                errors.append({'file': name, 'message': 'Bỏ qua: chỉ hỗ trợ file .docx.'})
+                continue
+            if info.file_size > BATCH_MEMBER_MAX_SIZE:
+                errors.append({'file': name, 'message': 'Bỏ qua: file quá lớn.'})
+                continue
+            if len(members) >= BATCH_MAX_MEMBERS:
+                errors.append({'file': name, 'message': f'Bỏ qua: mỗi lần chỉ import tối đa {BATCH_MAX_MEMBERS} file.'})
+                continue
+            with archive.open(info) as member_stream:
+                # Ghi tham chiếu ngay khi giải nén để job khác không xóa mất file trước khi parse
+                file_path, sha256 = store_upload(job_id, member_stream, folder)
+            members.append({'position': len(members), 'name': name, 'file_path': file_path, 'sha256': sha256})
+    return members, errors
+
+
+def run_batch_import_job(job_id: str, db: Database) -> None:
+    payload = _load_payload(job_id)
+    zip_path = payload.get('file_path')
+    allow_multiple = bool(payload.get('allow_multiple'))
+    update_job(job_id, status=STATUS_RUNNING, progress=0, message='Đang giải nén file .zip')
+
+    try:
+        members, errors = _extract_batch_members(job_id, zip_path, os.path.dirname(zip_path))
+    except zipfile.BadZipFile:
+        update_job(job_id, status=STATUS_FAILED, message='File .zip không hợp lệ.')
+        return
+    finally:
+        _release_upload(job_id, zip_path)
+
+    if not members:
+        update_job(job_id, status=STATUS_FAILED, message='Không tìm thấy file .docx nào trong file .zip.',
+                   result={'errors': errors, 'created': []})
+        return
+
+    update_job(job_id, message=f'Đang đọc {len(members)} file đề')
+    executor = _get_executor()
+    futures = {
+        executor.submit(load_exam_questions, member['file_path'], member['sha256'], allow_multiple,
+                        job_id=job_id): member
+        for member in members
+    }
+
+    parsed = []
+    for done_count, future in enumerate(as_completed(futures), start=1):
+        member = futures[future]
+        try:
+            parsed.append((member['position'], member, future.result()))
+        except ExamParseError as exc:
+            errors.append({'file': member['name'], 'message': str(exc)})
+        except Exception as exc:
+            errors.append({'file': member['name'], 'message': f'Lỗi không xác định khi xử lý file: {exc}'})
+        update_job(job_id, progress=int(done_count * PARSE_PROGRESS_SHARE / len(members)))
+
+    # Giữ thứ tự đề theo thứ tự file trong .zip
+    parsed.sort(key=lambda item: item[0])
+    hash_index = db.get_questions_hash_index()
+    question_index = db.get_question_index()
+    # Câu gần trùng giữa các file trong cùng .zip được so qua chỉ mục riêng của lô
+    batch_index = QuestionIndex()
+    records = []
+    created = []
+    for _, member, entry in parsed:
+        member_payload = dict(payload, title=_batch_member_title(payload, member['name']))
+        record = build_exam_record(member_payload, entry['questions'], entry['allow_multiple_answers'],
+                                   entry.get('questions_hash'))
+        records.append(record)
+        similar_numbers = {
+            item['number']
+            for index in (question_index, batch_index)
+            for item in index.match_exam(record['questions'])
+        }
+        batch_index.add_exam(payload['grade'], record)
+        created.append({
+            'file': member['name'],
+            'exam_id': record['id'],
+            'title': record['title'],
+            'question_count': len(record['questions']),
+            'duplicate_of': list(hash_index.get(record['questions_hash'], [])),
+            'similar_count': len(similar_numbers)
+        })
+        hash_index.setdefault(record['questions_hash'], []).append(
+            {'grade': payload['grade'], 'id': record['id'], 'title': record['title']}
+        )
+
+    try:
+        db.add_exams(payload['grade'], records)
+    except Exception as exc:
+        update_job(job_id, status=STATUS_FAILED, message=f'Không thể lưu đề thi: {exc}',
+                   result={'errors': errors, 'created': []})
+        return
+
+    update_job(
+        job_id,
+        status=STATUS_DONE if records else STATUS_FAILED,
+        progress=100,
+        message=f'Đã tạo {len(records)}/{len(members)} đề thi cho khối {payload["grade"]}.',
+        result={'grade': payload['grade'], 'created': created, 'errors': errors}
+    )
@@ -0,0 +1,266 @@
+import math
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # Không có NumPy thì cộng dồn từng bài bằng Python, kết quả như nhau
+    np = None
+
+from utils.grading import BREAKDOWN_SCORES, iter_breakdown, normalize_answer_token, normalize_correct_answers
+
+# Ngưỡng đánh dấu câu hỏi cần giáo viên xem lại
+HARD_P_VALUE = 0.2
+EASY_P_VALUE = 0.9
+LOW_DISCRIMINATION = 0.2
+BLANK = '-'
+
+
+def _iter_items(result):
+    """(số câu, loại, lựa chọn, điểm) theo thứ tự câu trong đề, cho cả bản nén lẫn bản cũ."""
+    if 'breakdown' in result:
+        yield from iter_breakdown(result['breakdown'])
+        return
+    for item in result.get('question_breakdown', []):
+        question_type = item.get('type', 'standard')
+        selected = item.get('mistakes', 0) if question_type == 'tl2' else item.get('selected', '')
+        yield item.get('question_number'), question_type, selected, float(item.get('score', 0))
+
+
+def _result_key(result):
+    # Bài được chấm lại giữ id cũ nhưng có regraded_ts mới, nên được tính như một bài khác
+    return result.get('id'), result.get('regraded_ts')
+
+
+class ExamStats:
+    """
+    Thống kê đủ (tổng, tổng bình phương, tổng tích với điểm bài) của một đề, theo vị trí câu.
+    Từ các tổng này tính được độ khó, hệ số tương quan điểm câu - điểm phần còn lại và độ tin cậy,
+    nên thêm một bài nộp chỉ tốn O(số câu) thay vì đọc lại toàn bộ kết quả.
+    Bài nộp trên đề cũ có ít câu hơn được tính 0 điểm cho các câu thiếu.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.result_ids = set()
+        self.sum_total = 0.0
+        self.sum_total_sq = 0.0
+        self.numbers: List = []
+        self.types: List[str] = []
+        self.sum_x: List[float] = []
+        self.sum_x2: List[float] = []
+        self.sum_xy: List[float] = []
+        self.options: List[Counter] = []
+
+    def _ensure(self, size: int) -> None:
+        while len(self.sum_x) < size:
+            self.numbers.append(None)
+            self.types.append('standard')
+            self.sum_x.append(0.0)
+            self.sum_x2.append(0.0)
+            self.sum_xy.append(0.0)
+            self.options.append(Counter())
+
+    def add(self, result: Dict) -> None:
+        items = list(_iter_items(result))
+        total = sum(item[3] for item in items)
+        self._ensure(len(items))
+        for position, (number, question_type, selected, score) in enumerate(items):
+            if self.numbers[position] is None:
+                self.numbers[position] = number
+                self.types[position] = question_type
+            self.sum_x[position] += score
+            self.sum_x2[position] += score * score
+            self.sum_xy[position] += score * total
+            if question_type != 'tl2':
+                self.options[position][selected or BLANK] += 1
+        self.count += 1
+        self.sum_total += total
+        self.sum_total_sq += total * total
+        self.result_ids.add(_result_key(result))
+
+    @classmethod
+    def build(cls, results: List[Dict]) -> 'ExamStats':
+        stats = cls()
+        if not stats._build_vectorized(results):
+            for result in results:
+                stats.add(result)
+        return stats
+
+    def _build_vectorized(self, results: List[Dict]) -> bool:
+        """
+        Dựng một lượt bằng NumPy khi mọi bài đều ở dạng nén, cùng bộ câu và đáp án một ký tự ASCII:
+        ghép chuỗi điểm/lựa chọn của tất cả bài thành ma trận (số bài x số câu) rồi cộng theo cột.
+        """
+        if np is None or not results:
+            return False
+        packed = [result.get('breakdown') for result in results]
+        if any(not item or not isinstance(item.get('s'), str) or 'n' in item for item in packed):
+            return False
+        types = packed[0]['t']
+        if any(item['t'] != types for item in packed):
+            return False
+        try:
+            score_codes = ''.join(item['c'] for item in packed).encode('ascii')
+            selection_codes = ''.join(item['s'] for item in packed).encode('ascii')
+        except UnicodeEncodeError:
+            return False
+        rows, width = len(packed), len(types)
+        if len(score_codes) != rows * width or len(selection_codes) != rows * width:
+            return False
+
+        lookup = np.zeros(256)
+        for code, score in BREAKDOWN_SCORES.items():
+            lookup[ord(code)] = score
+        scores = lookup[np.frombuffer(score_codes, dtype=np.uint8).reshape(rows, width)]
+        selections = np.frombuffer(selection_codes, dtype=np.uint8).reshape(rows, width)
+        totals = scores.sum(axis=1)
+
+        self._ensure(width)
+        self.numbers = list(range(1, width + 1))
+        self.types = ['tl2' if code == 't' else 'standard' for code in types]
+        self.sum_x = scores.sum(axis=0).tolist()
+        self.sum_x2 = (scores * scores).sum(axis=0).tolist()
+        self.sum_xy = (scores.T @ totals).tolist()
+        standard_columns = np.array([code != 't' for code in types])
+        for value in np.unique(selections[:, standard_columns]) if standard_columns.any() else []:
+            column_counts = ((selections == value) & standard_columns).sum(axis=0)
+            for position in np.nonzero(column_counts)[0]:
+                self.options[position][chr(value)] = int(column_counts[position])
+        self.count = rows
+        self.sum_total = float(totals.sum())
+        self.sum_total_sq = float((totals * totals).sum())
+        self.result_ids = {_result_key(result) for result in results}
+        return True
+
+    def _discrimination(self, position: int) -> Optional[float]:
+        # Tương quan điểm câu với điểm các câu còn lại (point-biserial đã hiệu chỉnh)
+        n = self.count
+        sx, sxx, sxy = self.sum_x[position], self.sum_x2[position], self.sum_xy[position]
+        sy = self.sum_total - sx
+        syy = self.sum_total_sq - 2 * sxy + sxx
+        rest_xy = sxy - sxx
+        denominator = (n * sxx - sx * sx) * (n * syy - sy * sy)
+        if n < 2 or denominator <= 1e-12:
+            return None
+        return (n * rest_xy - sx * sy) / math.sqrt(denominator)
+
+    def reliability(self) -> Optional[float]:
+        """Hệ số tin cậy KR-20 / Cronbach's alpha của cả đề."""
+        n, width = self.count, len(self.sum_x)
+        if n < 2 or width < 2:
+            return None
+        total_variance = self.sum_total_sq / n - (self.sum_total / n) ** 2
+        if total_variance <= 1e-12:
+            return None
+        item_variance = sum(sxx / n - (sx / n) ** 2 for sx, sxx in zip(self.sum_x, self.sum_x2))
+        return width / (width - 1) * (1 - item_variance / total_variance)
+
+    def question_stats(self, questions: Iterable[Dict] = ()) -> List[Dict]:
+        questions = list(questions)
+        stats = []
+        for position in range(len(self.sum_x)):
+            question = questions[position] if position < len(questions) else {}
+            p_value = self.sum_x[position] / self.count if self.count else None
+            discrimination = self._discrimination(position)
+            entry = {
+                'position': position,
+                'number': question.get('number', self.numbers[position]),
+                'question': question.get('question', ''),
+                'type': self.types[position],
+                'p_value': p_value,
+                'discrimination': discrimination,
+                'options': self._option_distribution(position, question),
+                'flags': []
+            }
+            if p_value is not None and self.count:
+                if p_value < HARD_P_VALUE:
+                    entry['flags'].append('Quá khó')
+                elif p_value > EASY_P_VALUE:
+                    entry['flags'].append('Quá dễ')
+            if discrimination is not None and discrimination < LOW_DISCRIMINATION:
+                entry['flags'].append('Phân loại kém')
+            if discrimination is not None and discrimination < 0 and self._distractor_beats_key(entry['options']):
+                entry['flags'].append('Nghi sai đáp án')
+            stats.append(entry)
+        return stats
+
+    def _option_distribution(self, position: int, question: Dict) -> List[Dict]:
+        if self.types[position] == 'tl2':
+            return []
+        counts = self.options[position]
+        keys = [normalize_answer_token(key) for key in (question.get('options') or {})]
+        keys += sorted(key for key in counts if key not in keys and key != BLANK)
+        correct = normalize_correct_answers(question.get('correct_answer'))
+        distribution = [
+            {'key': key, 'count': counts.get(key, 0), 'is_correct': key in correct}
+            for key in keys
+        ]
+        distribution.append({'key': BLANK, 'count': counts.get(BLANK, 0), 'is_correct': False})
+        for option in distribution:
+            option['ratio'] = option['count'] / self.count if self.count else 0
+        return distribution
+
+    @staticmethod
+    def _distractor_beats_key(options: List[Dict]) -> bool:
+        key_count = max((option['count'] for option in options if option['is_correct']), default=0)
+        return any(
+            option['count'] > key_count
+            for option in options
+            if not option['is_correct'] and option['key'] != BLANK
+        )
+
+
+class ItemAnalysis:
+    """
+    Thống kê câu hỏi theo từng đề, giữ trong bộ nhớ và cập nhật dần:
+    bài nộp mới chỉ được cộng thêm; bài bị xóa/chấm lại thì dựng lại thống kê của đề đó.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._stats: Dict[tuple, ExamStats] = {}
+        self._lock = threading.Lock()
+
+    def get_stats(self, grade, exam_id) -> ExamStats:
+        key = (str(grade), exam_id)
+        results = self.db.get_exam_results(grade, exam_id)
+        result_ids = {_result_key(result) for result in results}
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None or not stats.result_ids <= result_ids:
+                stats = ExamStats.build(results)
+            else:
+                # Bài do process khác ghi thêm
+                for result in results:
+                    if _result_key(result) not in stats.result_ids:
+                        stats.add(result)
+            self._stats[key] = stats
+        return stats
+
+    def record_result(self, result: Dict) -> None:
+        """Gọi sau khi lưu bài nộp: cộng ngay vào thống kê đang có của đề (nếu đã được dựng)."""
+        key = (str(result.get('grade')), result.get('exam_id'))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is not None and _result_key(result) not in stats.result_ids:
+                stats.add(result)
+
+    def invalidate(self, grade=None, exam_id=None) -> None:
+        with self._lock:
+            if grade is None:
+                self._stats.clear()
+            else:
+                self._stats.pop((str(grade), exam_id), None)
+
+    def analyze(self, grade, exam: Dict) -> Dict:
+        stats = self.get_stats(grade, exam.get('id'))
+        questions = exam.get('questions', [])
+        return {
+            'count': stats.count,
+            'mean_points': stats.sum_total / stats.count if stats.count else None,
+            'max_points': len(questions),
+            'reliability': stats.reliability(),
+            'questions': stats.question_stats(questions)
+        }
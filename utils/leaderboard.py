@@ -0,0 +1,129 @@
+import threading
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional
+
+# Số người hiển thị trên bảng xếp hạng và số khoảng điểm (thang 10) của biểu đồ phân bố
+LEADERBOARD_SIZE = 20
+HISTOGRAM_BUCKETS = 10
+MAX_SCORE = 10.0
+
+
+def _bucket(score: float) -> int:
+    position = int(score / MAX_SCORE * HISTOGRAM_BUCKETS)
+    return min(max(position, 0), HISTOGRAM_BUCKETS - 1)
+
+
+def _rank_key(entry: Dict) -> tuple:
+    # Điểm cao hơn xếp trước; bằng điểm thì làm nhanh hơn, rồi nộp sớm hơn xếp trước
+    return (-entry['score'], entry['time_spent_seconds'], entry['submitted_ts'], entry['user_id'])
+
+
+class ExamLeaderboard:
+    """
+    Bảng xếp hạng một đề: mỗi học sinh chỉ giữ lần làm tốt nhất.
+    Danh sách khóa xếp hạng luôn được giữ đã sắp xếp nên lấy top K là O(K), tìm hạng là O(log n).
+    """
+
+    def __init__(self):
+        self.best: Dict[str, Dict] = {}
+        self.ranking: List[tuple] = []
+        self.attempts = 0
+        self.attempt_histogram = [0] * HISTOGRAM_BUCKETS
+        self.best_histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, result: Dict) -> None:
+        entry = {
+            'user_id': str(result.get('user_id')),
+            'username': result.get('username', ''),
+            'score': float(result.get('score') or 0),
+            'time_spent_seconds': int(result.get('time_spent_seconds') or 0),
+            'submitted_ts': float(result.get('submitted_ts') or 0),
+            'submitted_at': result.get('submitted_at', ''),
+            'result_id': result.get('id')
+        }
+        self.attempts += 1
+        self.attempt_histogram[_bucket(entry['score'])] += 1
+
+        current = self.best.get(entry['user_id'])
+        if current is not None:
+            if _rank_key(current) <= _rank_key(entry):
+                return
+            old_key = _rank_key(current)
+            del self.ranking[bisect_left(self.ranking, old_key)]
+            self.best_histogram[_bucket(current['score'])] -= 1
+        self.best[entry['user_id']] = entry
+        insort(self.ranking, _rank_key(entry))
+        self.best_histogram[_bucket(entry['score'])] += 1
+
+    def top(self, limit: int = LEADERBOARD_SIZE) -> List[Dict]:
+        return [dict(self.best[key[3]], rank=position + 1) for position, key in enumerate(self.ranking[:limit])]
+
+    def rank_of(self, user_id) -> Optional[Dict]:
+        entry = self.best.get(str(user_id))
+        if entry is None:
+            return None
+        return dict(entry, rank=bisect_left(self.ranking, _rank_key(entry)) + 1)
+
+    def histogram(self) -> List[Dict]:
+        width = MAX_SCORE / HISTOGRAM_BUCKETS
+        return [
+            {
+                'low': round(index * width, 2),
+                'high': round((index + 1) * width, 2),
+                'best': self.best_histogram[index],
+                'attempts': self.attempt_histogram[index]
+            }
+            for index in range(HISTOGRAM_BUCKETS)
+        ]
+
+
+class Leaderboards:
+    """
+    Bảng xếp hạng của mọi đề, dựng một lượt từ log kết quả rồi cập nhật dần khi có bài nộp mới.
+    Log kết quả bị ghi lại từ ngoài (process khác xóa đề, chấm lại, ...) thì dựng lại toàn bộ.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._boards: Dict[tuple, ExamLeaderboard] = {}
+        self._source = None
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    def _add(self, result: Dict) -> None:
+        key = (str(result.get('grade')), result.get('exam_id'))
+        board = self._boards.get(key)
+        if board is None:
+            board = self._boards[key] = ExamLeaderboard()
+        board.add(result)
+
+    def rebuild(self) -> int:
+        """Tính lại toàn bộ từ log kết quả; trả về số bài đã duyệt."""
+        with self._lock:
+            results = self.db.get_all_exam_results()
+            self._boards = {}
+            for result in results:
+                self._add(result)
+            self._source = results
+            self._seen = len(results)
+            return self._seen
+
+    def refresh(self) -> None:
+        """Cộng các bài nộp mới (đã được Database nối vào cuối log) vào bảng xếp hạng."""
+        results = self.db.get_all_exam_results()
+        if results is not self._source:
+            self.rebuild()
+            return
+        if len(results) > self._seen:
+            with self._lock:
+                for result in results[self._seen:]:
+                    self._add(result)
+                self._seen = len(results)
+
+    def get(self, grade, exam_id) -> ExamLeaderboard:
+        self.refresh()
+        return self._boards.get((str(grade), exam_id)) or ExamLeaderboard()
+
+    def boards(self) -> Dict[tuple, ExamLeaderboard]:
+        self.refresh()
+        return dict(self._boards)
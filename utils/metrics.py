@@ -0,0 +1,267 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+from flask import Response, g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# Request chậm hơn ngưỡng này (giây) được ghi log kèm phân rã thời gian; SAMPLE_RATE = tỉ lệ được ghi
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv('SLOW_REQUEST_SAMPLE_RATE', '1'))
+# Đặt token thì /metrics yêu cầu header "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labels), 0)
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(dict(zip(self.labels, key)))} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # key -> [số lần theo từng bucket (không cộng dồn), tổng, số lần]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            items = sorted((key, [list(entry[0]), entry[1], entry[2]]) for key, entry in self._values.items())
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_format_labels(dict(labels, le=repr(bound)))} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(dict(labels, le="+Inf"))} {count}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+
+class Gauge:
+    """Giá trị đọc tại thời điểm scrape qua hàm callback."""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {_format_value(self.read())}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'app_request_duration_seconds', 'Thời gian xử lý request theo endpoint', ('endpoint', 'method', 'status')
+))
+JSON_READS = registry.register(Counter('app_json_reads_total', 'Số lần đọc file JSON', ('file',)))
+JSON_READ_BYTES = registry.register(Counter('app_json_read_bytes_total', 'Số byte JSON đã đọc', ('file',)))
+JSON_WRITES = registry.register(Counter('app_json_writes_total', 'Số lần ghi file JSON', ('file',)))
+JSON_WRITE_BYTES = registry.register(Counter('app_json_write_bytes_total', 'Số byte JSON đã ghi', ('file',)))
+REQUEST_JSON_READ_BYTES = registry.register(Counter(
+    'app_request_json_read_bytes_total', 'Số byte JSON đọc trong các request, theo endpoint', ('endpoint',)
+))
+REQUEST_JSON_WRITE_BYTES = registry.register(Counter(
+    'app_request_json_write_bytes_total', 'Số byte JSON ghi trong các request, theo endpoint', ('endpoint',)
+))
+CALL_SECONDS = registry.register(Histogram(
+    'app_call_duration_seconds', 'Thời gian các lời gọi được theo dõi (AI, ...)', ('call', 'outcome')
+))
+
+
+class RequestStats:
+    """Số liệu của một request, dùng cho log request chậm."""
+    __slots__ = ('reads', 'read_bytes', 'writes', 'write_bytes', 'calls')
+
+    def __init__(self):
+        self.reads = 0
+        self.read_bytes = 0
+        self.writes = 0
+        self.write_bytes = 0
+        # tên lời gọi -> [số lần, tổng thời gian]
+        self.calls: Dict[str, list] = {}
+
+    def describe(self) -> str:
+        parts = [
+            f'đọc JSON {self.reads} lần/{self.read_bytes} byte',
+            f'ghi JSON {self.writes} lần/{self.write_bytes} byte'
+        ]
+        for name, (count, seconds) in sorted(self.calls.items()):
+            parts.append(f'{name} {count} lần/{seconds * 1000:.0f}ms')
+        return ', '.join(parts)
+
+
+def _current_stats() -> Optional[RequestStats]:
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+def file_size(f) -> int:
+    """Kích thước (byte) của file đang mở; với file đang ghi thì tính cả phần còn trong buffer."""
+    if f.writable():
+        f.flush()
+    return os.fstat(f.fileno()).st_size
+
+
+def record_json_read(path: str, size: int) -> None:
+    name = os.path.basename(path)
+    JSON_READS.inc(file=name)
+    JSON_READ_BYTES.inc(size, file=name)
+    stats = _current_stats()
+    if stats is not None:
+        stats.reads += 1
+        stats.read_bytes += size
+
+
+def record_json_write(path: str, size: int) -> None:
+    name = os.path.basename(path)
+    JSON_WRITES.inc(file=name)
+    JSON_WRITE_BYTES.inc(size, file=name)
+    stats = _current_stats()
+    if stats is not None:
+        stats.writes += 1
+        stats.write_bytes += size
+
+
+def observe_call(name: str, seconds: float, outcome: str = 'ok') -> None:
+    CALL_SECONDS.observe(seconds, call=name, outcome=outcome)
+    stats = _current_stats()
+    if stats is not None:
+        entry = stats.calls.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+@contextmanager
+def track(name: str):
+    """Đo thời gian khối lệnh; outcome là 'ok' hoặc tên lớp ngoại lệ thoát ra khỏi khối."""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException as exc:
+        outcome = type(exc).__name__
+        raise
+    finally:
+        observe_call(name, time.perf_counter() - started, outcome)
+
+
+def init_app(app) -> None:
+    """Đo mọi request và mở endpoint /metrics (định dạng Prometheus, số liệu riêng của từng process)."""
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_stats = RequestStats()
+        g.request_started = time.perf_counter()
+
+    def finish(status: int) -> None:
+        started = g.pop('request_started', None)
+        stats = g.pop('request_stats', None)
+        if started is None or stats is None:
+            return
+        duration = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_SECONDS.observe(duration, endpoint=endpoint, method=request.method, status=str(status))
+        if stats.read_bytes:
+            REQUEST_JSON_READ_BYTES.inc(stats.read_bytes, endpoint=endpoint)
+        if stats.write_bytes:
+            REQUEST_JSON_WRITE_BYTES.inc(stats.write_bytes, endpoint=endpoint)
+        if duration >= SLOW_REQUEST_SECONDS and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+            logger.warning('Request chậm: %s %s (%s) %d trong %.0fms - %s',
+                           request.method, request.path, endpoint, status, duration * 1000, stats.describe())
+
+    @app.after_request
+    def record_request_metrics(response):
+        finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exc):
+        # Lỗi không được xử lý thì after_request không chạy
+        if exc is not None:
+            finish(500)
+
+    def metrics_view():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(registry.expose(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,193 @@
+import random
+import re
+import unicodedata
+import zlib
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # Không có NumPy thì tính chữ ký bằng Python, kết quả như nhau
+    np = None
+
+# Chữ ký MinHash gồm NUM_PERM giá trị, chia thành BANDS dải để băm LSH.
+# Với 16 dải x 4 hàng, cặp câu có độ tương đồng ~0.5 có khoảng 50% khả năng thành ứng viên, từ 0.7 trở lên là gần chắc chắn.
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+# Độ tương đồng Jaccard (ước lượng) tối thiểu để coi hai câu là gần trùng
+SIMILARITY_THRESHOLD = 0.7
+
+_PRIME = 4294967311  # số nguyên tố lớn hơn 2^32
+_rng = random.Random(20240601)
+_PERM_A = [_rng.randrange(1, 1 << 32) for _ in range(NUM_PERM)]
+_PERM_B = [_rng.randrange(0, 1 << 32) for _ in range(NUM_PERM)]
+
+
+def normalize_text(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt, bỏ dấu câu và khoảng trắng thừa."""
+    text = unicodedata.normalize('NFD', str(text or '').lower()).replace('đ', 'd')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+def question_text(question: Dict) -> str:
+    """Nội dung đem so sánh: đề bài cùng các lựa chọn (sắp xếp để đảo thứ tự lựa chọn vẫn trùng)."""
+    options = sorted(normalize_text(value) for value in (question.get('options') or {}).values())
+    return ' | '.join([normalize_text(question.get('question', ''))] + options)
+
+
+def _shingles(text: str) -> List[int]:
+    if len(text) <= SHINGLE_SIZE:
+        return [zlib.crc32(text.encode('utf-8'))]
+    return list({
+        zlib.crc32(text[start:start + SHINGLE_SIZE].encode('utf-8'))
+        for start in range(len(text) - SHINGLE_SIZE + 1)
+    })
+
+
+@lru_cache(maxsize=50000)
+def text_signature(text: str) -> tuple:
+    """Chữ ký MinHash của một đoạn văn bản đã chuẩn hóa (được nhớ lại khi dựng lại chỉ mục)."""
+    shingles = _shingles(text)
+    if np is not None:
+        values = np.array(shingles, dtype=np.uint64)
+        a = np.array(_PERM_A, dtype=np.uint64)[:, None]
+        b = np.array(_PERM_B, dtype=np.uint64)[:, None]
+        return tuple(((a * values + b) % _PRIME).min(axis=1).tolist())
+    return tuple(min((a * value + b) % _PRIME for value in shingles) for a, b in zip(_PERM_A, _PERM_B))
+
+
+def similarity(first: tuple, second: tuple) -> float:
+    """Ước lượng độ tương đồng Jaccard từ hai chữ ký."""
+    return sum(1 for x, y in zip(first, second) if x == y) / NUM_PERM
+
+
+def _band_keys(signature: tuple):
+    for band in range(BANDS):
+        yield band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+
+
+class QuestionIndex:
+    """
+    Chỉ mục câu hỏi gần trùng trong ngân hàng đề: mỗi câu có một chữ ký MinHash và nằm trong BANDS
+    bucket LSH. Thêm một đề chỉ tốn O(số câu); tra một câu chỉ so với các câu chung bucket.
+    """
+
+    def __init__(self):
+        self.entries: List[Dict] = []
+        self.buckets: Dict[tuple, List[int]] = {}
+
+    def add_exam(self, grade, exam: Dict) -> None:
+        for question in exam.get('questions', []):
+            if not isinstance(question, dict):
+                continue
+            signature = text_signature(question_text(question))
+            position = len(self.entries)
+            self.entries.append({
+                'grade': str(grade),
+                'exam_id': exam.get('id'),
+                'exam_title': exam.get('title', ''),
+                'number': question.get('number'),
+                'question': question.get('question', ''),
+                'signature': signature
+            })
+            for key in _band_keys(signature):
+                self.buckets.setdefault(key, []).append(position)
+
+    def _candidates(self, signature: tuple) -> set:
+        candidates = set()
+        for key in _band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        return candidates
+
+    def find_similar(self, question: Dict, threshold: float = SIMILARITY_THRESHOLD,
+                     exclude_exam: Optional[str] = None, limit: int = 3) -> List[Dict]:
+        """Các câu trong chỉ mục gần trùng với câu hỏi, giống nhất trước."""
+        signature = text_signature(question_text(question))
+        matches = []
+        for position in self._candidates(signature):
+            entry = self.entries[position]
+            if exclude_exam is not None and entry['exam_id'] == exclude_exam:
+                continue
+            score = similarity(signature, entry['signature'])
+            if score >= threshold:
+                matches.append(self._describe(entry, score))
+        matches.sort(key=lambda match: -match['similarity'])
+        return matches[:limit]
+
+    def match_exam(self, questions: Iterable[Dict], exclude_exam: Optional[str] = None) -> List[Dict]:
+        """Với mỗi câu của một đề (chưa lưu), các câu gần trùng đã có trong ngân hàng."""
+        report = []
+        for question in questions:
+            matches = self.find_similar(question, exclude_exam=exclude_exam)
+            if matches:
+                report.append({'number': question.get('number'), 'matches': matches})
+        return report
+
+    def duplicate_groups(self, threshold: float = SIMILARITY_THRESHOLD) -> List[Dict]:
+        """
+        Gom các câu gần trùng trong toàn ngân hàng: chỉ xét cặp chung bucket LSH (không so từng cặp)
+        rồi gộp nhóm bằng union-find. Nhóm lớn trước.
+        """
+        parent = list(range(len(self.entries)))
+
+        def find(position):
+            while parent[position] != position:
+                parent[position] = parent[parent[position]]
+                position = parent[position]
+            return position
+
+        best = {}
+        # Câu trùng hệt nhau có cùng chữ ký: gộp thẳng vào một đại diện để bucket không phình bậc hai
+        representatives = {}
+        for position, entry in enumerate(self.entries):
+            representative = representatives.setdefault(entry['signature'], position)
+            if representative != position:
+                parent[position] = representative
+                best[position] = best[representative] = 1.0
+
+        checked = set()
+        for bucket in self.buckets.values():
+            members = sorted({representatives[self.entries[position]['signature']] for position in bucket})
+            if len(members) < 2:
+                continue
+            for index, first in enumerate(members):
+                for second in members[index + 1:]:
+                    pair = (first, second)
+                    if pair in checked:
+                        continue
+                    checked.add(pair)
+                    score = similarity(self.entries[first]['signature'], self.entries[second]['signature'])
+                    if score < threshold:
+                        continue
+                    root_first, root_second = find(first), find(second)
+                    if root_first != root_second:
+                        parent[root_second] = root_first
+                    for position in pair:
+                        best[position] = max(best.get(position, 0.0), score)
+
+        groups: Dict[int, List[int]] = {}
+        for position in best:
+            groups.setdefault(find(position), []).append(position)
+        report = [
+            {
+                'size': len(members),
+                'questions': [self._describe(self.entries[position], best[position]) for position in sorted(members)]
+            }
+            for members in groups.values()
+        ]
+        report.sort(key=lambda group: -group['size'])
+        return report
+
+    @staticmethod
+    def _describe(entry: Dict, score: float) -> Dict:
+        return {
+            'grade': entry['grade'],
+            'exam_id': entry['exam_id'],
+            'exam_title': entry['exam_title'],
+            'number': entry['number'],
+            'question': entry['question'],
+            'similarity': round(score, 2)
+        }
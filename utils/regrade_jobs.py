@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+from utils.grading import compile_answer_key, regrade_result
+from utils.import_jobs import STATUS_DONE, STATUS_FAILED, STATUS_RUNNING, create_job, update_job
+
+REGRADE_JOB_WORKERS = int(os.getenv('REGRADE_JOB_WORKERS', '2'))
+# Số bài gửi sang worker mỗi lần; đề có ít bài hơn một lô thì chấm luôn trong luồng điều phối
+REGRADE_CHUNK_SIZE = int(os.getenv('REGRADE_CHUNK_SIZE', '500'))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max(1, REGRADE_JOB_WORKERS))
+        return _executor
+
+
+def regrade_chunk(results: List[Dict], answer_key) -> Dict[str, Dict]:
+    """Chạy trong process worker: chấm lại một lô bài, trả về {result id: các trường mới} của bài đổi điểm."""
+    updates = {}
+    for result in results:
+        fields = regrade_result(result, answer_key)
+        if fields is not None:
+            updates[result.get('id')] = fields
+    return updates
+
+
+def enqueue_regrade_job(db, leaderboards, grade: str, exam: Dict, changed_questions: List, created_by: Optional[str],
+                        on_finished: Optional[Callable[[str, str], None]] = None) -> str:
+    """
+    Chấm lại mọi bài đã nộp của đề sau khi sửa đáp án.
+    Luồng điều phối chạy trong web process và dùng chính `db`/`leaderboards` của app (chung khóa ghi kết quả
+    và chỉ mục trong bộ nhớ); on_finished(grade, exam_id) làm mới thống kê. Việc chấm được chia lô trên process pool.
+    """
+    payload = {'kind': 'regrade', 'grade': grade, 'exam_id': exam.get('id'), 'changed_questions': changed_questions}
+    job_id = create_job(payload, created_by)
+    update_job(job_id, exam_id=exam.get('id'))
+    answer_key = compile_answer_key(exam.get('questions', []))
+    worker = threading.Thread(target=_run_regrade_job_safely,
+                              args=(db, leaderboards, job_id, grade, exam.get('id'), answer_key, on_finished),
+                              daemon=True)
+    worker.start()
+    return job_id
+
+
+def _run_regrade_job_safely(db, leaderboards, job_id, grade, exam_id, answer_key, on_finished) -> None:
+    try:
+        run_regrade_job(db, leaderboards, job_id, grade, exam_id, answer_key, on_finished)
+    except Exception as exc:
+        update_job(job_id, status=STATUS_FAILED, message=f'Lỗi không xác định khi chấm lại: {exc}')
+
+
+def run_regrade_job(db, leaderboards, job_id: str, grade: str, exam_id: str, answer_key,
+                    on_finished: Optional[Callable[[str, str], None]] = None) -> None:
+    results = db.get_exam_results(grade, exam_id)
+    total = len(results)
+    update_job(job_id, status=STATUS_RUNNING, progress=0, message=f'Đang chấm lại {total} bài nộp')
+
+    updates = {}
+    chunks = [results[start:start + REGRADE_CHUNK_SIZE] for start in range(0, total, REGRADE_CHUNK_SIZE)]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            updates.update(regrade_chunk(chunk, answer_key))
+    else:
+        executor = _get_executor()
+        futures = {executor.submit(regrade_chunk, chunk, answer_key): len(chunk) for chunk in chunks}
+        done = 0
+        for future in as_completed(futures):
+            updates.update(future.result())
+            done += futures[future]
+            # Chừa 10% cuối cho bước ghi file
+            update_job(job_id, progress=int(done * 90 / total), message=f'Đã chấm lại {done}/{total} bài nộp')
+
+    update_job(job_id, progress=90, message='Đang lưu điểm mới')
+    applied = db.apply_regraded_results(updates)
+    if applied:
+        leaderboards.rebuild()
+    if on_finished is not None:
+        on_finished(grade, exam_id)
+
+    update_job(
+        job_id,
+        status=STATUS_DONE,
+        progress=100,
+        message=f'Đã chấm lại {total} bài nộp, {applied} bài thay đổi điểm.',
+        result={'grade': grade, 'total': total, 'changed': applied}
+    )
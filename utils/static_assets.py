@@ -0,0 +1,183 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, Iterable, Optional
+
+from flask import Response, current_app, render_template, request, send_from_directory, session
+from markupsafe import escape
+
+try:
+    import brotli
+except ImportError:  # brotli không bắt buộc; khi thiếu chỉ tạo bản .gz
+    brotli = None
+
+DIST_FOLDER_NAME = 'dist'
+MANIFEST_NAME = 'manifest.json'
+PRERENDER_FOLDER = os.getenv('PRERENDER_FOLDER', 'data/prerendered')
+# Thư mục con của static/ không đưa vào bước build (file người dùng tải lên, kết quả build)
+SKIP_FOLDERS = {'uploads', DIST_FOLDER_NAME}
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map'}
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Tên người dùng trong trang render sẵn được thay vào chỗ này lúc trả về
+USERNAME_PLACEHOLDER = '__PRERENDER_USERNAME__'
+ROLES = ('student', 'teacher')
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _precompress(path: str, data: bytes):
+    """Tạo bản .br/.gz nếu nhỏ hơn bản gốc; trả về danh sách encoding đã tạo (ưu tiên br)."""
+    encodings = []
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return encodings
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            _write_atomic(f'{path}.br', compressed)
+            encodings.append('br')
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) < len(data):
+        _write_atomic(f'{path}.gz', compressed)
+        encodings.append('gzip')
+    return encodings
+
+
+def _page_filename(template_name: str, role: str) -> str:
+    stem = os.path.splitext(template_name)[0].replace('/', '__')
+    return os.path.join(PRERENDER_FOLDER, f'{stem}.{role}.html')
+
+
+class StaticAssets:
+    """
+    Phục vụ static/ theo bản build: URL có mã băm nội dung (cache vĩnh viễn), chọn bản nén sẵn
+    theo Accept-Encoding, và trả các trang tĩnh đã render sẵn thay vì chạy Jinja mỗi lần.
+    Chưa chạy `flask build-static` thì mọi thứ hoạt động như cũ.
+    """
+
+    def __init__(self, app=None):
+        self.manifest: Dict[str, str] = {}
+        self.encodings: Dict[str, list] = {}
+        self._pages: Dict = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.dist_folder = os.path.join(self.static_folder, DIST_FOLDER_NAME)
+        self.load_manifest()
+        app.url_defaults(self._fingerprint_url)
+        app.view_functions['static'] = self.serve_static
+        app.extensions['static_assets'] = self
+
+    def load_manifest(self) -> None:
+        try:
+            with open(os.path.join(self.dist_folder, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            data = {}
+        self.manifest = data.get('files', {})
+        self.encodings = data.get('encodings', {})
+
+    def build(self, pages: Iterable[str] = ()) -> Dict[str, str]:
+        """Build lại static/dist (bản có mã băm + bản nén) rồi render sẵn các trang trong `pages`."""
+        shutil.rmtree(self.dist_folder, ignore_errors=True)
+        files, encodings = {}, {}
+        for root, folders, names in os.walk(self.static_folder):
+            if os.path.abspath(root) == os.path.abspath(self.static_folder):
+                folders[:] = [name for name in folders if name not in SKIP_FOLDERS]
+            for name in names:
+                source = os.path.join(root, name)
+                relative = os.path.relpath(source, self.static_folder).replace(os.sep, '/')
+                with open(source, 'rb') as f:
+                    data = f.read()
+                stem, extension = os.path.splitext(relative)
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                hashed = f'{DIST_FOLDER_NAME}/{stem}.{digest}{extension}'
+                target = os.path.join(self.static_folder, hashed)
+                _write_atomic(target, data)
+                files[relative] = hashed
+                encodings[hashed] = _precompress(target, data)
+
+        manifest = json.dumps({'files': files, 'encodings': encodings}, ensure_ascii=False, indent=2)
+        _write_atomic(os.path.join(self.dist_folder, MANIFEST_NAME), manifest.encode('utf-8'))
+        self.load_manifest()
+
+        shutil.rmtree(PRERENDER_FOLDER, ignore_errors=True)
+        with self._lock:
+            self._pages.clear()
+        for template_name in pages:
+            for role in ROLES:
+                html = self._prerender(template_name, role)
+                _write_atomic(_page_filename(template_name, role), html.encode('utf-8'))
+        return files
+
+    def _fingerprint_url(self, endpoint, values) -> None:
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def _negotiate(self, filename: str) -> Optional[str]:
+        for encoding in self.encodings.get(filename, []):
+            if request.accept_encodings[encoding]:
+                return encoding
+        return None
+
+    def serve_static(self, filename):
+        if filename not in self.encodings:
+            return current_app.send_static_file(filename)
+
+        encoding = self._negotiate(filename)
+        if encoding:
+            suffix = 'br' if encoding == 'br' else 'gz'
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(self.static_folder, f'{filename}.{suffix}', mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = send_from_directory(self.static_folder, filename)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    def _prerender(self, template_name: str, role: str) -> str:
+        # Render trong một request giả, với session mẫu của vai trò tương ứng
+        with current_app.test_request_context():
+            session['user_id'] = '__prerender__'
+            session['role'] = role
+            session['username'] = USERNAME_PLACEHOLDER
+            return render_template(template_name, username=USERNAME_PLACEHOLDER)
+
+    def _get_page(self, template_name: str, role: str) -> str:
+        key = (template_name, role)
+        html = self._pages.get(key)
+        if html is None:
+            try:
+                with open(_page_filename(template_name, role), 'r', encoding='utf-8') as f:
+                    html = f.read()
+            except FileNotFoundError:
+                html = self._prerender(template_name, role)
+            with self._lock:
+                self._pages[key] = html
+        return html
+
+    def render_page(self, template_name: str):
+        """
+        Trang tĩnh (chỉ phụ thuộc vai trò + tên người dùng trên thanh menu) được render một lần rồi dùng lại.
+        Có thông báo flash đang chờ hoặc đang chạy debug thì render bằng Jinja như bình thường.
+        """
+        if current_app.debug or session.get('_flashes'):
+            return render_template(template_name, username=session.get('username'))
+        role = 'teacher' if session.get('role') == 'teacher' else 'student'
+        html = self._get_page(template_name, role)
+        return Response(html.replace(USERNAME_PLACEHOLDER, str(escape(session.get('username', '')))),
+                        mimetype='text/html')